@@ -0,0 +1,128 @@
+import itertools
+import time
+
+from locust import FastHttpUser, events, task, between
+
+from utils.seeding import user_random, worker_index
+from utils.targets import TargetMix, load_targets
+from utils import capabilities, connections, distributed, saturation, validation
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+# extend command line with the targets file of the mixed workload
+@events.init_command_line_parser.add_listener
+def init_parser(parser):
+    parser.add_argument(
+        "--targets-file",
+        type=str,
+        default=None,
+        help="JSON (or YAML) file of the WMS and WMTS targets of the run: host, layer, request parameters and traffic weight of each one",
+    )
+    parser.add_argument(
+        "--random-seed",
+        type=int,
+        default=1640,
+        help="Random seed of the targets, bboxes and tiles drawn by each user, this is important to prevent server/client caching. If no seed then 1640 value will be used",
+    )
+    capabilities.add_arguments(parser)
+    validation.add_arguments(parser)
+    connections.add_arguments(parser)
+    distributed.add_arguments(parser)
+    saturation.add_arguments(parser)
+
+
+@events.init.add_listener
+def on_init(environment, **kwargs):
+    """
+    Receive the work partitioning of the master on workers.
+    """
+    distributed.register(environment)
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **kwargs):
+    """
+    Resolve the targets once per process, before users are spawned: the
+    capabilities of each service url are parsed once, whatever the number of
+    its layers and users.
+    """
+    options = environment.parsed_options
+    if not options.targets_file:
+        raise SystemExit("mixed.py needs a --targets-file")
+    targets = load_targets(options.targets_file, host=environment.host, cache_dir=options.capabilities_cache_dir)
+    for target in targets:
+        logger.info(f"Target {target.name}: {target.service} layer {target.layer}, weight {target.weight}")
+    MixedBenchmark.target_mix = TargetMix(targets)
+    MixedBenchmark.request_headers = connections.request_headers(options)
+    connections.apply_options(MixedBenchmark, options)
+    distributed.start_reporter(environment)
+    saturation.start_monitor(environment)
+    # capabilities of the targets and slots of the workers, before the users are spawned
+    distributed.send_setup(environment)
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **kwargs):
+    """
+    Log (and write to --worker-report-output and --client-report-output) the
+    last client CPU and client saturation reports.
+    """
+    distributed.stop_reporter()
+    saturation.stop_monitor()
+
+
+class MixedBenchmark(FastHttpUser):
+    """
+    A class to model a mixed WMS and WMTS workload over several layers: each
+    request goes to a target drawn from the traffic weights of the targets file.
+    Statistics are reported per target (service and layer).
+    """
+
+    # The targets have their own host, --host is only the default of the targets without one
+    host = ""
+
+    # Defines a wait time of 1 to 2 seconds between consecutive tasks executed by a simulated user
+    wait_time = between(1, 2)
+
+    # Index of the users spawned in this process, used to give each user its own random stream
+    user_indexes = itertools.count()
+
+    # shared by all the users of the process, set on test start
+    target_mix = None
+    request_headers = {}
+
+    def on_start(self):
+        """
+        On start, only the random streams and the response validators of the user
+        are created, the targets are shared.
+        """
+        options = self.environment.parsed_options
+        user_index = next(self.user_indexes)
+        self.rng = user_random(options.random_seed, worker_index(self.environment), user_index, "mixed")
+        # ServiceException, image format, size and blank checks of the responses (--validate-*)
+        validation_rng = user_random(options.random_seed, worker_index(self.environment), user_index, "validation")
+        self.validators = {
+            target.name: validation.validator_from_options(options, target.format, rng=validation_rng)
+            for target in self.target_mix.targets
+        }
+
+    @task
+    def load_target(self):
+        """
+        A task that sends a GetMap or GetTile request to the next target.
+        """
+        start = time.perf_counter()
+        target = self.target_mix.sample(self.rng)
+        saturation.add(saturation.DRAW, start)
+        start = time.perf_counter()
+        # the bbox or tile is drawn with the URL
+        url, width, height = target.request(self.rng)
+        saturation.add(saturation.URL, start)
+        logger.debug("URL for request: %s", url)
+        with self.client.get(url, name=target.name, headers=self.request_headers, catch_response=True) as response:
+            validator = self.validators.get(target.name)
+            if validator:
+                validation.check_response(response, validator, width, height)
@@ -27,6 +27,8 @@ docker run --rm -v $(pwd)/reports:/reports -v $(pwd)/logs:/logs \
 website.benchmark:v0.0.1 \
 -f wmts.py  --host "$HOST_URL" \
 --random-seed $RANDOM_SEED  --layer-name "$LAYER_NAME" \
+--capabilities-cache-dir /reports/capabilities \
+--history-db /reports/history.sqlite --history-compare 10 \
 --headless -u 100 -r 10 -t 4m \
 --html /reports/${HOST_SANITIZED}_${LAYER_NAME}_u100_r10_t4_s${RANDOM_SEED}.html \
 --loglevel DEBUG --logfile /logs/${HOST_SANITIZED}_${LAYER_NAME}_u100_r10_t4_s${RANDOM_SEED}.log
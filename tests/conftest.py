@@ -0,0 +1,69 @@
+"""Fixtures of the harness tests: mock servers and locust environments of wms.py and wmts.py"""
+import itertools
+
+import pytest
+from locust import constant
+from locust.argument_parser import get_empty_argument_parser, setup_parser_arguments
+from locust.env import Environment
+from locust.event import Events
+
+from utils.mock_server import MockServer
+
+
+def parse_options(locustfile, *args):
+    """
+    Options of a locustfile with their defaults, from its own parser only:
+    wms.py and wmts.py can not share one parser, their options overlap.
+    """
+    parser = get_empty_argument_parser(add_help=False, default_config_files=[])
+    setup_parser_arguments(parser)
+    locustfile.init_parser(parser)
+    return parser.parse_args(["-f", locustfile.__file__, *args])
+
+
+def benchmark_environment(locustfile, user_class, host: str, *args, wait_time=None):
+    """
+    Local runner environment of a user class of a locustfile, with its own
+    events: only the test start and stop listeners of that locustfile run.
+    The user class is subclassed with its own user indexes (and a wait time).
+    """
+    attributes = {"host": host, "user_indexes": itertools.count()}
+    if wait_time is not None:
+        attributes["wait_time"] = wait_time
+    user_class = type(user_class.__name__, (user_class,), attributes)
+    events = Events()
+    events.test_start.add_listener(locustfile.on_test_start)
+    events.test_stop.add_listener(locustfile.on_test_stop)
+    environment = Environment(
+        user_classes=[user_class], host=host, parsed_options=parse_options(locustfile, *args), events=events
+    )
+    environment.create_local_runner()
+    return environment, user_class
+
+
+def started_user(locustfile, user_class, host: str, *args, user_count: int = 1):
+    """
+    The last of `user_count` users of a locustfile in one environment,
+    after test start and their on_start, without wait time.
+    """
+    environment, user_class = benchmark_environment(locustfile, user_class, host, *args, wait_time=constant(0))
+    environment.events.test_start.fire(environment=environment)
+    for _ in range(user_count):
+        user = user_class(environment)
+        user.on_start()
+    return user
+
+
+@pytest.fixture
+def mock_server():
+    """Start mock servers in this process, stopped after the test"""
+    servers = []
+
+    def start(**settings) -> MockServer:
+        server = MockServer(**settings).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
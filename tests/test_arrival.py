@@ -0,0 +1,88 @@
+"""Open loop: rate of each user from the users of the whole test, late arrivals"""
+from types import SimpleNamespace
+import time
+
+import gevent
+import pytest
+from locust.env import Environment
+
+from utils import arrival, distributed, seeding
+
+
+@pytest.fixture(autouse=True)
+def clean_partition(monkeypatch):
+    monkeypatch.setattr(seeding, "_worker_slot", None)
+    monkeypatch.setattr(seeding, "_worker_total", None)
+    monkeypatch.setattr(seeding, "_test_users", None)
+
+
+def environment(runner_type: str, target_user_count: int = 0, **options):
+    runner = type(runner_type, (), {"target_user_count": target_user_count})()
+    return SimpleNamespace(runner=runner, parsed_options=SimpleNamespace(capacity_search=False, **options))
+
+
+def test_worker_rate_uses_the_users_of_the_master():
+    # -u is a default locust option, not sent to the workers: they only know their own share of the users
+    worker = environment("WorkerRunner", target_user_count=25, num_users=None)
+    message = SimpleNamespace(data={"slot": 1, "workers": 4, "users": 100, "capabilities": []})
+    distributed.on_worker_setup(worker, message)
+
+    assert seeding.worker_index(worker) == 1 and seeding.worker_count(worker) == 4
+    assert arrival.user_rate(worker, 200.0) == pytest.approx(2.0)
+
+
+def test_master_sends_its_target_user_count():
+    sent = []
+    nodes = [SimpleNamespace(id=f"worker-{index}") for index in range(2)]
+    runner = type(
+        "MasterRunner",
+        (),
+        {
+            "target_user_count": 30,
+            "clients": SimpleNamespace(ready=nodes, spawning=[], running=[]),
+            "get_worker_index": lambda self, client_id: int(client_id.split("-")[1]),
+            "send_message": lambda self, kind, data, client_id: sent.append(data),
+        },
+    )()
+    # web UI run: no -u
+    distributed.send_setup(SimpleNamespace(runner=runner, parsed_options=SimpleNamespace(num_users=None)))
+
+    assert [(data["slot"], data["workers"], data["users"]) for data in sent] == [(0, 2, 30), (1, 2, 30)]
+
+
+def test_local_rate_uses_the_target_user_count():
+    # web UI run of a local runner, -u not given
+    local = environment("LocalRunner", target_user_count=40, num_users=None)
+    assert arrival.user_rate(local, 200.0) == pytest.approx(5.0)
+    assert arrival.user_rate(environment("LocalRunner", num_users=20), 200.0) == pytest.approx(10.0)
+
+
+def test_capacity_search_rate_is_per_user():
+    search = environment("LocalRunner", target_user_count=40)
+    search.parsed_options.capacity_search = True
+    assert arrival.user_rate(search, 5.0) == 5.0
+
+
+def test_late_arrivals_are_counted_apart_from_the_requests():
+    arrival.late_stats.clear_all()
+    environment = Environment()
+    sent = []
+    # the first 5 arrivals were due 1 s ago
+    open_loop = arrival.OpenLoop(environment, rate=5.0, max_concurrency=10, max_lag=2.0)
+    open_loop.schedule = arrival.arrival_times(5.0, start=time.perf_counter() - 1.0)
+    greenlet = gevent.spawn(open_loop.run, sent.append)
+    gevent.sleep(0.1)
+    greenlet.kill()
+
+    late = arrival.late_stats.get("late", arrival.REQUEST_TYPE).num_requests
+    assert len(sent) >= 5 and late >= 5
+    # the requests themselves are the only entries of the locust statistics
+    assert environment.stats.total.num_requests == 0 and not environment.stats.entries
+
+    # a worker sends its late entries with its stats report, the master adds them up
+    data = {}
+    arrival.on_report_to_master("worker-0", data)
+    assert arrival.late_stats.get("late", arrival.REQUEST_TYPE).num_requests == 0
+    arrival.on_worker_report("worker-0", data)
+    arrival.on_worker_report("worker-1", data)
+    assert arrival.late_stats.get("late", arrival.REQUEST_TYPE).num_requests == 2 * late
@@ -0,0 +1,82 @@
+"""Capacity search: steps driven by a simulated server on a fake clock"""
+from types import SimpleNamespace
+
+from locust.stats import RequestStats
+
+from utils import arrival
+from utils.capacity import CapacitySearchShape
+
+# requests per user and second of the simulated server
+USER_RPS = 1
+
+
+def search(capacity: int, ticks: int = 10000, **kwargs):
+    """
+    Run a capacity search against a server meeting a 200 ms p95 up to
+    `capacity` users, 1 s per tick. The runner reaches the user count of a
+    tick at once. Returns the shape and the user count of every tick.
+    """
+    clock = [0.0]
+    stats = RequestStats()
+    runner = SimpleNamespace(user_count=0, environment=SimpleNamespace(stats=stats))
+    options = {"slo_p95": 200, "start_users": 10, "growth": 2.0, "step_time": 30, "warmup": 5, "resolution": 0.05, **kwargs}
+    shape = CapacitySearchShape(**options)
+    shape.runner = runner
+    shape.get_run_time = lambda: clock[0]
+    users_per_tick = []
+    for _ in range(ticks):
+        tick = shape.tick()
+        if tick is None:
+            break
+        runner.user_count = tick[0]
+        users_per_tick.append(tick[0])
+        clock[0] += 1.0
+        response_time = 50 if runner.user_count <= capacity else 800
+        for _ in range(runner.user_count * USER_RPS):
+            stats.log_request("GET", "GetTile", response_time, 1000)
+        # OPENLOOP entries are not requests to the server (only the dropped failures count, as errors)
+        stats.log_request(arrival.REQUEST_TYPE, "late", 5000, 0)
+    return shape, users_per_tick
+
+
+def test_users_grow_until_the_slo_breaks_then_bisect():
+    shape, _ = search(capacity=100)
+
+    steps = [step["users"] for step in shape.steps]
+    # growth by 2 from 10 users, then a binary search between 80 and 160 users
+    assert steps[:5] == [10, 20, 40, 80, 160]
+    # down to 5% of the good user count
+    assert steps[5:] == [120, 100, 110, 105]
+    assert shape.result["users"] == 100 and shape.result["broke_at"]["users"] == 105
+    assert shape.result["max_rps"] == 100 * USER_RPS
+    assert shape.result["p95"] == 50 and shape.result["error_rate"] == 0
+    assert shape.steps[4]["reason"] == "p95 800ms > 200ms"
+
+
+def test_bisection_stops_at_the_resolution():
+    shape, _ = search(capacity=1000, resolution=0.1)
+
+    # 640 meets the SLO and 1280 breaks it, the search ends within 10% of the good user count
+    good, bad = shape.result["users"], shape.result["broke_at"]["users"]
+    assert good <= 1000 < bad and bad - good <= 0.1 * good
+    assert [step["users"] for step in shape.steps][-1] in (good, bad)
+
+
+def test_users_are_stopped_after_a_step_breaking_the_slo():
+    shape, users_per_tick = search(capacity=30)
+
+    # 10, 20 meet the SLO and 40 breaks it: every user is stopped for the warm up
+    end_of_40 = users_per_tick.index(40) + users_per_tick.count(40)
+    assert users_per_tick[end_of_40 - 1] == 40
+    assert users_per_tick[end_of_40 : end_of_40 + 5] == [0] * 5
+    assert users_per_tick[end_of_40 + 5] == 30
+    # no cooldown after a step meeting the SLO
+    end_of_10 = users_per_tick.count(10)
+    assert users_per_tick[end_of_10] == 20
+
+
+def test_search_stops_at_max_users():
+    shape, _ = search(capacity=10000, max_users=50)
+
+    assert [step["users"] for step in shape.steps] == [10, 20, 40, 50]
+    assert shape.result["users"] == 50 and shape.result["broke_at"] is None
@@ -0,0 +1,75 @@
+"""Coverage masks: tiles are drawn from the bitset through its rank index"""
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from utils.coverage import BLOCK_BYTES, BitsetIndex, CoverageError, CoverageSampler, rasterize, tile_range
+from utils.hotspots import point_tiles
+
+# mainland Portugal, longitude/latitude
+PORTUGAL = (-9.5, 36.9, -6.2, 42.2)
+
+
+def random_mask(cols: int, rows: int, density: float, seed: int = 1):
+    """Bitset of a (10, 10 + cols - 1, 20, 20 + rows - 1) range and its set tiles from the range origin"""
+    rng = random.Random(seed)
+    row_bytes = (cols + 7) // 8
+    bits = bytearray(row_bytes * rows)
+    tiles = []
+    for row in range(rows):
+        for col in range(cols):
+            if rng.random() < density:
+                bits[row * row_bytes + col // 8] |= 0x80 >> (col % 8)
+                tiles.append((col, row))
+    return (10, 10 + cols - 1, 20, 20 + rows - 1), bytes(bits), tiles
+
+
+@pytest.mark.parametrize("cols, rows, density", [(1000, 70, 0.3), (13, 500, 0.5), (3000, 40, 0.002)])
+def test_ranks_select_every_set_tile_in_order(cols, rows, density):
+    matrix_range, bits, tiles = random_mask(cols, rows, density)
+    index = BitsetIndex(matrix_range, bits)
+    assert len(index) == len(tiles)
+    assert len(index.prefix) == -(-len(bits) // BLOCK_BYTES)
+    assert [index.select(rank) for rank in range(len(index))] == tiles
+
+
+def test_sampler_draws_tiles_with_data():
+    matrix_range, bits, tiles = random_mask(200, 100, 0.05)
+    sampler = CoverageSampler(matrix_range, BitsetIndex(matrix_range, bits), random.Random(3))
+    covered = {(10 + col, 20 + row) for col, row in tiles}
+    drawn = [next(sampler) for _ in range(5000)]
+    assert set(drawn) <= covered and len(set(drawn)) > 0.9 * len(covered)
+
+
+def test_empty_mask_is_rejected():
+    matrix_range, bits, _ = random_mask(100, 10, 0.0)
+    with pytest.raises(CoverageError):
+        CoverageSampler(matrix_range, BitsetIndex(matrix_range, bits))
+
+
+@pytest.mark.parametrize(
+    "crs, top_left_corner",
+    [("urn:ogc:def:crs:OGC:1.3:CRS84", (-180.0, 90.0)), ("urn:ogc:def:crs:EPSG::4326", (90.0, -180.0))],
+)
+def test_geographic_tile_matrix(crs, top_left_corner):
+    # WorldCRS84Quad level 5: 64x32 tiles of 5.625 degrees, EPSG:4326 corners are latitude first
+    tile_matrix = SimpleNamespace(
+        scaledenominator=279541132.0143589 / 2**5,
+        topleftcorner=top_left_corner,
+        tilewidth=256,
+        tileheight=256,
+        matrixwidth=64,
+        matrixheight=32,
+    )
+    matrix_range = tile_range(tile_matrix, extent=PORTUGAL, crs=crs)
+    assert matrix_range == (30, 30, 8, 9)
+
+    minx, miny, maxx, maxy = PORTUGAL
+    bits = rasterize([[(minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy)]], tile_matrix, matrix_range, crs)
+    assert bytes(bits) == bytes([0x80, 0x80])
+    assert list(point_tiles([(-9.14, 38.72), (-8.61, 41.15), (2.35, 48.86)], tile_matrix, matrix_range, crs)) == [
+        (30, 9),
+        (30, 8),
+        (30, 8),
+    ]
@@ -0,0 +1,97 @@
+"""URL building, seeding determinism and response validation of the users, against the mock server"""
+import itertools
+from urllib.parse import parse_qsl, urlsplit
+
+import wms
+import wmts
+from conftest import started_user
+from utils.mock_server import EXTENT, LAYER, TILE_MATRIX_SET
+from utils.url_template import encode_bbox, encode_value
+from utils.validation import BlankImageError, ServiceExceptionError
+
+
+def query(url: str) -> dict:
+    return {key.lower(): value for key, value in parse_qsl(urlsplit(url).query)}
+
+
+def test_wms_getmap_url(mock_server):
+    server = mock_server()
+    user = started_user(wms, wms.WMSBenchmark, server.wms_url, "--bbox-area", "100")
+    bbox = next(user.bbox_generator)
+    url = user.url_template.render_encoded(bbox=encode_bbox(bbox))
+
+    params = query(url)
+    assert (params["request"], params["layers"], params["crs"]) == ("GetMap", LAYER, "EPSG:3763")
+    assert (params["width"], params["height"], params["format"]) == ("512", "512", "image/png")
+    minx, miny, maxx, maxy = (float(value) for value in params["bbox"].split(","))
+    assert EXTENT[0] <= minx < maxx <= EXTENT[2] and EXTENT[1] <= miny < maxy <= EXTENT[3]
+    assert abs((maxx - minx) * (maxy - miny) - 100e6) < 1e3
+
+
+def test_wmts_gettile_url(mock_server):
+    server = mock_server()
+    user = started_user(wmts, wmts.WMTSBenchmark, server.wmts_url)
+    tile_matrix, tile_col, tile_row = next(user.tile_generator)
+    url = user.url_template.render_encoded(tilematrix=encode_value(tile_matrix), tilecol=tile_col, tilerow=tile_row)
+
+    params = query(url)
+    assert (params["request"], params["layer"], params["tilematrixset"]) == ("GetTile", LAYER, TILE_MATRIX_SET)
+    # no --tile-matrix, the middle level
+    assert params["tilematrix"] == tile_matrix == "06"
+    min_col, max_col, min_row, max_row = user.tile_ranges[tile_matrix]
+    assert min_col <= int(params["tilecol"]) <= max_col and min_row <= int(params["tilerow"]) <= max_row
+
+
+def bboxes(server, user_count: int, *args):
+    """First bboxes of the last of `user_count` users"""
+    user = started_user(wms, wms.WMSBenchmark, server.wms_url, *args, user_count=user_count)
+    return list(itertools.islice(user.bbox_generator, 20))
+
+
+def test_wms_bboxes_depend_only_on_the_seed_and_user(mock_server):
+    server = mock_server()
+    first = bboxes(server, 1, "--random-seed", "7")
+    assert bboxes(server, 1, "--random-seed", "7") == first
+    assert bboxes(server, 1, "--random-seed", "8") != first
+    assert bboxes(server, 2, "--random-seed", "7") != first
+
+
+def test_wmts_tiles_depend_only_on_the_seed(mock_server):
+    server = mock_server()
+    tiles = lambda seed: list(
+        itertools.islice(
+            started_user(wmts, wmts.WMTSBenchmark, server.wmts_url, "--random-seed", seed, "--tile-matrix", "04:08").tile_generator,
+            50,
+        )
+    )
+    first = tiles("7")
+    assert tiles("7") == first and tiles("8") != first
+    assert {tile_matrix for tile_matrix, _, _ in first} > {"04"}
+
+
+def failures(user, requests: int = 10) -> dict:
+    """Failures of the user requests by error type"""
+    for _ in range(requests):
+        user.request_map() if isinstance(user, wms.WMSBenchmark) else user.request_tile()
+    counts = {}
+    for error in user.environment.stats.errors.values():
+        counts[type(error.error)] = counts.get(type(error.error), 0) + error.occurrences
+    return counts
+
+
+def test_valid_responses_pass_validation(mock_server):
+    server = mock_server()
+    assert failures(started_user(wms, wms.WMSBenchmark, server.wms_url, "--validate-responses")) == {}
+    assert failures(started_user(wmts, wmts.WMTSBenchmark, server.wmts_url, "--validate-responses")) == {}
+
+
+def test_service_exceptions_are_failures(mock_server):
+    server = mock_server(exception_rate=1.0)
+    user = started_user(wms, wms.WMSBenchmark, server.wms_url, "--validate-responses")
+    assert failures(user) == {ServiceExceptionError: 10}
+
+
+def test_blank_images_are_failures(mock_server):
+    server = mock_server(blank_rate=1.0)
+    user = started_user(wmts, wmts.WMTSBenchmark, server.wmts_url, "--validate-responses", "--validate-blank-fraction", "1")
+    assert failures(user) == {BlankImageError: 10}
@@ -0,0 +1,102 @@
+"""Run history: regressions against the prediction limit of the previous runs of a configuration"""
+import math
+
+import pytest
+
+from utils import history
+
+CONFIG = {"service": "WMTS", "host": "http://127.0.0.1/wmts", "layer": "mock", "tile_matrix": "06", "users": 20}
+# small run to run variations of a stable service
+NOISE = (0.0, 0.01, -0.01, 0.02, -0.02, 0.015, -0.005, 0.005, -0.015, 0.0)
+
+
+def summary(p50=100.0, p95=200.0, p99=300.0, rps=50.0, error_rate=0.001) -> dict:
+    requests = 3000
+    return {
+        "duration": requests / rps,
+        "requests": requests,
+        "failures": round(error_rate * requests),
+        "error_rate": error_rate,
+        "rps": rps,
+        "p50": p50,
+        "p90": p95,
+        "p95": p95,
+        "p99": p99,
+        "max": p99 * 2,
+        "bytes": requests * 20000,
+        "response_times": {round(p50): requests // 2, round(p95): requests // 2},
+    }
+
+
+@pytest.fixture
+def connection(tmp_path):
+    """History database with 10 stable runs of CONFIG, and runs of another configuration"""
+    connection = history.connect(str(tmp_path / "history" / "runs.sqlite"))
+    for day, noise in enumerate(NOISE):
+        stable = summary(100 * (1 + noise), 200 * (1 - noise), 300 * (1 + noise / 2), 50 * (1 + noise), 0.001 + noise / 100)
+        history.append_run(connection, CONFIG, stable, seed=day, started=1000.0 + day)
+        # a slower configuration, not part of the baseline of CONFIG
+        history.append_run(connection, {**CONFIG, "users": 200}, summary(p95=2000, rps=20), started=1000.5 + day)
+    yield connection
+    connection.close()
+
+
+def flagged(rows) -> set:
+    return {row["metric"] for row in rows if row["regression"]}
+
+
+def test_regressed_run_is_flagged(connection):
+    run_id = history.append_run(connection, CONFIG, summary(p95=300, rps=35, error_rate=0.05), started=2000.0)
+    rows = {row["metric"]: row for row in history.compare_run(connection, run_id, last=10)}
+
+    assert flagged(rows.values()) == {"p95", "rps", "error_rate"}
+    assert rows["p95"]["runs"] == 10 and rows["p95"]["mean"] == pytest.approx(200, rel=0.01)
+    # lower is worse for the throughput: its limit is under the mean
+    assert rows["rps"]["limit"] < rows["rps"]["mean"] < 50 * 1.01
+
+
+def test_noise_of_a_stable_service_is_not_flagged(connection):
+    run_id = history.append_run(connection, CONFIG, summary(p50=101, p95=204, p99=297, rps=49.5), started=2000.0)
+    assert flagged(history.compare_run(connection, run_id)) == set()
+
+
+def test_change_under_the_minimum_effect_is_not_flagged(connection):
+    # p50 is over its prediction limit, but only 6% over the mean
+    run_id = history.append_run(connection, CONFIG, summary(p50=106), started=2000.0)
+    p50 = next(row for row in history.compare_run(connection, run_id) if row["metric"] == "p50")
+    assert p50["value"] > p50["limit"] and not p50["regression"]
+
+    flagged_with_lower_effect = flagged(history.compare_run(connection, run_id, min_effect=0.05))
+    assert flagged_with_lower_effect == {"p50"}
+
+
+def test_baseline_is_the_last_runs_before_the_compared_one(connection):
+    first_id = connection.execute("SELECT MIN(id) FROM runs").fetchone()[0]
+    rows = history.compare_run(connection, first_id)
+    assert all(row["runs"] == 0 and row["limit"] is None and not row["regression"] for row in rows)
+
+    run_id = history.append_run(connection, CONFIG, summary(p95=300), started=2000.0)
+    assert {row["runs"] for row in history.compare_run(connection, run_id, last=3)} == {3}
+    with pytest.raises(history.HistoryError):
+        history.compare_run(connection, run_id + 1)
+
+
+def test_prediction_limit():
+    assert history.prediction_limit([], 1) is None and history.prediction_limit([10.0], 1) is None
+    # mean 12, standard deviation 2, t(2 degrees of freedom) = 2.920
+    spread = 2.920 * 2 * math.sqrt(1 + 1 / 3)
+    assert history.prediction_limit([10.0, 12.0, 14.0], 1) == pytest.approx(12 + spread)
+    assert history.prediction_limit([10.0, 12.0, 14.0], -1) == pytest.approx(12 - spread)
+    # the normal quantile over 30 degrees of freedom
+    values = [float(value % 2) for value in range(41)]
+    assert history.prediction_limit(values, 1) == pytest.approx(
+        sum(values) / 41 + 1.645 * history.statistics.stdev(values) * math.sqrt(1 + 1 / 41)
+    )
+
+
+def test_compare_command_exits_with_1_on_a_regression(connection, tmp_path, capsys):
+    database = str(tmp_path / "history" / "runs.sqlite")
+    assert history.main(["compare", database]) == 0
+    history.append_run(connection, CONFIG, summary(p99=600), started=2000.0)
+    assert history.main(["compare", database, "--last", "5"]) == 1
+    assert "p99" in capsys.readouterr().out.split("REGRESSION")[0].splitlines()[-1]
@@ -0,0 +1,89 @@
+"""Live metrics endpoint: a local scrape of the series of the users, and the merge of the worker reports"""
+import socket
+
+import pytest
+import requests
+
+import wms
+import wmts
+from conftest import started_user
+from utils import metrics
+from utils.mock_server import LAYER
+
+
+@pytest.fixture(autouse=True)
+def clean_metrics():
+    metrics._series.clear()
+    yield
+    metrics.stop_server()
+    metrics._series.clear()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def scrape(port: int) -> dict:
+    """Samples of the /metrics endpoint by name and labels"""
+    response = requests.get(f"http://127.0.0.1:{port}/metrics")
+    assert response.status_code == 200
+    samples = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_wmts_series_are_scraped_per_tile_matrix(mock_server):
+    server = mock_server(exception_rate=0.5, seed=3)
+    port = free_port()
+    user = started_user(wmts, wmts.WMTSBenchmark, server.wmts_url, "--metrics-port", str(port), "--validate-responses")
+    metrics.register(user.environment)
+    for _ in range(40):
+        user.request_tile()
+
+    samples = scrape(port)
+    labels = f'service="WMTS",layer="{LAYER}",tile_matrix="06"'
+    failures = samples[f'ogc_benchmark_failures_total{{{labels},error="ServiceExceptionError"}}']
+    assert samples[f"ogc_benchmark_requests_total{{{labels}}}"] == 40
+    assert samples[f'ogc_benchmark_response_time_seconds_bucket{{{labels},le="+Inf"}}'] == 40
+    assert samples[f"ogc_benchmark_response_time_seconds_count{{{labels}}}"] == 40
+    assert 5 < failures < 35 and failures == user.environment.stats.total.num_failures
+    assert samples[f"ogc_benchmark_response_bytes_total{{{labels}}}"] > 0
+    assert samples["ogc_benchmark_users"] == 0
+
+
+def test_wms_series_in_openmetrics(mock_server):
+    server = mock_server()
+    port = free_port()
+    user = started_user(wms, wms.WMSBenchmark, server.wms_url, "--metrics-port", str(port))
+    metrics.register(user.environment)
+    for _ in range(5):
+        user.request_map()
+
+    response = requests.get(f"http://127.0.0.1:{port}/metrics", headers={"Accept": "application/openmetrics-text"})
+    assert response.headers["Content-Type"].startswith("application/openmetrics-text")
+    assert response.text.endswith("# EOF\n")
+    assert "# TYPE ogc_benchmark_requests counter" in response.text
+    assert f'ogc_benchmark_requests_total{{service="WMS",layer="{LAYER}"}} 5' in response.text
+    assert requests.get(f"http://127.0.0.1:{port}/other").status_code == 404
+
+
+def test_worker_reports_are_merged_by_the_master():
+    for response_time in (10, 60, 60, 20000):
+        metrics.series("WMTS", "layer", "05").add(response_time, 1000, "http_503" if response_time > 10000 else None)
+    report = {}
+    metrics.on_report_to_master("worker", report)
+    # the increments are sent once
+    assert metrics.series("WMTS", "layer", "05").requests == 0
+    metrics.on_report_to_master("worker", {})
+    for _ in range(3):
+        metrics.on_worker_report("worker", report)
+
+    merged = metrics.series("WMTS", "layer", "05")
+    assert merged.requests == 12 and merged.bytes == 12000 and merged.failures == {"http_503": 3}
+    # 25, 50, 100 ms and +Inf buckets
+    assert (merged.buckets[0], merged.buckets[1], merged.buckets[2], merged.buckets[-1]) == (3, 0, 6, 3)
@@ -0,0 +1,103 @@
+"""Mock OGC server: capabilities, images and injected failures"""
+import time
+
+import pytest
+import requests
+from owslib.wms import WebMapService
+from owslib.wmts import WebMapTileService
+
+from utils.capabilities import load_capabilities, load_layer_capabilities
+from utils.capabilities_reader import read_wms_layer, read_wmts_layer
+from utils.mock_server import LAYER, TILE_MATRIX_SET, MockServer, MockServerError, jpeg_image, png_image, wms_capabilities, wmts_capabilities
+from utils.validation import BlankImageError, ResponseValidator
+
+
+@pytest.mark.parametrize("layers", [1, 500])
+def test_capabilities_are_read_by_owslib_and_the_streaming_reader(layers):
+    wms_xml = wms_capabilities("http://localhost/wms", layers)
+    wmts_xml = wmts_capabilities("http://localhost/wmts", layers)
+
+    wms = WebMapService("http://localhost/wms", xml=wms_xml)
+    wmts = WebMapTileService("http://localhost/wmts", xml=wmts_xml)
+    assert len(wms.contents) == len(wmts.contents) == layers
+    assert wms.contents[LAYER].boundingBox[-1] == "EPSG:3763"
+    assert list(wmts.tilematrixsets) == [TILE_MATRIX_SET]
+
+    assert LAYER in read_wms_layer(wms_xml, "http://localhost/wms").contents
+    streamed = read_wmts_layer(wmts_xml, "http://localhost/wmts", LAYER)
+    assert list(streamed.tilematrixsets) == [TILE_MATRIX_SET]
+
+
+WMS_130_XML = b"""<?xml version="1.0" encoding="UTF-8"?>
+<WMS_Capabilities version="1.3.0" xmlns="http://www.opengis.net/wms" xmlns:xlink="http://www.w3.org/1999/xlink">
+<Service><Name>WMS</Name><Title>WMS 1.3.0</Title></Service>
+<Capability><Request><GetMap><Format>image/png</Format><DCPType><HTTP><Get>
+<OnlineResource xlink:href="http://localhost/wms13?"/></Get></HTTP></DCPType></GetMap></Request>
+<Layer><Title>Root</Title><CRS>EPSG:3763</CRS><CRS>EPSG:4326</CRS>
+<EX_GeographicBoundingBox><westBoundLongitude>-9.5</westBoundLongitude><eastBoundLongitude>-6.2</eastBoundLongitude>
+<southBoundLatitude>36.9</southBoundLatitude><northBoundLatitude>42.2</northBoundLatitude></EX_GeographicBoundingBox>
+<Layer><Name>ortos</Name><Title>Ortos</Title>
+<BoundingBox CRS="EPSG:4326" minx="36.9" miny="-9.5" maxx="42.2" maxy="-6.2"/></Layer>
+</Layer></Capability></WMS_Capabilities>"""
+
+
+@pytest.mark.parametrize("layer", ["ortos", "missing"])
+def test_wms_130_capabilities_file(tmp_path, layer):
+    capabilities_file = tmp_path / "capabilities.xml"
+    capabilities_file.write_bytes(WMS_130_XML)
+    url = f"http://localhost/wms13/{layer}"
+
+    # a missing layer falls back to the owslib parse of the whole document
+    capabilities = load_layer_capabilities("WMS", url, layer, capabilities_file=str(capabilities_file))
+    assert capabilities.version == "1.3.0" and "ortos" in capabilities.contents
+    assert sorted(capabilities.contents["ortos"].crsOptions) == ["EPSG:3763", "EPSG:4326"]
+    assert capabilities.getOperationByName("GetMap").formatOptions == ["image/png"]
+    assert load_capabilities("WMS", url).contents["ortos"].boundingBox[-1] == "EPSG:4326"
+
+def test_capabilities_are_revalidated_with_their_etag(mock_server):
+    server = mock_server()
+    url = f"{server.wmts_url}?SERVICE=WMTS&REQUEST=GetCapabilities"
+    response = requests.get(url)
+    assert response.status_code == 200 and response.content.startswith(b"<?xml")
+    revalidated = requests.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    assert revalidated.status_code == 304
+
+
+@pytest.mark.parametrize("image_format, build", [("image/png", png_image), ("image/jpeg", jpeg_image)])
+@pytest.mark.parametrize("width, height", [(256, 256), (512, 384), (101, 77)])
+def test_images_have_the_requested_size_and_are_not_blank(image_format, build, width, height):
+    validator = ResponseValidator(image_format, blank_fraction=1.0)
+    headers = {"Content-Type": image_format}
+    assert validator.validate(200, headers, build(width, height), width, height) is None
+    assert isinstance(validator.validate(200, headers, build(width, height, blank=True), width, height), BlankImageError)
+
+
+def test_getmap_answers_the_requested_size_and_format(mock_server):
+    server = mock_server()
+    response = requests.get(
+        f"{server.wms_url}?SERVICE=WMS&REQUEST=GetMap&LAYERS={LAYER}&WIDTH=300&HEIGHT=200&FORMAT=image/jpeg&CRS=EPSG:3763&BBOX=0,0,1,1"
+    )
+    assert response.headers["Content-Type"] == "image/jpeg"
+    assert ResponseValidator("image/jpeg").validate(200, response.headers, response.content, 300, 200) is None
+
+
+def test_failures_are_injected_at_their_rates(mock_server):
+    server = mock_server(error_rate=0.2, exception_rate=0.3, seed=1)
+    url = f"{server.wmts_url}?SERVICE=WMTS&REQUEST=GetTile&LAYER={LAYER}&TILEMATRIX=05&TILECOL=1&TILEROW=1&FORMAT=image/png"
+    responses = [requests.get(url) for _ in range(400)]
+    errors = sum(response.status_code == 500 for response in responses)
+    exceptions = sum(b"exceptionCode" in response.content for response in responses)
+    assert 50 < errors < 110 and 85 < exceptions < 155
+    assert server.requests["gettile"] == 400
+
+
+def test_latency_is_injected(mock_server):
+    server = mock_server(latency=0.05)
+    start = time.perf_counter()
+    requests.get(f"{server.wms_url}?SERVICE=WMS&REQUEST=GetMap&WIDTH=64&HEIGHT=64&FORMAT=image/png")
+    assert time.perf_counter() - start >= 0.05
+
+
+def test_invalid_rates_are_rejected():
+    with pytest.raises(MockServerError):
+        MockServer(error_rate=1.5)
@@ -0,0 +1,82 @@
+"""
+Harness overhead: requests per CPU second of the load generator against the mock server.
+The server runs in its own process, so that the measured CPU time is the harness only.
+Run with -s to print the table, or deselect with -m "not benchmark".
+"""
+import socket
+import subprocess
+import sys
+import time
+
+import gevent
+import pytest
+import requests
+from locust import constant
+
+import wms
+import wmts
+from conftest import benchmark_environment
+
+USERS = 20
+WARMUP = 1.0
+DURATION = 3.0
+# far below a single core of a laptop, only catches gross regressions of the hot path
+MIN_REQUESTS_PER_CPU_SECOND = 200
+
+
+@pytest.fixture(scope="module")
+def server_url():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "utils.mock_server", "--port", str(port)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                requests.get(f"{url}/wms?SERVICE=WMS&REQUEST=GetCapabilities", timeout=1)
+                break
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        else:
+            pytest.fail("mock server did not start")
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@pytest.mark.benchmark
+@pytest.mark.parametrize("validate", [False, True], ids=["plain", "validated"])
+@pytest.mark.parametrize(
+    "locustfile, user_class, path",
+    [(wms, wms.WMSBenchmark, "/wms"), (wmts, wmts.WMTSBenchmark, "/wmts")],
+    ids=["wms", "wmts"],
+)
+def test_requests_per_cpu_second(server_url, locustfile, user_class, path, validate, record_property):
+    args = ["--validate-responses"] if validate else []
+    environment, _ = benchmark_environment(locustfile, user_class, server_url + path, *args, wait_time=constant(0))
+    runner = environment.runner
+    runner.start(USERS, spawn_rate=USERS)
+    gevent.sleep(WARMUP)
+    environment.stats.reset_all()
+    cpu_start = time.process_time()
+    gevent.sleep(DURATION)
+    cpu = time.process_time() - cpu_start
+    total = environment.stats.total
+    requests_count, failures = total.num_requests, total.num_failures
+    runner.quit()
+
+    per_cpu_second = requests_count / cpu
+    record_property("requests_per_cpu_second", round(per_cpu_second))
+    print(
+        f"\n{locustfile.__name__} {'validated' if validate else 'plain'}: {requests_count} requests, "
+        f"{cpu:.2f} CPU s, {per_cpu_second:.0f} requests per CPU second, "
+        f"{total.avg_response_time:.1f} ms average"
+    )
+    assert failures == 0
+    assert per_cpu_second >= MIN_REQUESTS_PER_CPU_SECOND
@@ -0,0 +1,36 @@
+"""Timing breakdown: phases are kept out of the locust statistics and merged from the workers"""
+import wmts
+from conftest import started_user
+from utils import timing
+
+
+def test_phases_are_not_counted_as_requests(mock_server):
+    server = mock_server()
+    user = started_user(wmts, wmts.WMTSBenchmark, server.wmts_url, "--timing-breakdown")
+    timing.phase_stats.clear_all()
+    for _ in range(12):
+        user.request_tile()
+
+    stats = user.environment.stats
+    assert stats.total.num_requests == 12
+    assert {method for _, method in stats.entries} == {"GET"}
+    phases = {method: entry.num_requests for (_, method), entry in timing.phase_stats.entries.items()}
+    assert phases[timing.TTFB] == phases[timing.DOWNLOAD] == 12
+    # keep-alive: a single connection for the user
+    assert phases[timing.CONNECT] == 1
+    assert timing.throughput_rows(timing.phase_stats)[0]["requests"] == 12
+
+
+def test_worker_phases_are_merged_by_the_master():
+    timing.phase_stats.clear_all()
+    for response_time in (10, 20, 30):
+        timing.phase_stats.log_request(timing.TTFB, "layer image/png", response_time, 0)
+    report = {}
+    timing.on_report_to_master("worker", report)
+    # the worker entries are reset once sent
+    assert timing.phase_stats.get("layer image/png", timing.TTFB).num_requests == 0
+    timing.on_worker_report("worker", report)
+    timing.on_worker_report("worker", report)
+
+    merged = timing.phase_stats.get("layer image/png", timing.TTFB)
+    assert merged.num_requests == 6 and merged.max_response_time == 30
@@ -0,0 +1,215 @@
+"""Open-loop, constant arrival rate, request scheduling
+
+In the default closed loop (`wait_time = between(1, 2)`) a slow server also
+slows down the offered load, hiding latency (coordinated omission). In open
+loop every simulated user sends requests on a fixed schedule (constant or
+Poisson arrivals) through a bounded pool of greenlets, and latency is measured
+from the intended send time, not from the moment the request was actually sent.
+
+Requests the client could not send on time are reported apart:
+- "late": dispatched after their intended send time, then sent. Their lag is
+  kept in `late_stats`, a locust RequestStats apart from the environment
+  statistics (the request itself is already counted there), and logged at
+  the end of the test. Workers send theirs to the master with their stats
+  reports.
+- "dropped": not sent because every slot of the pool stayed busy for longer
+  than max lag, an OPENLOOP failure of the locust statistics.
+"""
+from typing import Callable, Iterator, Optional
+import logging
+import random
+import time
+
+import gevent
+from gevent.pool import Pool
+from locust.stats import RequestStats, StatsEntry, calculate_response_time_percentile
+
+from utils import seeding
+
+logger = logging.getLogger(__name__)
+
+CONSTANT = "constant"
+POISSON = "poisson"
+ARRIVAL_PROCESSES = (CONSTANT, POISSON)
+
+# request_type of the dropped failures in locust statistics, and of the late entries
+REQUEST_TYPE = "OPENLOOP"
+# key of the late entries in the stats reports of the workers
+REPORT_KEY = "open_loop_late"
+
+# requests dispatched later than this (in seconds) are counted as late,
+# below it is gevent's scheduling noise
+LATE_THRESHOLD = 0.005
+
+
+# lag of the late requests of the process, and of the workers on the master
+late_stats = RequestStats(use_response_times_cache=False)
+
+
+class ClientOverloadError(Exception):
+    """Request not sent, the load generator could not keep up with the arrival rate."""
+
+    pass
+
+
+def arrival_times(
+    rate: float, process: str = CONSTANT, rng: Optional[random.Random] = None, start: Optional[float] = None
+) -> Iterator[float]:
+    """
+    Yield the intended send times (time.perf_counter() clock) of a request stream.
+
+    Parameters:
+    - rate (float): Requests per second.
+    - process (str): "constant" for a fixed interval, "poisson" for exponential intervals.
+    - rng (random.Random): Optional. Random number generator of the poisson intervals.
+    - start (float): Optional. Time of the first request, defaults to now plus a random
+      phase so the users of a process do not all send at the same instant.
+    """
+    if rate <= 0:
+        raise ValueError("Arrival rate must be greater than 0.")
+    if process not in ARRIVAL_PROCESSES:
+        raise ValueError(f"Unknown arrival process {process}, use one of {ARRIVAL_PROCESSES}")
+    rng = rng or random.Random()
+    interval = 1.0 / rate
+    intended = start if start is not None else time.perf_counter() + rng.uniform(0, interval)
+    while True:
+        yield intended
+        intended += interval if process == CONSTANT else rng.expovariate(rate)
+
+
+class OpenLoop:
+    """
+    Send requests of one simulated user on an arrival schedule.
+
+    Example:
+    open_loop = OpenLoop(environment, rate=2.0, max_concurrency=10, max_lag=1.0)
+    open_loop.run(send)  # send(intended) is spawned for every arrival, never returns
+    """
+
+    def __init__(
+        self,
+        environment,
+        rate: float,
+        process: str = CONSTANT,
+        max_concurrency: int = 10,
+        max_lag: float = 1.0,
+        rng: Optional[random.Random] = None,
+    ):
+        """
+        Parameters:
+        - environment: Locust environment, to report late and dropped requests.
+        - rate (float): Requests per second of this user.
+        - process (str): "constant" or "poisson" arrivals.
+        - max_concurrency (int): Maximum number of requests in flight of this user.
+        - max_lag (float): Seconds a request may wait for a free slot before being dropped.
+        - rng (random.Random): Optional. Random number generator of the arrivals.
+        """
+        self.environment = environment
+        self.schedule = arrival_times(rate, process, rng)
+        self.pool = Pool(max_concurrency)
+        self.max_lag = max_lag
+
+    def run(self, send: Callable[[float], None]):
+        """
+        Spawn `send(intended)` at each arrival, `intended` being the
+        time.perf_counter() value the request should have been sent at.
+        """
+        for intended in self.schedule:
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                gevent.sleep(delay)
+
+            if self.pool.full():
+                # wait for a slot, but not past the maximum lag
+                if not self.pool.wait_available(timeout=max(intended + self.max_lag - time.perf_counter(), 0)):
+                    self.report(
+                        "dropped",
+                        (time.perf_counter() - intended) * 1000,
+                        ClientOverloadError(f"no free slot within --max-lag {self.max_lag}s"),
+                    )
+                    continue
+
+            lag = time.perf_counter() - intended
+            if lag > LATE_THRESHOLD:
+                late_stats.log_request(REQUEST_TYPE, "late", lag * 1000, 0)
+            self.pool.spawn(send, intended)
+
+    def report(self, name: str, response_time: float, exception: Optional[Exception] = None):
+        """Add a dropped request to locust statistics"""
+        self.environment.events.request.fire(
+            request_type=REQUEST_TYPE,
+            name=name,
+            response_time=response_time,
+            response_length=0,
+            exception=exception,
+            context={},
+        )
+
+    def stop(self):
+        """Kill the requests in flight"""
+        self.pool.kill()
+
+
+def user_rate(environment, target_rps: float) -> float:
+    """
+    Requests per second of one simulated user, the target rate is split evenly
+    between all users of the test (-u or the web UI, across all workers, the
+    count of the master on workers).
+    In a capacity search the user count changes between steps, the target rate
+    is then the rate of each user.
+    """
+    if getattr(environment.parsed_options, "capacity_search", False):
+        return target_rps
+    return target_rps / max(seeding.test_user_count(environment), 1)
+
+
+def on_test_start(environment, **kwargs):
+    late_stats.clear_all()
+
+
+def on_report_to_master(client_id, data, **kwargs):
+    """Add the late entries since the last report to the stats report of a worker, they are reset"""
+    entries = late_stats.serialize_stats()
+    if entries:
+        data[REPORT_KEY] = entries
+
+
+def on_worker_report(client_id, data, **kwargs):
+    """Add the late entries of a worker to the late entries of the master"""
+    for entry_data in data.get(REPORT_KEY, []):
+        entry = StatsEntry.unserialize(entry_data)
+        late_stats.get(entry.name, entry.method).extend(entry)
+
+
+def register(environment):
+    """
+    On init: late entries are cleared on test start, workers send theirs to
+    the master (they only get --target-rps with the spawn message).
+    """
+    environment.events.test_start.add_listener(on_test_start)
+    runner_type = type(environment.runner).__name__
+    if runner_type == "WorkerRunner":
+        environment.events.report_to_master.add_listener(on_report_to_master)
+    elif runner_type == "MasterRunner":
+        environment.events.worker_report.add_listener(on_worker_report)
+
+
+def log_report(environment):
+    """
+    Log the late requests and their lag at the end of an open loop test, on
+    the master (or local) runner only.
+    """
+    options = environment.parsed_options
+    if not getattr(options, "target_rps", 0) or type(environment.runner).__name__ == "WorkerRunner":
+        return
+    late = late_stats.get("late", REQUEST_TYPE)
+    requests = environment.stats.total.num_requests
+    if not late.num_requests:
+        logger.info(f"Open loop: no late request of {requests}")
+        return
+    percentile = lambda fraction: calculate_response_time_percentile(late.response_times, late.num_requests, fraction)
+    logger.info(
+        f"Open loop: {late.num_requests} late requests of {requests} ({late.num_requests / max(requests, 1):.1%}), "
+        f"lag p50 {percentile(0.5)}ms p95 {percentile(0.95)}ms max {late.max_response_time:.0f}ms: "
+        "the load generator could not keep up with the arrival rate"
+    )
@@ -0,0 +1,188 @@
+"""Tile grid aligned WMS bboxes
+
+Random bboxes never line up with the grid of a WMS cache (MapProxy,
+GeoWebCache), every GetMap is then a full render. Tiled WMS clients (e.g. an
+OpenLayers TileWMS layer) request one grid cell per GetMap, with the image
+size of a tile, and can be answered from the cache. `GridBBoxes` yields such
+bboxes, the grid being a WMTS TileMatrix or an origin and a resolution.
+
+With a repeat probability, the next bbox is one of the recently requested
+cells of the user instead of a new one, which sets the expected cache hit
+rate of the test.
+"""
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+import math
+import random
+
+from utils.crs import crs_info
+
+# OGC standardized rendering pixel size (0.28mm)
+PIXEL_SIZE = 0.00028
+
+# OGC WMTS: metres of one degree, for the scale denominators of geographic TileMatrixSets
+METERS_PER_DEGREE = 6378137 * 2 * math.pi / 360
+
+
+class BBoxGridError(ValueError):
+    """Custom exception for invalid bbox grids."""
+
+    pass
+
+
+class BBoxGrid(NamedTuple):
+    """
+    Grid of tiles, cell (0, 0) is the top left one (WMTS order).
+    x is the longitude in geographic CRS.
+    """
+
+    left: float
+    top: float
+    span_x: float
+    span_y: float
+    # image size of a cell
+    tile_width: int
+    tile_height: int
+
+    def cell(self, x: float, y: float) -> Tuple[int, int]:
+        """(col, row) of the cell containing the point"""
+        return math.floor((x - self.left) / self.span_x), math.floor((self.top - y) / self.span_y)
+
+    def bbox(self, col: int, row: int) -> Tuple[float, float, float, float]:
+        """(minx, miny, maxx, maxy) of a cell"""
+        minx = self.left + col * self.span_x
+        maxy = self.top - row * self.span_y
+        return minx, maxy - self.span_y, minx + self.span_x, maxy
+
+    def cell_range(self, extent: Tuple[float, float, float, float]) -> Tuple[int, int, int, int]:
+        """(min_col, max_col, min_row, max_row) of the cells intersecting the extent"""
+        minx, miny, maxx, maxy = extent
+        min_col, min_row = self.cell(minx, maxy)
+        max_col = math.ceil((maxx - self.left) / self.span_x) - 1
+        max_row = math.ceil((self.top - miny) / self.span_y) - 1
+        return min_col, max(max_col, min_col), min_row, max(max_row, min_row)
+
+
+def parse_bbox_grid(spec: str, tile_width: int = 256, tile_height: int = 256) -> BBoxGrid:
+    """
+    Grid of a "LEFT,TOP,RESOLUTION" spec: top left corner and CRS units per pixel.
+    """
+    try:
+        left, top, resolution = (float(value) for value in spec.split(","))
+    except ValueError:
+        raise BBoxGridError(f"Bbox grid must be LEFT,TOP,RESOLUTION, got {spec!r}")
+    if resolution <= 0:
+        raise BBoxGridError(f"Bbox grid resolution must be greater than 0, got {spec!r}")
+    return BBoxGrid(left, top, resolution * tile_width, resolution * tile_height, tile_width, tile_height)
+
+
+def tile_matrix_grid(tile_matrix, crs: Optional[str] = None) -> BBoxGrid:
+    """
+    Grid of an owslib WMTS TileMatrix.
+
+    Parameters:
+    - tile_matrix: owslib TileMatrix.
+    - crs (str): Optional. CRS of the TileMatrixSet, for the units and axis order
+      of geographic TileMatrixSets.
+    """
+    info = crs_info(crs)
+    left, top = tile_matrix.topleftcorner[:2]
+    resolution = tile_matrix.scaledenominator * PIXEL_SIZE
+    if info.geographic:
+        resolution /= METERS_PER_DEGREE
+        if info.lat_first:
+            left, top = top, left
+    else:
+        resolution /= info.meters_per_unit
+    return BBoxGrid(
+        left,
+        top,
+        resolution * tile_matrix.tilewidth,
+        resolution * tile_matrix.tileheight,
+        tile_matrix.tilewidth,
+        tile_matrix.tileheight,
+    )
+
+
+class GridBBoxes:
+    """
+    Grid cell bboxes within an extent, new cells are drawn uniformly (or
+    contain the given centers, e.g. hotspots) and, with `repeat_probability`,
+    a bbox is one of the last `window` new cells instead.
+
+    Example:
+    bboxes = GridBBoxes(grid, extent, rng, repeat_probability=0.8)
+    bbox = next(bboxes)
+    bboxes.repeated  # True when bbox was requested before by this user
+    """
+
+    def __init__(
+        self,
+        grid: BBoxGrid,
+        extent: Tuple[float, float, float, float],
+        rng: Optional[random.Random] = None,
+        repeat_probability: float = 0.0,
+        window: int = 1000,
+        centers: Optional[Iterator[Tuple[float, float]]] = None,
+    ):
+        """
+        Parameters:
+        - grid (BBoxGrid): The cache grid.
+        - extent (tuple): (minx, miny, maxx, maxy) of the layer, new cells intersect it.
+        - rng (random.Random): Optional. Random number generator of the user.
+        - repeat_probability (float): Probability of requesting again a previous cell.
+        - window (int): Number of recent new cells a repeat is drawn from.
+        - centers (iterator): Optional. (x, y) points whose cells are the new cells.
+        """
+        if not 0.0 <= repeat_probability <= 1.0:
+            raise BBoxGridError(f"Repeat probability must be between 0 and 1, got {repeat_probability}")
+        if window < 1:
+            raise BBoxGridError(f"Repeat window must be at least 1, got {window}")
+        self.grid = grid
+        self.range = grid.cell_range(extent)
+        self.rng = rng or random.Random()
+        self.repeat_probability = repeat_probability
+        self.window = window
+        self.centers = centers
+        # ring buffer of the last new cells
+        self.history: List[Tuple[int, int]] = []
+        self.position = 0
+        self.repeated = False
+
+    def __iter__(self) -> Iterator[Tuple[float, float, float, float]]:
+        return self
+
+    def __next__(self) -> Tuple[float, float, float, float]:
+        if self.history and self.rng.random() < self.repeat_probability:
+            self.repeated = True
+            return self.grid.bbox(*self.history[self.rng.randrange(len(self.history))])
+
+        self.repeated = False
+        min_col, max_col, min_row, max_row = self.range
+        if self.centers is not None:
+            col, row = self.grid.cell(*next(self.centers))
+            cell = (min(max(col, min_col), max_col), min(max(row, min_row), max_row))
+        else:
+            cell = (self.rng.randint(min_col, max_col), self.rng.randint(min_row, max_row))
+        if len(self.history) < self.window:
+            self.history.append(cell)
+        else:
+            self.history[self.position] = cell
+            self.position = (self.position + 1) % self.window
+        return self.grid.bbox(*cell)
+
+
+# Example of class usage
+if __name__ == "__main__":
+    grid = parse_bbox_grid("-144205.734375,276083.78125,10", 256, 256)
+    minx, miny, maxx, maxy = grid.bbox(12, 34)
+    assert grid.cell((minx + maxx) / 2, (miny + maxy) / 2) == (12, 34) and maxx - minx == 2560
+    extent = (-144205.734375, -326024.8125, 162129.09375, 276083.78125)
+    bboxes = GridBBoxes(grid, extent, random.Random(1640), repeat_probability=0.75, window=50)
+    repeats = 0
+    for _ in range(10000):
+        minx, miny, maxx, maxy = next(bboxes)
+        col, row = grid.cell(minx + 1, maxy - 1)
+        assert grid.bbox(col, row) == (minx, miny, maxx, maxy)
+        repeats += bboxes.repeated
+    assert abs(repeats / 10000 - 0.75) < 0.02, repeats
+    print(f"cells {bboxes.range}, {repeats / 100:.1f}% repeated")
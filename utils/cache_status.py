@@ -0,0 +1,209 @@
+"""Cache HIT/MISS classification from response headers
+
+MapProxy, GeoWebCache and the caching proxies in front of them tell in the
+response headers whether a tile or map came from the cache:
+
+- `X-Cache: HIT from proxy`, `X-Cache-Status: MISS` (nginx), `CF-Cache-Status`;
+- `geowebcache-cache-result: HIT` (MISS, or WMS for requests passed through);
+- `Age: 120`, the seconds a response spent in a proxy cache (0 is not cached).
+
+Each response is tagged HIT, MISS or UNKNOWN from the first configured header
+found, the tag is appended to the request name in locust statistics (e.g.
+"GetMap HIT"), so hits and misses get their own latency percentiles. As the
+tag is part of the name, statistics aggregated by the master of a distributed
+test include it too, `CacheRatioReporter` reads the hit ratio over time from them.
+"""
+from typing import Dict, Iterable, List, Optional, Sequence
+import logging
+import re
+import time
+
+from utils import reporting
+
+logger = logging.getLogger(__name__)
+
+HIT = "HIT"
+MISS = "MISS"
+UNKNOWN = "UNKNOWN"
+CACHE_STATUSES = (HIT, MISS, UNKNOWN)
+
+# headers inspected by default, in order
+DEFAULT_HEADERS = ("X-Cache", "geowebcache-cache-result", "X-Cache-Status", "CF-Cache-Status", "Age")
+DEFAULT_HIT_VALUES = ("HIT", "STALE", "UPDATING", "REVALIDATED")
+DEFAULT_MISS_VALUES = ("MISS", "EXPIRED", "BYPASS", "DYNAMIC", "WMS")
+
+
+class CacheClassifier:
+    """
+    Tag responses as HIT, MISS or UNKNOWN from their headers.
+
+    Example:
+    classifier = CacheClassifier()
+    classifier.classify({"X-Cache": "HIT from mapproxy"}, 200)  # "HIT"
+    """
+
+    def __init__(
+        self,
+        headers: Sequence[str] = DEFAULT_HEADERS,
+        hit_values: Iterable[str] = DEFAULT_HIT_VALUES,
+        miss_values: Iterable[str] = DEFAULT_MISS_VALUES,
+    ):
+        """
+        Parameters:
+        - headers (list of str): Header names inspected in order, the first one found decides.
+          `Age` is numeric, a positive age is a hit.
+        - hit_values, miss_values (list of str): Words of the header values (case insensitive)
+          meaning a hit or a miss, e.g. "HIT" matches "HIT from proxy".
+        """
+        self.headers = list(headers)
+        self.hit_values = {value.upper() for value in hit_values}
+        self.miss_values = {value.upper() for value in miss_values}
+
+    def classify(self, headers, status_code: int = 200) -> str:
+        """
+        Cache status of a response.
+
+        Parameters:
+        - headers: Dict like response headers, case insensitive (None for connection errors).
+        - status_code (int): HTTP status, a 304 Not Modified is a hit.
+        """
+        if status_code == 304:
+            return HIT
+        if not headers:
+            return UNKNOWN
+        for name in self.headers:
+            value = headers.get(name)
+            if value is None:
+                continue
+            if name.lower() == "age":
+                try:
+                    return HIT if float(value) > 0 else MISS
+                except ValueError:
+                    continue
+            words = set(re.findall(r"[A-Za-z]+", value.upper()))
+            if words & self.hit_values:
+                return HIT
+            if words & self.miss_values:
+                return MISS
+        return UNKNOWN
+
+
+def classifier_from_options(parsed_options) -> Optional[CacheClassifier]:
+    """CacheClassifier of the --cache-* options, None when --cache-status is not set"""
+    if not getattr(parsed_options, "cache_status", False):
+        return None
+
+    def values(option: str, default: Sequence[str]) -> List[str]:
+        value = getattr(parsed_options, option, None)
+        return [item.strip() for item in value.split(",") if item.strip()] if value else list(default)
+
+    return CacheClassifier(
+        values("cache_headers", DEFAULT_HEADERS),
+        values("cache_hit_values", DEFAULT_HIT_VALUES),
+        values("cache_miss_values", DEFAULT_MISS_VALUES),
+    )
+
+
+def tag_response(response, classifier: CacheClassifier, name: str) -> str:
+    """
+    Append the cache status of a catch_response=True response to its name in
+    locust statistics, before the `with` block exits. Returns the status.
+    """
+    status = classifier.classify(response.headers, response.status_code)
+    response.request_meta["name"] = f"{name} {status}"
+    return status
+
+
+def cache_counts(stats, request_type: str = "GET") -> Dict[str, int]:
+    """Number of requests of each cache status in locust RequestStats"""
+    counts = dict.fromkeys(CACHE_STATUSES, 0)
+    for (name, method), entry in stats.entries.items():
+        if method != request_type:
+            continue
+        status = name.rsplit(" ", 1)[-1]
+        if status in counts:
+            counts[status] += entry.num_requests
+    return counts
+
+
+def hit_ratio(counts: Dict[str, int]) -> Optional[float]:
+    """Hits over hits and misses, None without classified requests"""
+    classified = counts[HIT] + counts[MISS]
+    return counts[HIT] / classified if classified else None
+
+
+class CacheRatioReporter(reporting.PeriodicReporter):
+    """
+    Log (and write to a CSV file) the cache hit ratio of every interval and of
+    the whole test, from the HIT/MISS/UNKNOWN tagged statistics.
+
+    Example:
+    reporter = CacheRatioReporter(environment, interval=10, output="cache.csv")
+    reporter.start()
+    ...
+    reporter.stop()
+    """
+
+    title = "Cache hit ratio report"
+
+    def __init__(self, environment, interval: float = 10.0, output: Optional[str] = None):
+        """
+        Parameters:
+        - environment: Locust environment, of the master in a distributed test.
+        - interval (float): Seconds between two reports.
+        - output (str): Optional. CSV file of the reports.
+        """
+        super().__init__(environment, interval, output)
+        self.previous = dict.fromkeys(CACHE_STATUSES, 0)
+
+    def report(self):
+        """Add the counts since the previous report"""
+        counts = cache_counts(self.environment.stats)
+        interval = {status: counts[status] - self.previous[status] for status in CACHE_STATUSES}
+        self.previous = counts
+        ratio, total_ratio = hit_ratio(interval), hit_ratio(counts)
+        self.rows.append(
+            {
+                "timestamp": round(time.time(), 3),
+                "hits": interval[HIT],
+                "misses": interval[MISS],
+                "unknown": interval[UNKNOWN],
+                "hit_ratio": "" if ratio is None else round(ratio, 4),
+                "total_hit_ratio": "" if total_ratio is None else round(total_ratio, 4),
+            }
+        )
+        if ratio is not None:
+            logger.info(
+                f"Cache hit ratio {ratio:.1%} (last {interval[HIT] + interval[MISS]} requests), "
+                f"{total_ratio:.1%} since the start, {counts[UNKNOWN]} unknown"
+            )
+        elif interval[UNKNOWN]:
+            logger.info(f"Cache status unknown for {interval[UNKNOWN]} requests, check --cache-headers")
+
+
+def start_reporter(environment):
+    """
+    Start the hit ratio reports of a test with --cache-status, on the master
+    (or local) runner only, workers have no aggregated statistics.
+    """
+    options = environment.parsed_options
+    if not getattr(options, "cache_status", False) or type(environment.runner).__name__ == "WorkerRunner":
+        return
+    reporting.start(CacheRatioReporter(environment, options.cache_report_interval, options.cache_report_output))
+
+
+def stop_reporter():
+    """Stop the hit ratio reports, the last report covers the end of the test"""
+    reporting.stop(CacheRatioReporter)
+
+
+# Example of class usage
+if __name__ == "__main__":
+    classifier = CacheClassifier()
+    assert classifier.classify({"X-Cache": "HIT from mapproxy"}) == HIT
+    assert classifier.classify({"geowebcache-cache-result": "MISS"}) == MISS
+    assert classifier.classify({"geowebcache-cache-result": "WMS"}) == MISS
+    assert classifier.classify({"Age": "12"}) == HIT and classifier.classify({"Age": "0"}) == MISS
+    assert classifier.classify({"Content-Type": "image/png"}) == UNKNOWN
+    assert classifier.classify(None, 0) == UNKNOWN and classifier.classify({}, 304) == HIT
+    assert hit_ratio({HIT: 3, MISS: 1, UNKNOWN: 5}) == 0.75
@@ -0,0 +1,270 @@
+"""GetCapabilities loading shared by all simulated users of a process
+
+The capabilities document is downloaded and parsed once per process (and
+service url), optionally re-using an on-disk cache validated with the
+ETag/Last-Modified headers sent by the server, or read from a local XML file.
+The users of one layer only parse that layer (load_layer_capabilities).
+"""
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import json
+import logging
+import os
+import threading
+
+import requests
+from owslib.util import clean_ows_url
+from owslib.map.common import WMSCapabilitiesReader
+from owslib.wms import WebMapService
+from owslib.wmts import WMTSCapabilitiesReader, WebMapTileService
+
+from utils.capabilities_reader import document_version, read_wms_layer, read_wmts_layer
+
+logger = logging.getLogger(__name__)
+
+# Version used by owslib's WebMapService factory when none is given
+WMS_CAPABILITIES_VERSION = "1.1.1"
+# WMS versions parsed by owslib, other documents are parsed as WMS_CAPABILITIES_VERSION
+WMS_VERSIONS = ("1.1.1", "1.3.0")
+WMTS_CAPABILITIES_VERSION = "1.0.0"
+
+# parsed owslib objects, key is (service, url)
+_capabilities: Dict[Tuple[str, str], object] = {}
+# single layer capabilities of the streaming readers, key is (service, url, layer, tile matrix set)
+_layer_capabilities: Dict[Tuple[str, str, str, str], object] = {}
+# XML documents, sent by the master to the workers of a distributed test
+_documents: Dict[Tuple[str, str], bytes] = {}
+# threading is monkey patched by locust, so this lock only blocks the greenlet
+_lock = threading.Lock()
+
+
+class CapabilitiesError(Exception):
+    """Custom exception for GetCapabilities download and parsing errors."""
+
+    pass
+
+
+def capabilities_url(service: str, url: str) -> str:
+    """
+    Build the GetCapabilities url the same way owslib does for `url`.
+
+    Parameters:
+    - service (str): "WMS" or "WMTS".
+    - url (str): Service url as given on --host.
+    """
+    if service == "WMS":
+        reader = WMSCapabilitiesReader(WMS_CAPABILITIES_VERSION)
+    elif service == "WMTS":
+        reader = WMTSCapabilitiesReader(WMTS_CAPABILITIES_VERSION)
+    else:
+        raise CapabilitiesError(f"Unknown service type {service}")
+    return reader.capabilities_url(clean_ows_url(url))
+
+
+def _cache_paths(cache_dir: str, request_url: str) -> Tuple[str, str]:
+    """Paths of the XML document and of its HTTP validators in cache_dir"""
+    key = hashlib.sha1(request_url.encode("utf-8")).hexdigest()
+    return (
+        os.path.join(cache_dir, f"{key}.xml"),
+        os.path.join(cache_dir, f"{key}.json"),
+    )
+
+
+def fetch_capabilities_xml(
+    service: str, url: str, cache_dir: Optional[str] = None, timeout: int = 30
+) -> bytes:
+    """
+    Download the GetCapabilities document of a service.
+
+    When `cache_dir` is set the document is stored there, keyed by the
+    GetCapabilities url, together with the server's ETag and Last-Modified
+    headers. Next downloads are conditional requests and a `304 Not Modified`
+    answer re-uses the cached document.
+
+    Parameters:
+    - service (str): "WMS" or "WMTS".
+    - url (str): Service url as given on --host.
+    - cache_dir (str): Optional. Directory of the on-disk cache.
+    - timeout (int): Request timeout in seconds.
+
+    Returns:
+    - The raw XML document as bytes.
+    """
+    request_url = capabilities_url(service, url)
+    headers = {}
+    cached_xml = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        xml_path, meta_path = _cache_paths(cache_dir, request_url)
+        if os.path.exists(xml_path) and os.path.exists(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as meta_file:
+                meta = json.load(meta_file)
+            if meta.get("etag"):
+                headers["If-None-Match"] = meta["etag"]
+            if meta.get("last_modified"):
+                headers["If-Modified-Since"] = meta["last_modified"]
+            with open(xml_path, "rb") as xml_file:
+                cached_xml = xml_file.read()
+
+    try:
+        response = requests.get(request_url, headers=headers, timeout=timeout)
+    except requests.RequestException as e:
+        if cached_xml is not None:
+            logger.warning(f"GetCapabilities request failed ({e}), using cached document")
+            return cached_xml
+        raise CapabilitiesError(f"GetCapabilities request to {request_url} failed: {e}")
+
+    if response.status_code == 304 and cached_xml is not None:
+        logger.info(f"GetCapabilities not modified, using cached document for {request_url}")
+        return cached_xml
+    if response.status_code != 200:
+        raise CapabilitiesError(
+            f"GetCapabilities request to {request_url} returned HTTP {response.status_code}"
+        )
+
+    xml = response.content
+    if cache_dir:
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        # without validators the cached copy could never be revalidated
+        if etag or last_modified:
+            with open(xml_path, "wb") as xml_file:
+                xml_file.write(xml)
+            with open(meta_path, "w", encoding="utf-8") as meta_file:
+                json.dump(
+                    {"url": request_url, "etag": etag, "last_modified": last_modified},
+                    meta_file,
+                )
+    logger.info(f"GetCapabilities downloaded from {request_url} ({len(xml)} bytes)")
+    return xml
+
+
+def _read_document(service: str, url: str, capabilities_file: Optional[str], cache_dir: Optional[str]) -> bytes:
+    """XML document of a service, read or downloaded once per process, the lock must be held"""
+    key = (service, url)
+    if key not in _documents:
+        if capabilities_file:
+            logger.info(f"Reading GetCapabilities from file {capabilities_file}")
+            with open(capabilities_file, "rb") as xml_file:
+                _documents[key] = xml_file.read()
+        else:
+            _documents[key] = fetch_capabilities_xml(service, url, cache_dir=cache_dir)
+    return _documents[key]
+
+
+def _parse(service: str, url: str, xml: bytes):
+    """
+    owslib object of the whole document, parsed once per process, the lock
+    must be held. WMS documents are parsed with the version of their root
+    element, owslib would read a 1.3.0 document as 1.1.1.
+    """
+    key = (service, url)
+    if key not in _capabilities:
+        if service == "WMS":
+            version = document_version(xml)
+            if version not in WMS_VERSIONS:
+                version = WMS_CAPABILITIES_VERSION
+            _capabilities[key] = WebMapService(url, version=version, xml=xml)
+        else:
+            _capabilities[key] = WebMapTileService(url, xml=xml)
+    return _capabilities[key]
+
+
+def load_capabilities(
+    service: str,
+    url: str,
+    capabilities_file: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+):
+    """
+    Return the parsed owslib capabilities object of a service, parsing it only
+    once per process.
+
+    Parameters:
+    - service (str): "WMS" or "WMTS".
+    - url (str): Service url as given on --host.
+    - capabilities_file (str): Optional. Local XML file used instead of a download.
+    - cache_dir (str): Optional. Directory of the on-disk GetCapabilities cache.
+
+    Returns:
+    - owslib WebMapService or WebMapTileService object.
+    """
+    with _lock:
+        return _parse(service, url, _read_document(service, url, capabilities_file, cache_dir))
+
+
+def load_layer_capabilities(
+    service: str,
+    url: str,
+    layer: Optional[str] = None,
+    tile_matrix_set: Optional[str] = None,
+    capabilities_file: Optional[str] = None,
+    cache_dir: Optional[str] = None,
+):
+    """
+    Return the capabilities of one layer of a service, read once per process
+    (and layer) by the streaming readers of utils.capabilities_reader: only the
+    layer, its bounding boxes and formats and the TileMatrixSet it uses are
+    parsed. The whole document is parsed by owslib when the layer can not be
+    read this way, e.g. when it does not exist, so the error lists every layer.
+
+    Parameters:
+    - service (str): "WMS" or "WMTS".
+    - url (str): Service url as given on --host.
+    - layer (str): Optional. Layer name, the first layer when not set.
+    - tile_matrix_set (str): Optional. WMTS TileMatrixSet, the first one of the layer when not set.
+    - capabilities_file (str): Optional. Local XML file used instead of a download.
+    - cache_dir (str): Optional. Directory of the on-disk GetCapabilities cache.
+
+    Returns:
+    - LayerCapabilities, or an owslib WebMapService or WebMapTileService object.
+    """
+    key = (service, url, layer or "", tile_matrix_set or "")
+    with _lock:
+        if (service, url) in _capabilities:
+            return _capabilities[(service, url)]
+        if key not in _layer_capabilities:
+            xml = _read_document(service, url, capabilities_file, cache_dir)
+            if service == "WMS":
+                capabilities = read_wms_layer(xml, url, layer)
+            else:
+                capabilities = read_wmts_layer(xml, url, layer, tile_matrix_set)
+            if capabilities is None:
+                logger.info(f"Layer {layer or '(first)'} not found by the streaming reader, parsing the whole {service} capabilities")
+                capabilities = _parse(service, url, xml)
+            _layer_capabilities[key] = capabilities
+        return _layer_capabilities[key]
+
+
+def register_capabilities(service: str, url: str, xml: bytes):
+    """
+    Keep a capabilities document received from elsewhere (the master of a
+    distributed test), next loads of the service url read it instead of a
+    download.
+    """
+    with _lock:
+        _documents.setdefault((service, url), xml)
+
+
+def capabilities_documents() -> List[Dict]:
+    """Service, url and XML document of every capabilities document read in the process"""
+    with _lock:
+        return [{"service": service, "url": url, "xml": xml} for (service, url), xml in _documents.items()]
+
+
+def clear_capabilities():
+    """Forget every parsed capabilities document of the process"""
+    with _lock:
+        _capabilities.clear()
+        _layer_capabilities.clear()
+        _documents.clear()
+
+
+def add_arguments(parser):
+    """Add the GetCapabilities cache option to the locust command line parser"""
+    parser.add_argument(
+        "--capabilities-cache-dir",
+        type=str,
+        default=None,
+        help="Directory to cache GetCapabilities documents (revalidated with ETag/Last-Modified), to be reused between runs and workers",
+    )
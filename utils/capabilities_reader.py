@@ -0,0 +1,351 @@
+"""Streaming GetCapabilities reader of a single layer
+
+Some services advertise thousands of layers and TileMatrixSets with dozens of
+levels. owslib's WebMapService/WebMapTileService build the object model of
+the whole document, which takes seconds and hundreds of MB per process,
+while a benchmark uses one layer.
+
+These readers walk the document with `iterparse`, keep only the elements of
+the selected layer (with its ancestors for the inherited WMS properties),
+the service identification and operations and the TileMatrixSet referenced
+by the layer, and stop as soon as they have them. The other elements are
+dropped as soon as they are read. The kept elements are parsed by owslib
+itself, so the layer objects are the same as the ones of a full parse.
+
+They return None when the document can not be read this way (unknown
+version, ServiceExceptionReport, layer not found): the caller then falls back
+to owslib (utils.capabilities.load_layer_capabilities).
+
+Benchmark on a synthetic document:
+python -m utils.capabilities_reader --layers 5000
+"""
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+import copy
+import io
+import multiprocessing
+import os
+import time
+
+from lxml import etree
+from owslib.map import wms111, wms130
+from owslib import wmts as owslib_wmts
+
+WMS_ROOT_TAG = "WMT_MS_Capabilities"
+WMS_130_NS = "{" + wms130.WMS_NAMESPACE + "}"
+# owslib module, element namespace and version of each WMS root element
+WMS_VERSIONS = {
+    WMS_ROOT_TAG: (wms111, "", "1.1.1"),
+    WMS_130_NS + "WMS_Capabilities": (wms130, WMS_130_NS, "1.3.0"),
+}
+# elements returned by the streaming WMS reader, of both versions
+WMS_TAGS = tuple(ns + tag for ns in ("", WMS_130_NS) for tag in ("Service", "Request", "Name", "Layer"))
+WMTS_ROOT_TAG = owslib_wmts._WMTS_NS + "Capabilities"
+
+
+class LayerCapabilities:
+    """
+    The parts of an owslib WebMapService/WebMapTileService used by the
+    benchmark, for one layer: `contents` holds the selected layer only.
+    """
+
+    def __init__(self, url: str, version: str, identification, operations: List, contents: Dict, tilematrixsets=None):
+        self.url = url
+        self.version = version
+        self.identification = identification
+        self.operations = operations
+        self.contents = contents
+        self.tilematrixsets = tilematrixsets if tilematrixsets is not None else {}
+
+    def getOperationByName(self, name: str):
+        """Return a named operation item, as owslib does"""
+        for item in self.operations:
+            if item.name == name:
+                return item
+        raise KeyError(f"No operation named {name}")
+
+
+def _drop(elem):
+    """Free an element that is not needed, and its place in its parent"""
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        parent.remove(elem)
+
+
+def _without_layers(elem):
+    """Copy of a layer element without its child layers, their parent properties only"""
+    stripped = etree.Element(elem.tag, dict(elem.attrib))
+    stripped.extend(copy.deepcopy(child) for child in elem if child.tag != elem.tag)
+    return stripped
+
+
+def document_version(xml: bytes) -> Optional[str]:
+    """Version attribute of the root element of a GetCapabilities document, the rest is not parsed"""
+    for _, root in etree.iterparse(io.BytesIO(xml), events=("start",)):
+        return root.get("version")
+    return None
+
+
+def read_wms_layer(xml: bytes, url: str, layer_name: Optional[str] = None) -> Optional[LayerCapabilities]:
+    """
+    Read one layer of a WMS 1.1.x or 1.3.0 GetCapabilities document.
+
+    Parameters:
+    - xml (bytes): GetCapabilities document.
+    - url (str): Service url.
+    - layer_name (str): Optional. Name of the layer, the first named layer when not set (as owslib's contents).
+
+    Returns:
+    - LayerCapabilities, None when the layer is not found or the document is not WMS 1.1.x or 1.3.0.
+    """
+    identification = None
+    operations: List = []
+    # the layer selected by its name, the names come before the child layers
+    selected = None
+    # only the elements of these tags are returned, the parser builds the others without Python calls
+    context = etree.iterparse(io.BytesIO(xml), events=("end",), tag=WMS_TAGS)
+    root = None
+    for _, elem in context:
+        if root is None:
+            root = elem.getroottree().getroot()
+            if root.tag not in WMS_VERSIONS:
+                return None
+            wms, ns, version = WMS_VERSIONS[root.tag]
+            version = root.get("version", version)
+        parent = elem.getparent()
+        if elem.tag == ns + "Service":
+            identification = wms.ServiceIdentification(elem, version)
+        elif elem.tag == ns + "Request":
+            operations = [wms.OperationMetadata(operation) for operation in elem]
+        elif elem.tag == ns + "Name":
+            if selected is None and parent.tag == ns + "Layer" and (not layer_name or (elem.text or "").strip() == layer_name):
+                selected = parent
+        elif elem is selected:
+            # inherited properties come before the child layers, the ancestors have them already
+            ancestors = []
+            while parent.tag == ns + "Layer":
+                ancestors.insert(0, parent)
+                parent = parent.getparent()
+            metadata = None
+            for ancestor in ancestors:
+                metadata = wms.ContentMetadata(_without_layers(ancestor), parent=metadata, index=1)
+            layer = wms.ContentMetadata(elem, parent=metadata, index=1)
+            return LayerCapabilities(url, version, identification, operations, OrderedDict([(layer.name, layer)]))
+        elif selected is None:
+            _drop(elem)
+    return None
+
+
+def read_wmts_layer(
+    xml: bytes, url: str, layer_name: Optional[str] = None, tile_matrix_set: Optional[str] = None
+) -> Optional[LayerCapabilities]:
+    """
+    Read one layer of a WMTS 1.0.0 GetCapabilities document and its TileMatrixSet.
+
+    Parameters:
+    - xml (bytes): GetCapabilities document.
+    - url (str): Service url.
+    - layer_name (str): Optional. Identifier of the layer, the first layer when not set.
+    - tile_matrix_set (str): Optional. TileMatrixSet, the first one linked to the layer when not set.
+
+    Returns:
+    - LayerCapabilities, None when the layer or its TileMatrixSet is not found or the document is not WMTS 1.0.0.
+    """
+    identification = None
+    operations: List = []
+    layer = None
+    # identifiers of the TileMatrixSets to keep, known once the layer is read
+    wanted: List[str] = []
+    tilematrixsets: Dict = {}
+    tags = (
+        owslib_wmts._SERVICE_IDENTIFICATION_TAG,
+        owslib_wmts._OPERATIONS_METADATA_TAG,
+        owslib_wmts._LAYER_TAG,
+        owslib_wmts._TILE_MATRIX_SET_TAG,
+    )
+    context = etree.iterparse(io.BytesIO(xml), events=("end",), tag=tags)
+    root = None
+    for _, elem in context:
+        if root is None:
+            root = elem.getroottree().getroot()
+            if root.tag != WMTS_ROOT_TAG:
+                return None
+        if elem.tag == owslib_wmts._SERVICE_IDENTIFICATION_TAG:
+            identification = owslib_wmts.ServiceIdentification(elem)
+        elif elem.tag == owslib_wmts._OPERATIONS_METADATA_TAG:
+            operations = [owslib_wmts.OperationsMetadata(operation) for operation in elem]
+        elif elem.tag == owslib_wmts._LAYER_TAG:
+            identifier = (elem.findtext(owslib_wmts._IDENTIFIER_TAG) or "").strip()
+            if layer is None and (not layer_name or identifier == layer_name):
+                layer = owslib_wmts.ContentMetadata(elem)
+                links = list(layer.tilematrixsetlinks)
+                if tile_matrix_set:
+                    wanted = [tile_matrix_set] if tile_matrix_set in links else []
+                else:
+                    wanted = links[:1]
+                if not wanted:
+                    break
+            _drop(elem)
+        elif elem.getparent().tag == owslib_wmts._CONTENTS_TAG:
+            # a TileMatrixSet of the contents, not the one of a TileMatrixSetLink
+            identifier = (elem.findtext(owslib_wmts._IDENTIFIER_TAG) or "").strip()
+            if identifier in wanted:
+                tilematrixsets[identifier] = owslib_wmts.TileMatrixSet(elem)
+                if len(tilematrixsets) == len(wanted):
+                    break
+            _drop(elem)
+    if layer is None or len(tilematrixsets) < len(wanted):
+        return None
+    version = root.get("version", "1.0.0")
+    return LayerCapabilities(url, version, identification, operations, {layer.name: layer}, tilematrixsets)
+
+
+def synthetic_wms(layers: int, crs_count: int = 20) -> bytes:
+    """WMS 1.1.1 GetCapabilities of `layers` layers in a root layer, with many CRS, bboxes and styles"""
+    crs = "".join(f"<SRS>EPSG:{3000 + index}</SRS>" for index in range(crs_count))
+    body = []
+    for index in range(layers):
+        bboxes = "".join(
+            f'<BoundingBox SRS="EPSG:{3000 + code}" minx="{-index}" miny="-100" maxx="{index + 1}" maxy="100"/>'
+            for code in range(5)
+        )
+        body.append(
+            f"<Layer queryable=\"1\"><Name>layer{index}</Name><Title>Layer {index}</Title><Abstract>Synthetic layer {index}</Abstract>"
+            f"<KeywordList><Keyword>synthetic</Keyword><Keyword>layer{index}</Keyword></KeywordList>{crs}"
+            f'<LatLonBoundingBox minx="-9.5" miny="37" maxx="-6.2" maxy="42.1"/>{bboxes}'
+            f"<Style><Name>default</Name><Title>Default</Title><LegendURL width=\"20\" height=\"20\"><Format>image/png</Format>"
+            f'<OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="http://example.com/legend/{index}.png"/></LegendURL></Style></Layer>'
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><WMT_MS_Capabilities version="1.1.1">'
+        "<Service><Name>OGC:WMS</Name><Title>Synthetic WMS</Title></Service><Capability><Request>"
+        "<GetMap><Format>image/png</Format><Format>image/jpeg</Format><DCPType><HTTP><Get>"
+        '<OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="http://example.com/wms?"/>'
+        "</Get></HTTP></DCPType></GetMap></Request>"
+        f"<Layer><Title>Root</Title>{crs}<LatLonBoundingBox minx=\"-10\" miny=\"36\" maxx=\"-6\" maxy=\"43\"/>"
+        + "".join(body)
+        + "</Layer></Capability></WMT_MS_Capabilities>"
+    ).encode("utf-8")
+
+
+def synthetic_wmts(layers: int, tile_matrix_sets: int = 50, levels: int = 20) -> bytes:
+    """WMTS 1.0.0 GetCapabilities of `layers` layers, each linked to one of the TileMatrixSets"""
+    body = []
+    for index in range(layers):
+        limits = "".join(
+            f"<TileMatrixLimits><TileMatrix>{level:02d}</TileMatrix><MinTileRow>0</MinTileRow><MaxTileRow>{2 ** level}</MaxTileRow>"
+            f"<MinTileCol>0</MinTileCol><MaxTileCol>{2 ** level}</MaxTileCol></TileMatrixLimits>"
+            for level in range(levels)
+        )
+        body.append(
+            f"<Layer><ows:Title>Layer {index}</ows:Title><ows:WGS84BoundingBox><ows:LowerCorner>-9.5 37</ows:LowerCorner>"
+            f"<ows:UpperCorner>-6.2 42.1</ows:UpperCorner></ows:WGS84BoundingBox><ows:Identifier>layer{index}</ows:Identifier>"
+            f'<Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style><Format>image/png</Format>'
+            f"<TileMatrixSetLink><TileMatrixSet>tms{index % tile_matrix_sets}</TileMatrixSet>"
+            f"<TileMatrixSetLimits>{limits}</TileMatrixSetLimits></TileMatrixSetLink></Layer>"
+        )
+    for index in range(tile_matrix_sets):
+        matrices = "".join(
+            f"<TileMatrix><ows:Identifier>{level:02d}</ows:Identifier><ScaleDenominator>{559082264.0 / 2 ** level}</ScaleDenominator>"
+            f"<TopLeftCorner>-20037508.34 20037508.34</TopLeftCorner><TileWidth>256</TileWidth><TileHeight>256</TileHeight>"
+            f"<MatrixWidth>{2 ** level}</MatrixWidth><MatrixHeight>{2 ** level}</MatrixHeight></TileMatrix>"
+            for level in range(levels)
+        )
+        body.append(
+            f"<TileMatrixSet><ows:Identifier>tms{index}</ows:Identifier>"
+            f"<ows:SupportedCRS>urn:ogc:def:crs:EPSG::3857</ows:SupportedCRS>{matrices}</TileMatrixSet>"
+        )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><Capabilities xmlns="http://www.opengis.net/wmts/1.0" '
+        'xmlns:ows="http://www.opengis.net/ows/1.1" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">'
+        "<ows:ServiceIdentification><ows:Title>Synthetic WMTS</ows:Title><ows:ServiceType>OGC WMTS</ows:ServiceType>"
+        "<ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion></ows:ServiceIdentification><Contents>"
+        + "".join(body)
+        + "</Contents></Capabilities>"
+    ).encode("utf-8")
+
+
+def _rss() -> int:
+    """Resident memory of the process in bytes (Linux)"""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def _peak_rss() -> int:
+    """Peak resident memory of the process in bytes since the last reset (Linux)"""
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def measure(function, *args) -> Tuple[float, float]:
+    """
+    Seconds and peak resident memory increase (MB) of a call, run in a forked
+    process (Linux). lxml trees are not allocated by Python, tracemalloc would
+    not see them.
+    """
+
+    def child(connection):
+        # reset the peak to the current resident memory
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        start_rss = _rss()
+        start = time.perf_counter()
+        function(*args)
+        duration = time.perf_counter() - start
+        connection.send((duration, (_peak_rss() - start_rss) / 1e6))
+
+    context = multiprocessing.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=child, args=(sender,))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+# Benchmark of the streaming readers against owslib
+if __name__ == "__main__":
+    import argparse
+
+    from owslib.wms import WebMapService
+    from owslib.wmts import WebMapTileService
+
+    parser = argparse.ArgumentParser(description="Startup time and memory of the streaming capabilities readers and of owslib")
+    parser.add_argument("--layers", type=int, default=5000, help="Layers of the synthetic documents")
+    parser.add_argument("--tile-matrix-sets", type=int, default=50, help="TileMatrixSets of the synthetic WMTS document")
+    args = parser.parse_args()
+
+    wms_xml = synthetic_wms(args.layers)
+    wmts_xml = synthetic_wmts(args.layers, args.tile_matrix_sets)
+    middle = f"layer{args.layers // 2}"
+
+    print(f"WMS {len(wms_xml) / 1e6:.1f} MB, WMTS {len(wmts_xml) / 1e6:.1f} MB, {args.layers} layers")
+    print(f"{'Reader':<32} {'seconds':>8} {'MB':>8}")
+    for label, function, arguments in (
+        ("owslib WebMapService", WebMapService, ("http://example.com/wms", "1.1.1", wms_xml)),
+        ("streaming WMS, first layer", read_wms_layer, (wms_xml, "http://example.com/wms", "layer0")),
+        ("streaming WMS, middle layer", read_wms_layer, (wms_xml, "http://example.com/wms", middle)),
+        ("owslib WebMapTileService", WebMapTileService, ("http://example.com/wmts", "1.0.0", wmts_xml)),
+        ("streaming WMTS, first layer", read_wmts_layer, (wmts_xml, "http://example.com/wmts", "layer0")),
+        ("streaming WMTS, middle layer", read_wmts_layer, (wmts_xml, "http://example.com/wmts", middle)),
+    ):
+        seconds, megabytes = measure(function, *arguments)
+        print(f"{label:<32} {seconds:>8.3f} {megabytes:>8.1f}")
+
+    # same layer objects as a full parse
+    full = WebMapService("http://example.com/wms", xml=wms_xml)
+    streamed = read_wms_layer(wms_xml, "http://example.com/wms", middle)
+    assert streamed.contents[middle].boundingBox == full.contents[middle].boundingBox
+    assert sorted(streamed.contents[middle].crsOptions) == sorted(full.contents[middle].crsOptions)
+    assert streamed.getOperationByName("GetMap").formatOptions == ["image/png", "image/jpeg"]
+    assert read_wms_layer(wms_xml, "http://example.com/wms").contents.keys() == {"layer0"}
+    assert read_wms_layer(wms_xml, "http://example.com/wms", "missing") is None
+    full_tiles = WebMapTileService("http://example.com/wmts", xml=wmts_xml)
+    streamed_tiles = read_wmts_layer(wmts_xml, "http://example.com/wmts", middle)
+    tile_matrix_set = list(streamed_tiles.tilematrixsets)[0]
+    assert list(streamed_tiles.tilematrixsets[tile_matrix_set].tilematrix) == list(full_tiles.tilematrixsets[tile_matrix_set].tilematrix)
+    assert streamed_tiles.contents[middle].tilematrixsetlinks.keys() == full_tiles.contents[middle].tilematrixsetlinks.keys()
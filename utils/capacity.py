@@ -0,0 +1,247 @@
+"""Automatic capacity search under latency and error rate SLOs
+
+`CapacitySearchShape` is a locust `LoadTestShape` that runs the test as a
+sequence of fixed user count steps. Each step is measured (after a warm up)
+against the p95/p99 latency and error rate SLOs: the user count grows by a
+factor until a step breaks the SLOs, then a binary search between the last
+good and the first bad step finds the highest sustainable load.
+
+The result is one JSON document with the maximum sustainable requests per
+second, the latency percentiles at that point and the step where the server
+broke. Used with the open loop mode (--target-rps) each user sends a fixed
+rate of requests, so the user count directly sets the offered load.
+"""
+from typing import Dict, List, Optional
+import json
+import logging
+import math
+
+from locust import LoadTestShape
+from locust.stats import calculate_response_time_percentile, diff_response_time_dicts
+
+from utils import arrival, saturation, viewport
+
+logger = logging.getLogger(__name__)
+
+# request types that are not requests to the server: the open loop dropped
+# failures, the viewport complete times of the session mode and the client
+# saturation failure (the timing phases are kept out of the locust statistics)
+EXCLUDED_REQUEST_TYPES = (arrival.REQUEST_TYPE, viewport.REQUEST_TYPE, saturation.REQUEST_TYPE)
+
+
+class CapacitySearchShape(LoadTestShape):
+    """
+    Step load shape searching the highest user count (and requests per second)
+    meeting the SLOs.
+    """
+
+    # Only used when --capacity-search is set, not picked up from the locustfile
+    abstract = True
+
+    def __init__(
+        self,
+        slo_p95: Optional[float] = None,
+        slo_p99: Optional[float] = None,
+        slo_error_rate: float = 0.01,
+        start_users: int = 10,
+        growth: float = 2.0,
+        max_users: int = 10000,
+        step_time: float = 60.0,
+        warmup: float = 10.0,
+        resolution: float = 0.05,
+        spawn_rate: float = 10.0,
+        output: Optional[str] = None,
+    ):
+        """
+        Parameters:
+        - slo_p95, slo_p99 (float): Optional. Maximum 95th/99th percentile response time in ms.
+        - slo_error_rate (float): Maximum fraction of failed (or dropped) requests.
+        - start_users (int): Users of the first step.
+        - growth (float): User count factor between two steps until the SLOs break.
+        - max_users (int): Highest user count tried.
+        - step_time (float): Seconds of a step, warm up included.
+        - warmup (float): Seconds at the beginning of a step that are not measured.
+        - resolution (float): The binary search stops when the bad and good user
+          counts are closer than this fraction of the good one.
+        - spawn_rate (float): Users started per second when changing step.
+        - output (str): Optional. JSON file of the result, it is also logged.
+        """
+        super().__init__()
+        if growth <= 1:
+            raise ValueError("Capacity search growth must be greater than 1.")
+        self.slo_p95 = slo_p95
+        self.slo_p99 = slo_p99
+        self.slo_error_rate = slo_error_rate
+        self.growth = growth
+        self.max_users = max_users
+        self.step_time = step_time
+        self.warmup = warmup
+        self.resolution = resolution
+        self.spawn_rate = spawn_rate
+        self.output = output
+
+        self.steps: List[Dict] = []
+        self.good: Optional[Dict] = None  # best step meeting the SLOs
+        self.bad: Optional[Dict] = None  # lowest step breaking the SLOs
+        self.bisecting = False
+        self.result: Optional[Dict] = None
+        self._start_step(min(start_users, max_users))
+
+    def _start_step(self, users: int, cooldown: bool = False):
+        self.users = users
+        self.step_start = self.get_run_time()
+        self.window = None  # snapshot of the statistics after the warm up
+        # after a step breaking the SLOs every user is stopped for a warm up period,
+        # so the requests queued on the server do not leak into the next step
+        self.cooldown_until = self.step_start + self.warmup if cooldown else None
+
+    def reset_time(self):
+        super().reset_time()
+        self.step_start = 0.0
+
+    def _snapshot(self) -> Dict:
+        """Totals of the request statistics, without the excluded request types"""
+        stats = self.runner.environment.stats
+        num_requests = stats.total.num_requests
+        num_failures = stats.total.num_failures
+        response_times = dict(stats.total.response_times)
+        for entry in stats.entries.values():
+            if entry.method in EXCLUDED_REQUEST_TYPES:
+                num_requests -= entry.num_requests
+                num_failures -= entry.num_failures
+                if entry.method == arrival.REQUEST_TYPE:
+                    # dropped requests are failures that were never sent, they count as errors
+                    num_requests += entry.num_failures
+                    num_failures += entry.num_failures
+                response_times = diff_response_time_dicts(response_times, entry.response_times)
+        return {
+            "time": self.get_run_time(),
+            "num_requests": num_requests,
+            "num_failures": num_failures,
+            "response_times": response_times,
+        }
+
+    def _measure(self, start: Dict, end: Dict) -> Dict:
+        """Throughput, latency percentiles and error rate between two snapshots"""
+        num_requests = end["num_requests"] - start["num_requests"]
+        num_failures = end["num_failures"] - start["num_failures"]
+        response_times = diff_response_time_dicts(end["response_times"], start["response_times"])
+        # response_times only holds the requests that got an answer
+        num_answered = sum(response_times.values())
+        duration = max(end["time"] - start["time"], 1e-9)
+        return {
+            "users": self.users,
+            "rps": num_requests / duration,
+            "requests": num_requests,
+            "p50": calculate_response_time_percentile(response_times, num_answered, 0.50),
+            "p95": calculate_response_time_percentile(response_times, num_answered, 0.95),
+            "p99": calculate_response_time_percentile(response_times, num_answered, 0.99),
+            "error_rate": num_failures / num_requests if num_requests else 1.0,
+        }
+
+    def _breaks(self, step: Dict) -> Optional[str]:
+        """Reason why a step breaks the SLOs, None if it meets them"""
+        if step["requests"] == 0:
+            return "no requests"
+        if step["error_rate"] > self.slo_error_rate:
+            return f"error rate {step['error_rate']:.4f} > {self.slo_error_rate}"
+        if self.slo_p95 is not None and step["p95"] > self.slo_p95:
+            return f"p95 {step['p95']}ms > {self.slo_p95}ms"
+        if self.slo_p99 is not None and step["p99"] > self.slo_p99:
+            return f"p99 {step['p99']}ms > {self.slo_p99}ms"
+        return None
+
+    def _next_users(self) -> Optional[int]:
+        """User count of the next step, None when the search is over"""
+        if not self.bisecting:
+            if self.bad is None:
+                if self.users >= self.max_users:
+                    return None
+                return min(max(math.ceil(self.users * self.growth), self.users + 1), self.max_users)
+            self.bisecting = True
+        low = self.good["users"] if self.good else 0
+        high = self.bad["users"]
+        if high - low <= max(1, self.resolution * low):
+            return None
+        return (low + high) // 2
+
+    def _finish(self):
+        self.result = {
+            "max_rps": self.good["rps"] if self.good else 0.0,
+            "users": self.good["users"] if self.good else 0,
+            "p50": self.good["p50"] if self.good else None,
+            "p95": self.good["p95"] if self.good else None,
+            "p99": self.good["p99"] if self.good else None,
+            "error_rate": self.good["error_rate"] if self.good else None,
+            "broke_at": self.bad,
+            "slo": {"p95": self.slo_p95, "p99": self.slo_p99, "error_rate": self.slo_error_rate},
+            "steps": self.steps,
+        }
+        logger.info(f"Capacity search result: {json.dumps(self.result)}")
+        if self.output:
+            with open(self.output, "w", encoding="utf-8") as output_file:
+                json.dump(self.result, output_file, indent=2)
+
+    def tick(self):
+        run_time = self.get_run_time()
+
+        if self.cooldown_until is not None:
+            if run_time < self.cooldown_until or self.get_current_user_count() > 0:
+                return 0, self.spawn_rate
+            self._start_step(self.users)
+
+        if self.window is None:
+            # start measuring after the warm up, once every user of the step is running
+            if run_time - self.step_start >= self.warmup and self.get_current_user_count() == self.users:
+                self.window = self._snapshot()
+            return self.users, self.spawn_rate
+
+        if run_time - self.step_start < self.step_time:
+            return self.users, self.spawn_rate
+
+        step = self._measure(self.window, self._snapshot())
+        step["reason"] = self._breaks(step)
+        self.steps.append(step)
+        logger.info(
+            f"Capacity step {len(self.steps)}: {step['users']} users, {step['rps']:.1f} rps, "
+            f"p95 {step['p95']}ms, p99 {step['p99']}ms, error rate {step['error_rate']:.4f}"
+            + (f", breaks SLO: {step['reason']}" if step["reason"] else ", meets SLO")
+        )
+        if step["reason"] is None:
+            if self.good is None or step["users"] > self.good["users"]:
+                self.good = step
+        elif self.bad is None or step["users"] < self.bad["users"]:
+            self.bad = step
+
+        users = self._next_users()
+        if users is None:
+            self._finish()
+            return None
+        self._start_step(users, cooldown=step["reason"] is not None)
+        return (0 if self.cooldown_until is not None else self.users), self.spawn_rate
+
+
+def enable(environment):
+    """
+    Run the test with a CapacitySearchShape built from the --capacity-* and
+    --slo-* options, on the master (or local) runner only.
+    """
+    options = environment.parsed_options
+    if type(environment.runner).__name__ == "WorkerRunner":
+        return
+    shape = CapacitySearchShape(
+        slo_p95=options.slo_p95,
+        slo_p99=options.slo_p99,
+        slo_error_rate=options.slo_error_rate,
+        start_users=options.capacity_start_users,
+        growth=options.capacity_growth,
+        max_users=options.capacity_max_users,
+        step_time=options.capacity_step_time,
+        warmup=options.capacity_warmup,
+        resolution=options.capacity_resolution,
+        spawn_rate=options.spawn_rate or 10.0,
+        output=options.capacity_output,
+    )
+    shape.runner = environment.runner
+    environment.shape_class = shape
+    logger.info("Capacity search enabled, -u and -t are not used")
@@ -0,0 +1,187 @@
+"""Connection handling modes of the benchmark users
+
+Clients differ in how they use connections: browsers keep a pool of
+keep-alive connections per host, GIS desktop tools often open a new
+connection per request. Servers and load balancers behave differently under
+each pattern (TLS handshakes, accept queues, connection tracking), so the
+users can mimic them:
+
+- the size of the connection pool of each user;
+- `Connection: close` on every request, a new connection per request;
+- the `Accept-Encoding` header (e.g. "identity" to disable compression);
+- separate connect and read timeouts.
+
+The connection churn (new connections per second) is reported over time next
+to the latency, from the CONNECT phases of the timing breakdown
+(utils.timing), which the workers send to the master in a distributed test.
+"""
+from typing import Dict, Optional
+import logging
+import time
+
+from locust.stats import calculate_response_time_percentile, diff_response_time_dicts
+
+from utils import reporting, timing
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ACCEPT_ENCODING = "gzip, deflate"
+
+
+def apply_options(user_class, parsed_options):
+    """
+    Set the --connect-timeout, --read-timeout and --connections-per-user
+    options on a FastHttpUser class, before its users are spawned.
+    """
+    user_class.connection_timeout = parsed_options.connect_timeout
+    user_class.network_timeout = parsed_options.read_timeout
+    if parsed_options.connections_per_user > 0:
+        user_class.concurrency = parsed_options.connections_per_user
+
+
+def request_headers(parsed_options) -> Dict[str, str]:
+    """
+    Headers of every request. Accept-Encoding is always set, locust would
+    add its own default otherwise.
+    """
+    headers = {"Accept-Encoding": parsed_options.accept_encoding or DEFAULT_ACCEPT_ENCODING}
+    if parsed_options.connection_close:
+        # the server closes the connection after the response, the next request opens a new one
+        headers["Connection"] = "close"
+    return headers
+
+
+def churn_enabled(parsed_options) -> bool:
+    """True when the connection churn is reported, the timing breakdown is then needed too"""
+    return getattr(parsed_options, "connection_report_interval", 0) > 0
+
+
+def request_totals(stats, request_type: str = "GET") -> Dict:
+    """Requests and response times of locust RequestStats, new connections of the timing phases"""
+    num_requests = 0
+    response_times: Dict[int, int] = {}
+    for (_, method), entry in stats.entries.items():
+        if method == request_type:
+            num_requests += entry.num_requests
+            for response_time, count in entry.response_times.items():
+                response_times[response_time] = response_times.get(response_time, 0) + count
+    connections = sum(
+        entry.num_requests for (_, method), entry in timing.phase_stats.entries.items() if method == timing.CONNECT
+    )
+    return {"time": time.time(), "requests": num_requests, "response_times": response_times, "connections": connections}
+
+
+class ConnectionChurnReporter(reporting.PeriodicReporter):
+    """
+    Log (and write to a CSV file) the new connections per second and the
+    latency of every interval.
+
+    Example:
+    reporter = ConnectionChurnReporter(environment, interval=10, output="churn.csv")
+    reporter.start()
+    ...
+    reporter.stop()
+    """
+
+    title = "Connection churn report"
+
+    def __init__(self, environment, interval: float = 10.0, output: Optional[str] = None):
+        """
+        Parameters:
+        - environment: Locust environment, of the master in a distributed test.
+        - interval (float): Seconds between two reports.
+        - output (str): Optional. CSV file of the reports.
+        """
+        super().__init__(environment, interval, output)
+        self.previous = request_totals(environment.stats)
+
+    def report(self):
+        """Add the interval since the previous report"""
+        totals = request_totals(self.environment.stats)
+        duration = max(totals["time"] - self.previous["time"], 1e-9)
+        requests = totals["requests"] - self.previous["requests"]
+        connections = totals["connections"] - self.previous["connections"]
+        response_times = diff_response_time_dicts(totals["response_times"], self.previous["response_times"])
+        answered = sum(response_times.values())
+        self.previous = totals
+        row = {
+            "timestamp": round(totals["time"], 3),
+            "requests": requests,
+            "new_connections": connections,
+            "connections_per_s": round(connections / duration, 2),
+            "requests_per_connection": round(requests / connections, 2) if connections else "",
+            "p50": calculate_response_time_percentile(response_times, answered, 0.5) if answered else 0,
+            "p95": calculate_response_time_percentile(response_times, answered, 0.95) if answered else 0,
+        }
+        self.rows.append(row)
+        if requests:
+            logger.info(
+                f"Connections: {row['connections_per_s']} new/s ({connections} for {requests} requests), "
+                f"latency p50 {row['p50']}ms p95 {row['p95']}ms"
+            )
+
+
+def start_reporter(environment):
+    """
+    Start the connection churn reports of a test with --connection-report-interval,
+    on the master (or local) runner only, workers have no aggregated statistics.
+    """
+    options = environment.parsed_options
+    if not churn_enabled(options) or type(environment.runner).__name__ == "WorkerRunner":
+        return
+    reporting.start(
+        ConnectionChurnReporter(environment, options.connection_report_interval, options.connection_report_output)
+    )
+
+
+def stop_reporter():
+    """Stop the connection churn reports, the last report covers the end of the test"""
+    reporting.stop(ConnectionChurnReporter)
+
+
+def add_arguments(parser):
+    """Add the connection pool, header and timeout options of the users to the locust command line parser"""
+    parser.add_argument(
+        "--connections-per-user",
+        type=int,
+        default=0,
+        help="Size of the connection pool of each user, per host. Defaults to 0, locust's pool (10), or the open loop/viewport concurrency",
+    )
+    parser.add_argument(
+        "--connection-close",
+        action="store_true",
+        default=False,
+        help="Send Connection: close on every request, a new connection per request (GIS desktop clients) instead of keep-alive (browsers)",
+    )
+    parser.add_argument(
+        "--accept-encoding",
+        type=str,
+        default="gzip, deflate",
+        help="Accept-Encoding header of the requests, e.g. identity to disable compression. Defaults to 'gzip, deflate'",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=60.0,
+        help="Seconds to open a connection before the request fails. Defaults to 60",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=120.0,
+        help="Seconds without data from the server before the request fails, extended for very slow servers. Defaults to 120",
+    )
+
+
+# Example of function usage
+if __name__ == "__main__":
+    from locust.stats import RequestStats
+
+    options = type("", (), {"accept_encoding": "identity", "connection_close": True})()
+    assert request_headers(options) == {"Accept-Encoding": "identity", "Connection": "close"}
+    stats = RequestStats()
+    for response_time in (10, 20, 30, 40):
+        stats.log_request("GET", "GetMap", response_time, 1000)
+    timing.phase_stats.log_request(timing.CONNECT, "layer image/png", 1, 0)
+    totals = request_totals(stats)
+    assert totals["requests"] == 4 and totals["connections"] == 1
@@ -0,0 +1,432 @@
+"""Tiles with data of a WMTS layer
+
+A TileMatrix is usually much larger than the data of a layer (PTTM_06 covers
+far more than mainland Portugal), tiles outside the data are empty and answered
+in microseconds, inflating the throughput. Tiles are drawn:
+
+- within the TileMatrixSetLimits of the layer and its bounding box, always;
+- optionally from a coverage mask, one bitset per TileMatrix of the tiles
+  intersecting a GeoJSON footprint, built once with:
+
+python -m utils.coverage --host <url> --layer-name <layer> --tile-matrix-set <tms> --footprint footprint.geojson --output coverage.npz
+
+The mask is a NumPy `.npz` (written and read with the standard library only)
+with, for each TileMatrix, a `<matrix>` uint8 array of bits packed along the
+columns (`numpy.packbits` order) and a `<matrix>_range` int32 array
+[min_col, max_col, min_row, max_row] of the bitset window.
+"""
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import argparse
+import array
+import bisect
+import itertools
+import json
+import logging
+import math
+import random
+import zipfile
+
+from utils.bbox_grid import tile_matrix_grid
+from utils.crs import WEB_MERCATOR_CODES, crs_code, lonlat_to_web_mercator
+from utils.workload import NPY_MAGIC, npy_header, read_npy_header
+
+logger = logging.getLogger(__name__)
+
+# (min_col, max_col, min_row, max_row), inclusive
+TileRange = Tuple[int, int, int, int]
+
+
+class CoverageError(ValueError):
+    """Custom exception for invalid footprints and coverage masks."""
+
+    pass
+
+
+def to_tile_matrix_set_crs(points: Sequence[Tuple[float, float]], tms_crs: str):
+    """
+    Convert WGS84 longitude/latitude points to the CRS of a TileMatrixSet, when
+    it is done without a projection library (CRS84, EPSG:4326 or web mercator),
+    else None. Geographic points stay in (longitude, latitude) order.
+    """
+    code = crs_code(tms_crs)
+    if code in ("CRS84", "4326"):
+        return list(points)
+    if code in WEB_MERCATOR_CODES:
+        return [lonlat_to_web_mercator(lon, lat) for lon, lat in points]
+    return None
+
+
+def layer_extent(layer, tile_matrix_set) -> Optional[Tuple[float, float, float, float]]:
+    """
+    Extent of a WMTS layer in the CRS of the TileMatrixSet: its BoundingBox in
+    that CRS, or its WGS84BoundingBox when it can be converted. None if unknown.
+    """
+    code = crs_code(tile_matrix_set.crs)
+    for bounding_box in getattr(layer, "boundingBox", None) or []:
+        if crs_code(bounding_box.crs) == code:
+            return tuple(bounding_box.extent)
+    if layer.boundingBoxWGS84:
+        minx, miny, maxx, maxy = layer.boundingBoxWGS84[:4]
+        corners = to_tile_matrix_set_crs([(minx, miny), (maxx, maxy)], tile_matrix_set.crs)
+        if corners:
+            (minx, miny), (maxx, maxy) = corners
+            return minx, miny, maxx, maxy
+    return None
+
+
+def tile_range(tile_matrix, limits=None, extent=None, crs: Optional[str] = None) -> Optional[TileRange]:
+    """
+    Range of the tiles of a TileMatrix within its TileMatrixLimits and an extent.
+
+    Parameters:
+    - tile_matrix: owslib TileMatrix.
+    - limits: Optional. owslib TileMatrixLimits of the layer for this TileMatrix.
+    - extent (tuple): Optional. (minx, miny, maxx, maxy) in the TileMatrixSet CRS,
+      longitude first in a geographic CRS.
+    - crs (str): Optional. CRS of the TileMatrixSet, for the units and axis order
+      of geographic TileMatrixSets.
+
+    Returns:
+    - (min_col, max_col, min_row, max_row), or None when no tile is left.
+    """
+    min_col, max_col = 0, tile_matrix.matrixwidth - 1
+    min_row, max_row = 0, tile_matrix.matrixheight - 1
+    if limits is not None:
+        min_col, max_col = max(min_col, limits.mintilecol), min(max_col, limits.maxtilecol)
+        min_row, max_row = max(min_row, limits.mintilerow), min(max_row, limits.maxtilerow)
+    if extent is not None:
+        grid = tile_matrix_grid(tile_matrix, crs)
+        minx, miny, maxx, maxy = extent
+        min_col = max(min_col, math.floor((minx - grid.left) / grid.span_x))
+        max_col = min(max_col, math.ceil((maxx - grid.left) / grid.span_x) - 1)
+        min_row = max(min_row, math.floor((grid.top - maxy) / grid.span_y))
+        max_row = min(max_row, math.ceil((grid.top - miny) / grid.span_y) - 1)
+    if min_col > max_col or min_row > max_row:
+        return None
+    return min_col, max_col, min_row, max_row
+
+
+def layer_tile_ranges(layer, tile_matrix_set) -> Dict[str, TileRange]:
+    """
+    Range of the tiles of every TileMatrix of a layer, within its
+    TileMatrixSetLimits and extent. TileMatrix without any tile are left out.
+    """
+    link = layer.tilematrixsetlinks.get(tile_matrix_set.identifier)
+    limits = link.tilematrixlimits if link is not None else {}
+    extent = layer_extent(layer, tile_matrix_set)
+    if extent is None:
+        logger.info(
+            f"Layer {layer.id} has no extent in the CRS of {tile_matrix_set.identifier}, "
+            "tiles are only limited by the TileMatrixSetLimits"
+        )
+    ranges = {}
+    for identifier, tile_matrix in tile_matrix_set.tilematrix.items():
+        matrix_range = tile_range(tile_matrix, limits.get(identifier), extent, tile_matrix_set.crs)
+        if matrix_range is not None:
+            ranges[identifier] = matrix_range
+    return ranges
+
+
+def _footprint_rings(geojson: dict, tms_crs: str) -> List[List[Tuple[float, float]]]:
+    """
+    Polygon rings (exterior and holes) of a GeoJSON footprint, in the
+    TileMatrixSet CRS.
+
+    The footprint is read in the TileMatrixSet CRS when it declares it (legacy
+    "crs" member), else as WGS84 (RFC 7946), which is only converted to CRS84
+    and web mercator TileMatrixSets.
+    """
+    if geojson.get("type") == "FeatureCollection":
+        geometries = [feature["geometry"] for feature in geojson["features"]]
+    elif geojson.get("type") == "Feature":
+        geometries = [geojson["geometry"]]
+    else:
+        geometries = [geojson]
+
+    declared = crs_code(geojson.get("crs", {}).get("properties", {}).get("name"))
+    same_crs = declared is not None and declared == crs_code(tms_crs)
+
+    rings = []
+    for geometry in geometries:
+        if geometry["type"] == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            raise CoverageError(f"Footprint geometries must be polygons, got {geometry['type']}")
+        for polygon in polygons:
+            for ring in polygon:
+                points = [(point[0], point[1]) for point in ring]
+                if not same_crs:
+                    points = to_tile_matrix_set_crs(points, tms_crs)
+                    if points is None:
+                        raise CoverageError(
+                            f"The footprint must be in the TileMatrixSet CRS {tms_crs}, "
+                            f"e.g. ogr2ogr -t_srs EPSG:{crs_code(tms_crs)} -lco RFC7946=NO, "
+                            "with a 'crs' member"
+                        )
+                rings.append(points)
+    return rings
+
+
+def rasterize(
+    rings: List[List[Tuple[float, float]]], tile_matrix, matrix_range: TileRange, crs: Optional[str] = None
+) -> bytearray:
+    """
+    Bitset (bits packed along the columns, most significant bit first) of the
+    tiles of `matrix_range` intersecting the polygons, whose points are in the
+    CRS of the TileMatrixSet `crs` (longitude first in a geographic CRS).
+
+    Tiles whose center is inside the polygons are found with an even-odd scan
+    line per tile row, tiles crossed by a polygon edge are added by walking the
+    edges in quarter tile steps.
+    """
+    min_col, max_col, min_row, max_row = matrix_range
+    cols, rows = max_col - min_col + 1, max_row - min_row + 1
+    row_bytes = (cols + 7) // 8
+    bits = bytearray(row_bytes * rows)
+    left, top, span_x, span_y = tile_matrix_grid(tile_matrix, crs)[:4]
+
+    def mark(col: int, row: int):
+        if min_col <= col <= max_col and min_row <= row <= max_row:
+            index = col - min_col
+            bits[(row - min_row) * row_bytes + index // 8] |= 0x80 >> (index % 8)
+
+    # x crossings of each tile row center line
+    crossings: Dict[int, List[float]] = {}
+    for ring in rings:
+        for (x0, y0), (x1, y1) in zip(ring, ring[1:] + ring[:1]):
+            # rows whose center line y = top - (row + 0.5) * span_y is crossed by the edge
+            row0 = (top - y0) / span_y - 0.5
+            row1 = (top - y1) / span_y - 0.5
+            if row0 == row1:
+                continue
+            first = max(math.ceil(min(row0, row1)), min_row)
+            last = min(math.ceil(max(row0, row1)) - 1, max_row)
+            for row in range(first, last + 1):
+                crossings.setdefault(row, []).append(x0 + (x1 - x0) * (row - row0) / (row1 - row0))
+
+            # tiles crossed by the edge
+            steps = max(1, math.ceil(4 * max(abs(x1 - x0) / span_x, abs(y1 - y0) / span_y)))
+            for step in range(steps + 1):
+                x = x0 + (x1 - x0) * step / steps
+                y = y0 + (y1 - y0) * step / steps
+                mark(math.floor((x - left) / span_x), math.floor((top - y) / span_y))
+
+    for row, xs in crossings.items():
+        xs.sort()
+        for start, stop in zip(xs[::2], xs[1::2]):
+            # tiles whose center x is in [start, stop]
+            first = max(math.ceil((start - left) / span_x - 0.5), min_col)
+            last = min(math.floor((stop - left) / span_x - 0.5), max_col)
+            for col in range(first, last + 1):
+                mark(col, row)
+    return bits
+
+
+def write_mask(path: str, masks: Dict[str, Tuple[TileRange, bytearray]]):
+    """
+    Write coverage masks to a .npz file.
+
+    Parameters:
+    - path (str): Output .npz file.
+    - masks (dict): TileMatrix identifier to (tile range, bitset from rasterize()).
+    """
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as npz:
+        for identifier, (matrix_range, bits) in masks.items():
+            min_col, max_col, min_row, max_row = matrix_range
+            rows = max_row - min_row + 1
+            npz.writestr(f"{identifier}.npy", npy_header("|u1", (rows, len(bits) // rows)) + bytes(bits))
+            npz.writestr(
+                f"{identifier}_range.npy",
+                npy_header("<i4", (4,)) + array.array("i", matrix_range).tobytes(),
+            )
+
+
+# bytes of the bitset per prefix sum of BitsetIndex, 1/8 of the bitset size in prefix sums
+BLOCK_BYTES = 64
+# set bits of every byte value
+POPCOUNT = bytes(bin(value).count("1") for value in range(256))
+
+
+class BitsetIndex:
+    """
+    Rank index of the set bits of a mask: the cumulative count of set bits
+    at the end of each block of BLOCK_BYTES bytes. The k-th set bit is found
+    with a bisect over the blocks and a scan of one block, the bitset itself
+    is not expanded into a list of tiles.
+    """
+
+    def __init__(self, matrix_range: TileRange, bits: bytes):
+        """
+        Parameters:
+        - matrix_range (tuple): (min_col, max_col, min_row, max_row) of the mask.
+        - bits (bytes): Bitset of the mask, from rasterize().
+        """
+        min_col, max_col, _, _ = matrix_range
+        self.bits = bits
+        # bits per row, with the padding of the last byte (always 0)
+        self.row_bits = (max_col - min_col + 8) // 8 * 8
+        self.prefix = array.array(
+            "Q",
+            itertools.accumulate(
+                int.from_bytes(bits[offset : offset + BLOCK_BYTES], "big").bit_count()
+                for offset in range(0, len(bits), BLOCK_BYTES)
+            ),
+        )
+
+    def __len__(self) -> int:
+        return self.prefix[-1] if self.prefix else 0
+
+    def select(self, rank: int) -> Tuple[int, int]:
+        """(col, row) from the range origin of the set bit of a rank, from 0 to len() - 1"""
+        block = bisect.bisect_right(self.prefix, rank)
+        if block:
+            rank -= self.prefix[block - 1]
+        offset = block * BLOCK_BYTES
+        # set bits at the end of each byte of the block
+        counts = list(itertools.accumulate(self.bits[offset : offset + BLOCK_BYTES].translate(POPCOUNT)))
+        index = bisect.bisect_right(counts, rank)
+        if index:
+            rank -= counts[index - 1]
+        offset += index
+        byte = self.bits[offset]
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                if not rank:
+                    break
+                rank -= 1
+        row, col = divmod(offset * 8 + bit, self.row_bits)
+        return col, row
+
+
+class CoverageSampler:
+    """
+    Random tiles with data of one TileMatrix, drawn uniformly from the rank
+    index of the mask bitset in O(log(blocks) + BLOCK_BYTES) per tile.
+    """
+
+    def __init__(self, matrix_range: TileRange, index: BitsetIndex, rng: Optional[random.Random] = None):
+        """
+        Parameters:
+        - matrix_range (tuple): (min_col, max_col, min_row, max_row) of the mask.
+        - index (BitsetIndex): Rank index of the tiles with data.
+        - rng (random.Random): Optional. Random number generator of the sampler.
+        """
+        if not len(index):
+            raise CoverageError("The coverage mask has no tile with data")
+        self.min_col, _, self.min_row, _ = matrix_range
+        self.index = index
+        self.rng = rng or random.Random()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __iter__(self) -> Iterator[Tuple[int, int]]:
+        return self
+
+    def __next__(self) -> Tuple[int, int]:
+        col, row = self.index.select(self.rng.randrange(len(self.index)))
+        return self.min_col + col, self.min_row + row
+
+
+class CoverageMask:
+    """
+    Coverage masks of a .npz file, read once per process.
+
+    Example:
+    mask = load_mask("coverage.npz")
+    col, row = next(mask.sampler("07", rng))
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.masks: Dict[str, Tuple[TileRange, bytes]] = {}
+        self._indexes: Dict[str, BitsetIndex] = {}
+        with zipfile.ZipFile(path) as npz:
+            names = [name[: -len(".npy")] for name in npz.namelist() if name.endswith(".npy")]
+            for identifier in names:
+                if identifier.endswith("_range"):
+                    continue
+                bits = self._read(npz, identifier)
+                matrix_range = tuple(array.array("i", self._read(npz, f"{identifier}_range")))
+                self.masks[identifier] = (matrix_range, bits)
+
+    @staticmethod
+    def _read(npz: zipfile.ZipFile, name: str) -> bytes:
+        data = npz.read(f"{name}.npy")
+        if data[:6] != NPY_MAGIC:
+            raise CoverageError(f"{name} is not a .npy array")
+        _, offset = read_npy_header(data)
+        return data[offset:]
+
+    def __contains__(self, identifier: str) -> bool:
+        return identifier in self.masks
+
+    def sampler(self, identifier: str, rng: Optional[random.Random] = None) -> CoverageSampler:
+        """
+        Return a sampler of the tiles with data of a TileMatrix. The rank index
+        of the bitset is shared by the samplers of a process, each one has its
+        own `rng`.
+        """
+        if identifier not in self.masks:
+            raise CoverageError(
+                f"The coverage mask {self.path} has no TileMatrix {identifier}, available: {list(self.masks)}"
+            )
+        if identifier not in self._indexes:
+            self._indexes[identifier] = BitsetIndex(*self.masks[identifier])
+            logger.info(
+                f"Coverage mask {self.path}: {len(self._indexes[identifier])} tiles with data in TileMatrix {identifier}"
+            )
+        return CoverageSampler(self.masks[identifier][0], self._indexes[identifier], rng)
+
+
+# Masks shared by the users of the process, key is the file path
+_masks: Dict[str, CoverageMask] = {}
+
+
+def load_mask(path: str) -> CoverageMask:
+    """Return the coverage masks of `path`, read once per process"""
+    if path not in _masks:
+        _masks[path] = CoverageMask(path)
+    return _masks[path]
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Build the coverage mask of a WMTS layer for wmts.py --coverage-file")
+    parser.add_argument("--host", type=str, default="", help="Service url, to read GetCapabilities")
+    parser.add_argument("--capabilities-file", type=str, default=None, help="Local GetCapabilities XML file")
+    parser.add_argument("--layer-name", type=str, default="", help="Layer, defaults to the first one")
+    parser.add_argument("--tile-matrix-set", type=str, default=None, help="Layer's TileMatrixSet, defaults to the first one")
+    parser.add_argument("--tile-matrix", type=str, action="append", default=None, help="TileMatrix to include, can be repeated. Defaults to all")
+    parser.add_argument("--footprint", type=str, required=True, help="GeoJSON (Multi)Polygon footprint of the data")
+    parser.add_argument("--output", type=str, required=True, help="Output .npz file")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    from utils.capabilities import load_capabilities
+
+    wmts = load_capabilities("WMTS", args.host, capabilities_file=args.capabilities_file)
+    layer = wmts.contents[args.layer_name or list(wmts.contents.keys())[0]]
+    tile_matrix_set = wmts.tilematrixsets[args.tile_matrix_set or list(layer.tilematrixsetlinks.keys())[0]]
+    with open(args.footprint, encoding="utf-8") as footprint_file:
+        rings = _footprint_rings(json.load(footprint_file), tile_matrix_set.crs)
+
+    ranges = layer_tile_ranges(layer, tile_matrix_set)
+    masks = {}
+    for identifier in args.tile_matrix or list(ranges):
+        if identifier not in ranges:
+            raise CoverageError(f"TileMatrix {identifier} has no tiles in layer {layer.id}")
+        bits = rasterize(rings, tile_matrix_set.tilematrix[identifier], ranges[identifier], tile_matrix_set.crs)
+        covered = sum(bin(byte).count("1") for byte in bits)
+        min_col, max_col, min_row, max_row = ranges[identifier]
+        logger.info(
+            f"TileMatrix {identifier}: {covered} of {(max_col - min_col + 1) * (max_row - min_row + 1)} tiles with data"
+        )
+        masks[identifier] = (ranges[identifier], bits)
+    write_mask(args.output, masks)
+    logger.info(f"Wrote the coverage mask of {len(masks)} TileMatrix to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+"""CRS units and axis order of bbox requests
+
+Bbox areas are given in square kilometres on the ground. In a projected CRS
+(metres, or feet) the bbox side is a fixed number of CRS units, in a
+geographic CRS (degrees) the width in degrees of the same ground distance
+grows with the latitude, 1 degree of longitude being cos(latitude) times
+shorter than 1 degree of latitude. Web mercator metres are only true at the
+equator: both sides of a bbox grow with 1/cos(latitude).
+
+WMS 1.3.0 also uses the axis order of the EPSG definition: latitude first for
+EPSG:4326, EPSG:4258, ... (but not for CRS:84), both in the GetCapabilities
+BoundingBox and in the GetMap bbox. Bboxes are generated in (x=longitude,
+y=latitude) order and swapped only when read from or sent to the service.
+
+Units and axis order come from pyproj when it is installed, otherwise from a
+small built-in table: the geographic CRS below, every other code is taken as
+a projected CRS in metres.
+"""
+from typing import NamedTuple, Optional, Tuple
+import functools
+import math
+import re
+
+try:
+    import pyproj
+except ImportError:  # optional, the built-in table is used instead
+    pyproj = None
+
+WEB_MERCATOR_CODES = ("3857", "900913", "3785", "102100")
+# sphere radius of web mercator
+WEB_MERCATOR_RADIUS = 6378137.0
+
+# Metres of 1 degree of latitude (mean earth radius 6371008.8 m), 1 degree of
+# longitude is cos(latitude) times this
+METERS_PER_DEGREE = math.pi * 6371008.8 / 180
+
+# Geographic CRS (degrees, latitude first in EPSG order): WGS 84, ETRS89, NAD83,
+# GDA94, NAD83(CSRS), SIRGAS 2000, ED50, NZGD2000, JGD2000, JGD2011, GDA2020, CGCS2000
+GEOGRAPHIC_CODES = (
+    "4326", "4258", "4269", "4283", "4617", "4674", "4230", "4167", "4612", "6668", "7844", "4490",
+)
+
+# Projected CRS not in metres: US survey feet and international feet state planes
+FOOT_CODES = {
+    "2227": 0.3048006096012192,
+    "2229": 0.3048006096012192,
+    "2263": 0.3048006096012192,
+    "2272": 0.3048006096012192,
+    "2868": 0.3048,
+}
+
+
+def crs_code(crs: Optional[str]) -> Optional[str]:
+    """
+    Return the code of a CRS identifier, e.g. "3763" for
+    "urn:ogc:def:crs:EPSG::3763", "EPSG:3763" or
+    "http://www.opengis.net/def/crs/EPSG/0/3763", "CRS84" for OGC CRS84.
+    """
+    if not crs:
+        return None
+    match = re.search(r"(CRS84|\d+)\s*$", crs.strip(), re.IGNORECASE)
+    return match.group(1).upper() if match else None
+
+
+def lonlat_to_web_mercator(lon: float, lat: float) -> Tuple[float, float]:
+    """Project WGS84 longitude/latitude to EPSG:3857 (spherical mercator)"""
+    radius = WEB_MERCATOR_RADIUS
+    lat = max(min(lat, 85.0511287798), -85.0511287798)
+    return (
+        math.radians(lon) * radius,
+        math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * radius,
+    )
+
+
+def web_mercator_latitude(y: float) -> float:
+    """WGS84 latitude in degrees of an EPSG:3857 northing"""
+    return math.degrees(2 * math.atan(math.exp(y / WEB_MERCATOR_RADIUS)) - math.pi / 2)
+
+
+class CrsInfo(NamedTuple):
+    """Units and axis order of a CRS"""
+
+    code: Optional[str]
+    geographic: bool
+    # first axis is the latitude/northing in the EPSG definition (WMS 1.3.0 order)
+    lat_first: bool
+    # metres of one CRS unit, projected CRS only
+    meters_per_unit: float = 1.0
+    # web mercator, metres of one CRS unit are cos(latitude) times meters_per_unit
+    web_mercator: bool = False
+
+
+@functools.lru_cache(maxsize=None)
+def crs_info(crs: Optional[str]) -> CrsInfo:
+    """
+    Units and axis order of a CRS identifier, e.g. "EPSG:4326",
+    "urn:ogc:def:crs:EPSG::3763" or "CRS:84".
+    """
+    code = crs_code(crs)
+    if code in WEB_MERCATOR_CODES:
+        return CrsInfo(code, geographic=False, lat_first=False, web_mercator=True)
+    if code in ("CRS84", "84"):
+        # OGC CRS84, longitude first
+        return CrsInfo(code, geographic=True, lat_first=False)
+    if pyproj is not None and code is not None:
+        try:
+            definition = pyproj.CRS.from_user_input(f"EPSG:{code}")
+        except pyproj.exceptions.CRSError:
+            definition = None
+        if definition is not None:
+            axis = definition.axis_info
+            lat_first = bool(axis) and axis[0].direction.lower() in ("north", "south")
+            if definition.is_geographic:
+                return CrsInfo(code, geographic=True, lat_first=lat_first)
+            return CrsInfo(
+                code,
+                geographic=False,
+                lat_first=lat_first,
+                meters_per_unit=axis[0].unit_conversion_factor if axis else 1.0,
+            )
+    if code in GEOGRAPHIC_CODES:
+        return CrsInfo(code, geographic=True, lat_first=True)
+    return CrsInfo(code, geographic=False, lat_first=False, meters_per_unit=FOOT_CODES.get(code, 1.0))
+
+
+def axis_swapped(crs: Optional[str], version: str = "1.3.0") -> bool:
+    """True when bboxes of `crs` are latitude first in this WMS version"""
+    return version >= "1.3.0" and crs_info(crs).lat_first
+
+
+def swap_axes(bbox: Tuple[float, float, float, float]) -> Tuple[float, float, float, float]:
+    """(miny, minx, maxy, maxx) of a (minx, miny, maxx, maxy) bbox, and the other way round"""
+    return bbox[1], bbox[0], bbox[3], bbox[2]
+
+
+def capabilities_bbox(bbox, crs: Optional[str], version: str) -> Tuple[float, float, float, float]:
+    """
+    (minx, miny, maxx, maxy) of a GetCapabilities BoundingBox, x being the
+    longitude in a geographic CRS.
+
+    Parameters:
+    - bbox: The (minx, miny, maxx, maxy[, crs]) bbox of an owslib layer.
+    - crs (str): CRS of the bbox.
+    - version (str): WMS version of the GetCapabilities document.
+    """
+    bbox = tuple(bbox[:4])
+    return swap_axes(bbox) if axis_swapped(crs, version) else bbox
+
+
+def layer_bbox(layer, crs: str, version: str) -> Optional[Tuple[float, float, float, float]]:
+    """
+    (minx, miny, maxx, maxy) of an owslib WMS layer in `crs`, x being the
+    longitude in a geographic CRS: a BoundingBox of the capabilities, or the
+    WGS84 bbox, projected to web mercator if needed. None when the layer has
+    no bbox in `crs`.
+
+    Parameters:
+    - layer: owslib WMS ContentMetadata.
+    - crs (str): CRS of the bbox, e.g. "EPSG:3763".
+    - version (str): WMS version of the GetCapabilities document.
+    """
+    if crs == layer.boundingBox[-1]:
+        return capabilities_bbox(layer.boundingBox, crs, version)
+    for *bbox, bbox_crs in getattr(layer, "crs_list", None) or []:
+        if bbox_crs == crs:
+            return capabilities_bbox(bbox, crs, version)
+    if layer.boundingBoxWGS84 and crs_info(crs).geographic:
+        return tuple(layer.boundingBoxWGS84[:4])
+    if layer.boundingBoxWGS84 and crs_code(crs) in WEB_MERCATOR_CODES:
+        lon_min, lat_min, lon_max, lat_max = layer.boundingBoxWGS84[:4]
+        return (*lonlat_to_web_mercator(lon_min, lat_min), *lonlat_to_web_mercator(lon_max, lat_max))
+    return None
+
+
+def varies_with_latitude(info: CrsInfo) -> bool:
+    """True when the CRS units of a ground distance depend on the latitude"""
+    return info.geographic or info.web_mercator
+
+
+def center_latitude(info: CrsInfo, y: float) -> float:
+    """Latitude in degrees of a bbox center of northing `y` in a geographic or web mercator CRS"""
+    return web_mercator_latitude(y) if info.web_mercator else y
+
+
+def ground_size(width_m: float, height_m: float, info: CrsInfo, latitude: float = 0.0) -> Tuple[float, float]:
+    """
+    Width and height in CRS units of a `width_m` x `height_m` metres bbox,
+    centered on `latitude` (degrees) in a geographic or web mercator CRS.
+    """
+    # at the poles a degree of longitude has no length, keep the bbox finite
+    cos_latitude = max(math.cos(math.radians(latitude)), 0.01)
+    if info.web_mercator:
+        return width_m / cos_latitude, height_m / cos_latitude
+    if not info.geographic:
+        return width_m / info.meters_per_unit, height_m / info.meters_per_unit
+    return width_m / (METERS_PER_DEGREE * cos_latitude), height_m / METERS_PER_DEGREE
+
+
+# Example of function usage
+if __name__ == "__main__":
+    assert crs_info("EPSG:4326").geographic and axis_swapped("EPSG:4326")
+    assert not axis_swapped("CRS:84") and not axis_swapped("EPSG:4326", "1.1.1")
+    assert not crs_info("EPSG:3763").geographic and not axis_swapped("EPSG:3763")
+    assert capabilities_bbox((36.9, -9.6, 42.2, -6.1, "EPSG:4326"), "EPSG:4326", "1.3.0") == (-9.6, 36.9, -6.1, 42.2)
+    width, height = ground_size(10000, 10000, crs_info("EPSG:4326"), latitude=60)
+    assert abs(height - 0.0899) < 0.001 and abs(width - 2 * height) < 0.001
+    _, y = lonlat_to_web_mercator(-9.14, 38.72)
+    assert abs(web_mercator_latitude(y) - 38.72) < 1e-9
+    mercator_width, mercator_height = ground_size(10000, 10000, crs_info("EPSG:3857"), latitude=60)
+    assert abs(mercator_width - 20000) < 1e-6 and abs(mercator_height - 20000) < 1e-6
+    print(f"10km at 60N: {width:.4f} x {height:.4f} degrees, pyproj {'used' if pyproj else 'not installed'}")
@@ -0,0 +1,198 @@
+"""Distributed tests: work partitioning from the master and worker CPU reports
+
+With `--master`/`--worker` every worker would otherwise fetch the
+capabilities on its own and pick its share of the work from the locust worker
+index, which is not reused when a worker reconnects. On test start the master
+sends each worker a custom message with:
+
+- the capabilities documents it parsed, so the workers resolve the same layer,
+  tile matrix set and extent without any GetCapabilities request;
+- the slot of the worker among the workers of the test (0 to n - 1) and their
+  number n. The random streams of the users are derived from the slot and the
+  workload plans are split into n contiguous slices (utils.seeding).
+
+The client CPU of every worker (and of the master) is reported over time, a
+worker close to 100% CPU measures its own queueing instead of the server
+latency: more workers are needed.
+"""
+from typing import Dict, List
+import logging
+import time
+
+from utils import capabilities, reporting, seeding
+
+logger = logging.getLogger(__name__)
+
+# custom message type of the work partitioning
+WORKER_SETUP = "worker_setup"
+# CPU percent from which a worker is reported as client bound
+CPU_THRESHOLD = 80.0
+
+
+def is_worker(environment) -> bool:
+    return type(environment.runner).__name__ == "WorkerRunner"
+
+
+def is_master(environment) -> bool:
+    return type(environment.runner).__name__ == "MasterRunner"
+
+
+def register(environment):
+    """Handle the work partitioning message on workers, on init"""
+    if is_worker(environment):
+        environment.runner.register_message(WORKER_SETUP, on_worker_setup)
+
+
+def test_workers(runner) -> List:
+    """Worker nodes connected to the master and not missing, in locust worker index order"""
+    nodes = runner.clients.ready + runner.clients.spawning + runner.clients.running
+    return sorted(nodes, key=lambda node: runner.get_worker_index(node.id))
+
+
+def send_setup(environment):
+    """
+    Send the capabilities parsed by the master, the slot of each worker and
+    the users of the test, at the end of the master's test start: the
+    messages reach the workers before their spawn message.
+    """
+    if not is_master(environment):
+        return
+    documents = capabilities.capabilities_documents()
+    nodes = test_workers(environment.runner)
+    users = seeding.test_user_count(environment)
+    for slot, node in enumerate(nodes):
+        environment.runner.send_message(
+            WORKER_SETUP,
+            {"slot": slot, "workers": len(nodes), "users": users, "capabilities": documents},
+            client_id=node.id,
+        )
+    logger.info(f"Sent {len(documents)} capabilities documents and the work partitioning to {len(nodes)} workers")
+
+
+def on_worker_setup(environment, msg, **kwargs):
+    """Register the capabilities of the master, the slot of this worker and the users of the test"""
+    for document in msg.data["capabilities"]:
+        capabilities.register_capabilities(document["service"], document["url"], document["xml"])
+    seeding.assign_worker(msg.data["slot"], msg.data["workers"], msg.data.get("users") or None)
+    logger.info(
+        f"Worker slot {msg.data['slot']} of {msg.data['workers']} ({msg.data.get('users')} users in the test), "
+        f"{len(msg.data['capabilities'])} capabilities documents from the master"
+    )
+
+
+def label(worker) -> str:
+    """Name of a process in the logs, workers by their locust index"""
+    return f"worker {worker}" if isinstance(worker, int) else worker
+
+
+def cpu_samples(runner) -> List[Dict]:
+    """CPU, memory and users of the master (or local runner) and of every worker"""
+    distributed = type(runner).__name__ == "MasterRunner"
+    samples = [
+        {
+            "worker": "master" if distributed else "local",
+            "users": "" if distributed else runner.user_count,
+            "cpu": runner.current_cpu_usage,
+            "memory_mb": round(runner.current_memory_usage / 1e6, 1),
+        }
+    ]
+    if distributed:
+        for node in test_workers(runner):
+            samples.append(
+                {
+                    "worker": runner.get_worker_index(node.id),
+                    "users": node.user_count,
+                    "cpu": node.cpu_usage,
+                    "memory_mb": round(node.memory_usage / 1e6, 1),
+                }
+            )
+    return samples
+
+
+class WorkerCpuReporter(reporting.PeriodicReporter):
+    """
+    Log (and write to a CSV file) the client CPU of the master and of every
+    worker, and their peak at the end of the test.
+
+    Example:
+    reporter = WorkerCpuReporter(environment, interval=10, output="workers.csv")
+    reporter.start()
+    ...
+    reporter.stop()
+    """
+
+    title = "Client CPU report"
+
+    def report(self):
+        """Add the CPU of every process"""
+        timestamp = round(time.time(), 3)
+        samples = cpu_samples(self.environment.runner)
+        self.rows.extend({"timestamp": timestamp, **sample} for sample in samples)
+        logger.info(
+            "Client CPU: "
+            + ", ".join(
+                f"{label(sample['worker'])} {sample['cpu']:.0f}%" + (f" ({sample['users']} users)" if sample["users"] != "" else "")
+                for sample in samples
+            )
+        )
+
+    def peaks(self) -> Dict:
+        """Peak and mean CPU of every process"""
+        cpu: Dict = {}
+        for row in self.rows:
+            cpu.setdefault(row["worker"], []).append(row["cpu"])
+        return {worker: (max(values), sum(values) / len(values)) for worker, values in cpu.items()}
+
+    def summary(self):
+        """Log the peak CPU of every process"""
+        for worker, (peak, mean) in self.peaks().items():
+            message = f"Client CPU of {label(worker)}: peak {peak:.0f}%, mean {mean:.0f}%"
+            if peak >= CPU_THRESHOLD:
+                logger.warning(f"{message}, over {CPU_THRESHOLD:.0f}%: response times include client queueing, add workers")
+            else:
+                logger.info(message)
+
+
+def start_reporter(environment):
+    """
+    Start the client CPU reports of a test with --worker-report-interval, on
+    the master (or local) runner only, it receives the CPU of the workers with
+    their heartbeats.
+    """
+    options = environment.parsed_options
+    if getattr(options, "worker_report_interval", 0) <= 0 or is_worker(environment):
+        return
+    reporting.start(WorkerCpuReporter(environment, options.worker_report_interval, options.worker_report_output))
+
+
+def stop_reporter():
+    """Stop the client CPU reports"""
+    reporting.stop(WorkerCpuReporter)
+
+
+def add_arguments(parser):
+    """Add the client CPU report options to the locust command line parser"""
+    parser.add_argument(
+        "--worker-report-interval",
+        type=float,
+        default=0.0,
+        help="Seconds between two reports of the client CPU of the master and of every worker, with their peak at the end of the test. Defaults to 0, no report",
+    )
+    parser.add_argument(
+        "--worker-report-output",
+        type=str,
+        default=None,
+        help="CSV file of the client CPU reports (CPU, memory and users of every worker per interval)",
+    )
+
+
+# Example of function usage
+if __name__ == "__main__":
+    runner = type("LocalRunner", (), {"user_count": 10, "current_cpu_usage": 85.0, "current_memory_usage": 64e6})()
+    reporter = WorkerCpuReporter(type("", (), {"runner": runner})())
+    reporter.report()
+    runner.current_cpu_usage = 35.0
+    reporter.report()
+    assert reporter.peaks() == {"local": (85.0, 60.0)}
+    seeding.assign_worker(1, 3)
+    assert seeding.worker_index(None) == 1 and seeding.worker_count(None) == 3
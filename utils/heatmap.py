@@ -0,0 +1,544 @@
+"""Spatial latency heatmap: response times per tile or bbox cell
+
+Slow areas of a mosaic usually point to bad source files (uncompressed
+GeoTIFFs, missing overviews), but locust aggregates every GetMap or GetTile
+under one name. With --heatmap-output each response time is also recorded in a
+grid of cells over the layer:
+
+- WMTS, per TileMatrix: each cell holds a square block of tiles of its tile
+  range, one tile per cell when the range is small enough;
+- WMS, over the layer bbox: the cell of the bbox center.
+
+A grid is a fixed size accumulator of at most --heatmap-cells cells along its
+longest side (count, failures, sum, max and a histogram of BUCKETS per cell in
+`array` columns), 128 cells are below 1 MB whatever the size of the matrix
+(a 9325x16384 tiles level of PTTM_06 is 73x128 cells of 128x128 tiles). The
+grids are shared by the users of a process. The workers send the cells
+recorded since their last stats report with it, and the rest at test end, to
+the master, which merges them and writes CSV, GeoJSON (cell polygons in the
+CRS of the layer) and PNG (mean latency, with a world file) files.
+"""
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import array
+import csv
+import json
+import logging
+import math
+import os
+import struct
+import zlib
+
+import gevent
+
+from utils import distributed
+from utils.bbox_grid import BBoxGrid, tile_matrix_grid
+from utils.crs import crs_code
+
+logger = logging.getLogger(__name__)
+
+# custom message type of the grids of a worker at test end, and key of its grids in its stats reports
+HEATMAP = "heatmap"
+# upper bounds (ms) of the histogram buckets of a cell, the last bucket is above the last bound
+BUCKETS = (50, 100, 200, 500, 1000, 2000, 5000)
+# requests of a cell to be listed among the slowest ones
+MIN_REQUESTS = 3
+# seconds the master waits for the grids of the workers after its test stop
+WORKER_TIMEOUT = 10.0
+# PNG colour ramp, green at the first bucket bound and red at the last one (log scale)
+RAMP = ((26, 152, 80), (254, 224, 139), (215, 48, 39))
+
+
+class HeatmapError(ValueError):
+    """Custom exception for invalid heatmap outputs."""
+
+    pass
+
+
+class LatencyGrid:
+    """
+    Response times of the requests in each cell of a grid.
+
+    Example:
+    grid = LatencyGrid("PTTM_06/10", BBoxGrid(-100000, 300000, 1000, 1000, 1, 1), 128, 96, "EPSG:3763")
+    grid.add_point(-90500, 295500, 120.0)
+    grid.add(grid.cell_index(9, 4), 850.0, failed=True)
+    """
+
+    def __init__(
+        self,
+        name: str,
+        grid: BBoxGrid,
+        cols: int,
+        rows: int,
+        crs: Optional[str] = None,
+        tiles: Optional[Tuple[int, int, int]] = None,
+    ):
+        """
+        Parameters:
+        - name (str): Name of the grid, a TileMatrix or a layer.
+        - grid (BBoxGrid): Geometry of the cells, cell (0, 0) is the top left one.
+        - cols, rows (int): Number of cells.
+        - crs (str): Optional. CRS of the grid.
+        - tiles (tuple): Optional. (min_col, min_row, tiles per cell) of a tile grid,
+          cell (0, 0) starting at tile (min_col, min_row).
+        """
+        self.name = name
+        self.grid = grid
+        self.cols = cols
+        self.rows = rows
+        self.crs = crs
+        self.tiles = tiles
+        self.clear()
+
+    def clear(self):
+        """Empty every cell, e.g. once sent to the master"""
+        size = self.cols * self.rows
+        self.count = array.array("I", bytes(4 * size))
+        self.failures = array.array("I", bytes(4 * size))
+        self.total = array.array("d", bytes(8 * size))
+        self.max = array.array("d", bytes(8 * size))
+        self.histogram = array.array("I", bytes(4 * size * (len(BUCKETS) + 1)))
+
+    def cell_index(self, col: int, row: int) -> Optional[int]:
+        """Index of a cell, None outside the grid"""
+        if 0 <= col < self.cols and 0 <= row < self.rows:
+            return row * self.cols + col
+        return None
+
+    def add(self, index: Optional[int], response_time: float, failed: bool = False):
+        """Record a response time (ms) in a cell, nothing outside the grid"""
+        if index is None:
+            return
+        self.count[index] += 1
+        if failed:
+            self.failures[index] += 1
+        self.total[index] += response_time
+        if response_time > self.max[index]:
+            self.max[index] = response_time
+        bucket = 0
+        while bucket < len(BUCKETS) and response_time > BUCKETS[bucket]:
+            bucket += 1
+        self.histogram[index * (len(BUCKETS) + 1) + bucket] += 1
+
+    def add_point(self, x: float, y: float, response_time: float, failed: bool = False):
+        """Record a response time in the cell of a point, e.g. a bbox center"""
+        self.add(self.cell_index(*self.grid.cell(x, y)), response_time, failed)
+
+    def add_tile(self, tile_col: int, tile_row: int, response_time: float, failed: bool = False):
+        """Record a response time in the cell of a tile of a tile grid"""
+        min_col, min_row, tiles_per_cell = self.tiles
+        if tile_col < min_col or tile_row < min_row:
+            return
+        self.add(
+            self.cell_index((tile_col - min_col) // tiles_per_cell, (tile_row - min_row) // tiles_per_cell),
+            response_time,
+            failed,
+        )
+
+    def percentile(self, index: int, fraction: float) -> float:
+        """Upper bound of the bucket of a percentile of a cell, its max in the last bucket"""
+        offset = index * (len(BUCKETS) + 1)
+        target = fraction * self.count[index]
+        seen = 0
+        for bucket, bound in enumerate(BUCKETS):
+            seen += self.histogram[offset + bucket]
+            if seen >= target:
+                return min(bound, self.max[index])
+        return self.max[index]
+
+    def data(self) -> Dict:
+        """Grid and its non empty cells, as a message to the master"""
+        cells = [index for index, count in enumerate(self.count) if count]
+        width = len(BUCKETS) + 1
+        return {
+            "name": self.name,
+            "grid": list(self.grid),
+            "cols": self.cols,
+            "rows": self.rows,
+            "crs": self.crs,
+            "tiles": list(self.tiles) if self.tiles else None,
+            "cells": cells,
+            "count": [self.count[index] for index in cells],
+            "failures": [self.failures[index] for index in cells],
+            "total": [self.total[index] for index in cells],
+            "max": [self.max[index] for index in cells],
+            "histogram": [value for index in cells for value in self.histogram[index * width : (index + 1) * width]],
+        }
+
+    @classmethod
+    def from_data(cls, data: Dict) -> "LatencyGrid":
+        """Empty grid of the same cells as data()"""
+        return cls(
+            data["name"],
+            BBoxGrid(*data["grid"]),
+            data["cols"],
+            data["rows"],
+            data["crs"],
+            tuple(data["tiles"]) if data["tiles"] else None,
+        )
+
+    def merge(self, data: Dict):
+        """Add the cells of the data() of another process"""
+        width = len(BUCKETS) + 1
+        for position, index in enumerate(data["cells"]):
+            self.count[index] += data["count"][position]
+            self.failures[index] += data["failures"][position]
+            self.total[index] += data["total"][position]
+            self.max[index] = max(self.max[index], data["max"][position])
+            for bucket in range(width):
+                self.histogram[index * width + bucket] += data["histogram"][position * width + bucket]
+
+    def cell_rows(self) -> Iterator[Dict]:
+        """Statistics and bounds of the non empty cells"""
+        for index, count in enumerate(self.count):
+            if not count:
+                continue
+            row, col = divmod(index, self.cols)
+            minx, miny, maxx, maxy = self.grid.bbox(col, row)
+            cell = {"grid": self.name, "col": col, "row": row, "minx": minx, "miny": miny, "maxx": maxx, "maxy": maxy}
+            if self.tiles:
+                min_col, min_row, tiles_per_cell = self.tiles
+                cell.update(
+                    tile_cols=f"{min_col + col * tiles_per_cell}-{min_col + (col + 1) * tiles_per_cell - 1}",
+                    tile_rows=f"{min_row + row * tiles_per_cell}-{min_row + (row + 1) * tiles_per_cell - 1}",
+                )
+            else:
+                cell.update(tile_cols="", tile_rows="")
+            cell.update(
+                count=count,
+                failures=self.failures[index],
+                mean_ms=round(self.total[index] / count, 1),
+                max_ms=round(self.max[index], 1),
+                p50_ms=round(self.percentile(index, 0.5), 1),
+                p95_ms=round(self.percentile(index, 0.95), 1),
+            )
+            width = len(BUCKETS) + 1
+            buckets = self.histogram[index * width : (index + 1) * width]
+            cell.update({f"le_{bound}": value for bound, value in zip(BUCKETS, buckets)})
+            cell[f"gt_{BUCKETS[-1]}"] = buckets[-1]
+            yield cell
+
+
+def extent_grid(name: str, extent: Tuple[float, float, float, float], crs: Optional[str], cells: int) -> LatencyGrid:
+    """
+    Grid of square cells over an extent, at most `cells` along its longest side.
+    """
+    minx, miny, maxx, maxy = extent
+    span = max(maxx - minx, maxy - miny) / cells
+    return LatencyGrid(
+        name,
+        BBoxGrid(minx, maxy, span, span, 1, 1),
+        max(1, math.ceil((maxx - minx) / span)),
+        max(1, math.ceil((maxy - miny) / span)),
+        crs,
+    )
+
+
+def tile_grid(name: str, tile_matrix, crs: Optional[str], matrix_range: Tuple[int, int, int, int], cells: int) -> LatencyGrid:
+    """
+    Grid of blocks of tiles over the tile range of a TileMatrix, at most
+    `cells` along its longest side.
+
+    Parameters:
+    - name (str): Name of the grid.
+    - tile_matrix: owslib TileMatrix.
+    - crs (str): CRS of the TileMatrixSet.
+    - matrix_range (tuple): (min_col, max_col, min_row, max_row) of the requested tiles.
+    - cells (int): Maximum number of cells along the longest side.
+    """
+    min_col, max_col, min_row, max_row = matrix_range
+    tile_cols, tile_rows = max_col - min_col + 1, max_row - min_row + 1
+    tiles_per_cell = max(1, math.ceil(max(tile_cols, tile_rows) / cells))
+    tiles = tile_matrix_grid(tile_matrix, crs)
+    left, _, _, top = tiles.bbox(min_col, min_row)
+    return LatencyGrid(
+        name,
+        BBoxGrid(left, top, tiles.span_x * tiles_per_cell, tiles.span_y * tiles_per_cell, 1, 1),
+        math.ceil(tile_cols / tiles_per_cell),
+        math.ceil(tile_rows / tiles_per_cell),
+        crs,
+        (min_col, min_row, tiles_per_cell),
+    )
+
+
+# grids of the process, shared by its users, by name
+_grids: Dict[str, LatencyGrid] = {}
+# master only: workers of the test, workers whose grids were merged, test stopped before all of them
+_expected: Set[str] = set()
+_reported: Set[str] = set()
+_stopped = False
+
+
+def enabled(parsed_options) -> bool:
+    return bool(getattr(parsed_options, "heatmap_output", None))
+
+
+def layer_grid(name: str, extent: Tuple[float, float, float, float], crs: Optional[str], cells: int) -> LatencyGrid:
+    """Grid of a WMS layer of the process, created by its first user"""
+    if name not in _grids:
+        _grids[name] = extent_grid(name, extent, crs, cells)
+    return _grids[name]
+
+
+def tile_matrix_heatmap(name: str, tile_matrix, crs: Optional[str], matrix_range: Tuple[int, int, int, int], cells: int) -> LatencyGrid:
+    """Grid of a TileMatrix of the process, created by its first user"""
+    if name not in _grids:
+        _grids[name] = tile_grid(name, tile_matrix, crs, matrix_range, cells)
+    return _grids[name]
+
+
+def register(environment):
+    """
+    On init: workers send their cells with their stats reports (they only get
+    --heatmap-output with the spawn message), the master merges them and
+    writes its grids when it quits, if the last grids of some workers are
+    still missing.
+    """
+    runner_type = type(environment.runner).__name__
+    if runner_type == "WorkerRunner":
+        environment.events.report_to_master.add_listener(on_report_to_master)
+    elif runner_type == "MasterRunner" and enabled(environment.parsed_options):
+        environment.runner.register_message(HEATMAP, on_worker_heatmap)
+        environment.events.worker_report.add_listener(on_worker_report)
+
+        def on_quit(**kwargs):
+            # the master quits 0.5 s after the quit message of the workers (end of --run-time)
+            if _stopped:
+                logger.warning(
+                    f"No heatmap at test end from {len(_expected - _reported)} workers, "
+                    "writing their cells up to their last stats report"
+                )
+                write_merged(environment)
+
+        environment.events.quit.add_listener(on_quit)
+
+
+def start(environment):
+    """
+    On the master's test start, keep the workers of the test: the merged grids
+    are written once all of them sent theirs.
+    """
+    global _stopped
+    if type(environment.runner).__name__ != "MasterRunner" or not enabled(environment.parsed_options):
+        return
+    _grids.clear()
+    _expected.clear()
+    _expected.update(node.id for node in distributed.test_workers(environment.runner))
+    _reported.clear()
+    _stopped = False
+
+
+def merge(grids: List[Dict]):
+    """Add the data() of the grids of a worker to the grids of the master"""
+    for data in grids:
+        if data["name"] not in _grids:
+            _grids[data["name"]] = LatencyGrid.from_data(data)
+        _grids[data["name"]].merge(data)
+
+
+def on_report_to_master(client_id, data, **kwargs):
+    """Add the cells recorded since the last report to the stats report of a worker, they are cleared"""
+    grids = []
+    for grid in _grids.values():
+        if any(grid.count):
+            grids.append(grid.data())
+            grid.clear()
+    if grids:
+        data[HEATMAP] = grids
+
+
+def on_worker_report(client_id, data, **kwargs):
+    """Add the cells of the stats report of a worker to the grids of the master"""
+    merge(data.get(HEATMAP, []))
+
+
+def on_worker_heatmap(environment, msg, **kwargs):
+    """Add the last grids of a worker, at its test end, to the grids of the master"""
+    merge(msg.data["grids"])
+    _reported.add(msg.node_id)
+    logger.debug(f"Merged {len(msg.data['grids'])} heatmap grids of worker {msg.node_id}")
+    if _stopped and _expected <= _reported:
+        write_merged(environment)
+
+
+def rows(grids: List[LatencyGrid]) -> List[Dict]:
+    return [cell for grid in grids for cell in grid.cell_rows()]
+
+
+def write_csv(path: str, grids: List[LatencyGrid]):
+    """One row per non empty cell, with its bounds, statistics and histogram"""
+    cells = rows(grids)
+    with open(path, "w", encoding="utf-8", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=list(cells[0]) if cells else ["grid"])
+        writer.writeheader()
+        writer.writerows(cells)
+
+
+def write_geojson(path: str, grids: List[LatencyGrid]):
+    """
+    Cell polygons in the CRS of the grids, declared with the legacy "crs"
+    member unless they are in CRS84.
+    """
+    features = []
+    for cell in rows(grids):
+        minx, miny, maxx, maxy = cell.pop("minx"), cell.pop("miny"), cell.pop("maxx"), cell.pop("maxy")
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {
+                    "type": "Polygon",
+                    "coordinates": [[[minx, miny], [maxx, miny], [maxx, maxy], [minx, maxy], [minx, miny]]],
+                },
+                "properties": cell,
+            }
+        )
+    collection = {"type": "FeatureCollection", "features": features}
+    code = crs_code(grids[0].crs) if grids else None
+    if code and code != "CRS84":
+        collection["crs"] = {"type": "name", "properties": {"name": f"urn:ogc:def:crs:EPSG::{code}"}}
+    with open(path, "w", encoding="utf-8") as geojson_file:
+        json.dump(collection, geojson_file)
+
+
+def colour(mean: float) -> Tuple[int, int, int]:
+    """Ramp colour of a mean response time"""
+    low, high = math.log(BUCKETS[0]), math.log(BUCKETS[-1])
+    position = min(max((math.log(max(mean, 1e-3)) - low) / (high - low), 0.0), 1.0) * (len(RAMP) - 1)
+    start = min(int(position), len(RAMP) - 2)
+    fraction = position - start
+    return tuple(round(a + (b - a) * fraction) for a, b in zip(RAMP[start], RAMP[start + 1]))
+
+
+def png_bytes(width: int, height: int, pixels: bytes) -> bytes:
+    """RGBA PNG of rows of width * 4 bytes"""
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    raw = b"".join(b"\x00" + pixels[row * width * 4 : (row + 1) * width * 4] for row in range(height))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 9))
+        + chunk(b"IEND", b"")
+    )
+
+
+def write_png(path: str, grid: LatencyGrid):
+    """
+    Mean response time of every cell, one pixel per cell (empty cells are
+    transparent), and a world file (.pgw) to open it on a map.
+    """
+    pixels = bytearray(4 * grid.cols * grid.rows)
+    for index, count in enumerate(grid.count):
+        if count:
+            pixels[4 * index : 4 * index + 4] = bytes((*colour(grid.total[index] / count), 255))
+    with open(path, "wb") as png_file:
+        png_file.write(png_bytes(grid.cols, grid.rows, bytes(pixels)))
+    # pixel size, rotations and center of the top left pixel
+    world = (grid.grid.span_x, 0, 0, -grid.grid.span_y, grid.grid.left + grid.grid.span_x / 2, grid.grid.top - grid.grid.span_y / 2)
+    with open(os.path.splitext(path)[0] + ".pgw", "w", encoding="utf-8") as world_file:
+        world_file.write("\n".join(repr(float(value)) for value in world) + "\n")
+
+
+def write_outputs(outputs: str, grids: List[LatencyGrid]):
+    """
+    Write the comma separated --heatmap-output files, by extension: .csv,
+    .geojson (or .json) and .png (one per grid, suffixed with the grid name
+    when there are several).
+    """
+    for path in (path.strip() for path in outputs.split(",") if path.strip()):
+        base, extension = os.path.splitext(path)
+        extension = extension.lower()
+        if extension == ".csv":
+            write_csv(path, grids)
+        elif extension in (".geojson", ".json"):
+            write_geojson(path, grids)
+        elif extension == ".png":
+            for grid in grids:
+                suffix = "_" + "".join(c if c.isalnum() else "_" for c in grid.name) if len(grids) > 1 else ""
+                write_png(f"{base}{suffix}{extension}", grid)
+        else:
+            raise HeatmapError(f"Heatmap output must be a .csv, .geojson or .png file, got {path}")
+        logger.info(f"Heatmap written to {path}")
+
+
+def log_slowest(grids: List[LatencyGrid], count: int = 5):
+    """Log the cells with the highest mean response time"""
+    cells = sorted(
+        (cell for cell in rows(grids) if cell["count"] >= MIN_REQUESTS), key=lambda cell: cell["mean_ms"], reverse=True
+    )
+    for cell in cells[:count]:
+        tiles = f" (tiles {cell['tile_cols']} x {cell['tile_rows']})" if cell["tile_cols"] else ""
+        logger.info(
+            f"Slow cell {cell['grid']} {cell['col']},{cell['row']}{tiles} "
+            f"bbox {cell['minx']:.6g},{cell['miny']:.6g},{cell['maxx']:.6g},{cell['maxy']:.6g}: "
+            f"mean {cell['mean_ms']:.0f} ms, p95 <= {cell['p95_ms']:.0f} ms, max {cell['max_ms']:.0f} ms, {cell['count']} requests"
+        )
+
+
+def write_merged(environment):
+    """Log the slowest cells and write the --heatmap-output files, then clear the grids"""
+    global _stopped
+    _stopped = False
+    grids = list(_grids.values())
+    if grids:
+        log_slowest(grids)
+        write_outputs(environment.parsed_options.heatmap_output, grids)
+    else:
+        logger.info("No heatmap cells recorded")
+    _grids.clear()
+
+
+def finish(environment):
+    """
+    On test stop: workers send the rest of their grids to the master, the
+    local runner writes its grids. The master writes the merged grids when
+    every worker of the test sent its last grids: when the test is stopped
+    they arrive before the master's test stop, when it quits (end of
+    --run-time) just after it, or not before the master exits when the
+    workers take more than 0.5 s to stop their users; the master then writes
+    the cells of their stats reports when it quits.
+    """
+    global _stopped
+    if not enabled(environment.parsed_options):
+        return
+    runner_type = type(environment.runner).__name__
+    if runner_type == "WorkerRunner":
+        environment.runner.send_message(HEATMAP, {"grids": [grid.data() for grid in _grids.values()]})
+        _grids.clear()
+    elif runner_type == "MasterRunner" and not _expected <= _reported:
+        logger.info(f"Waiting for the heatmaps of {len(_expected - _reported)} workers")
+        _stopped = True
+        # workers lost during the test never send theirs
+        gevent.spawn_later(WORKER_TIMEOUT, lambda: _stopped and write_merged(environment))
+    else:
+        write_merged(environment)
+
+
+# Example of class usage
+if __name__ == "__main__":
+    grid = extent_grid("layer", (0.0, 0.0, 1000.0, 500.0), "EPSG:3763", 10)
+    assert (grid.cols, grid.rows) == (10, 5)
+    grid.add_point(50.0, 450.0, 40.0)
+    grid.add_point(60.0, 460.0, 700.0, failed=True)
+    grid.add_point(5000.0, 0.0, 10.0)  # outside of the grid
+    (cell,) = grid.cell_rows()
+    assert (cell["col"], cell["row"], cell["count"], cell["failures"], cell["mean_ms"]) == (0, 0, 2, 1, 370.0)
+    assert cell["p50_ms"] == 50 and cell["p95_ms"] == 700 and cell["le_1000"] == 1
+    merged = LatencyGrid.from_data(grid.data())
+    merged.merge(grid.data())
+    merged.merge(grid.data())
+    assert list(merged.count) == [2 * count for count in grid.count]
+    tiles = LatencyGrid("matrix", BBoxGrid(0, 0, 1, 1, 1, 1), 4, 4, tiles=(100, 200, 64))
+    tiles.add_tile(100 + 64 * 3 + 5, 200 + 10, 80.0)
+    assert tiles.count[3] == 1
+    assert colour(BUCKETS[0]) == RAMP[0] and colour(BUCKETS[-1]) == RAMP[-1]
+    # stats reports of a worker carry the cells since the previous report
+    _grids[grid.name] = grid
+    report = {}
+    on_report_to_master("worker", report)
+    assert sum(grid.count) == 0 and report[HEATMAP][0]["count"] == [2]
+    report = {}
+    on_report_to_master("worker", report)
+    assert HEATMAP not in report
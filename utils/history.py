@@ -0,0 +1,298 @@
+"""Run history in SQLite and regression detection
+
+The cron benchmarks write one HTML report and one log per run, with no way to
+follow a service over time. With --history-db every run of wms.py/wmts.py
+appends one summary row to a SQLite database: its configuration (service,
+host, layer, tile matrix set and matrix, bbox area, users, seed) and its
+results (requests per second, latency percentiles, error rate, bytes).
+
+The latency percentiles come from the locust response time histogram, which
+keeps two significant digits per bucket (like an HDR histogram), and the
+histogram itself is stored compressed, so other percentiles or merged
+distributions can be computed later.
+
+Runs of the same configuration share a `config_key`. A run is a regression
+when one of its metrics is outside the one-sided 95% prediction interval of
+the previous N runs of its configuration (mean plus t * s * sqrt(1 + 1/N)),
+and changed by more than a minimum effect (10% by default), so the noise of a
+stable service is not reported:
+
+python -m utils.history compare reports/history.sqlite --last 10
+
+Each run is a single indexed insert, the comparison reads the last N rows of
+one configuration, so both stay cheap with years of history.
+"""
+from typing import Dict, List, Optional
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import sqlite3
+import statistics
+import time
+import zlib
+
+from locust.stats import calculate_response_time_percentile
+
+from utils.capacity import EXCLUDED_REQUEST_TYPES
+
+logger = logging.getLogger(__name__)
+
+# configuration columns, the runs of the same values are compared (the seed changes between runs)
+CONFIG_COLUMNS = ("service", "host", "layer", "tile_matrix_set", "tile_matrix", "bbox_area", "users")
+RESULT_COLUMNS = ("duration", "requests", "failures", "error_rate", "rps", "p50", "p90", "p95", "p99", "max", "bytes")
+# metric, +1 when higher is worse, -1 when lower is worse
+COMPARED_METRICS = (("p50", 1), ("p95", 1), ("p99", 1), ("rps", -1), ("error_rate", 1))
+# one-sided 95% Student t quantiles by degrees of freedom, 1.645 (normal) above
+T_QUANTILES = {1: 6.314, 2: 2.920, 3: 2.353, 4: 2.132, 5: 2.015, 6: 1.943, 7: 1.895, 8: 1.860, 9: 1.833,
+               10: 1.812, 12: 1.782, 15: 1.753, 20: 1.725, 25: 1.708, 30: 1.697}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    config_key TEXT NOT NULL,
+    service TEXT, host TEXT, layer TEXT, tile_matrix_set TEXT, tile_matrix TEXT, bbox_area REAL, users INTEGER,
+    seed INTEGER,
+    duration REAL, requests INTEGER, failures INTEGER, error_rate REAL, rps REAL,
+    p50 REAL, p90 REAL, p95 REAL, p99 REAL, max REAL, bytes INTEGER,
+    histogram BLOB
+);
+CREATE INDEX IF NOT EXISTS runs_config ON runs (config_key, started);
+"""
+
+
+class HistoryError(Exception):
+    """Custom exception for run history errors."""
+
+    pass
+
+
+def config_key(config: Dict) -> str:
+    """Key of a configuration, the same for every run of the same configuration columns"""
+    values = json.dumps([config.get(column) for column in CONFIG_COLUMNS])
+    return hashlib.sha1(values.encode("utf-8")).hexdigest()[:16]
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Open (and create) a history database, runs of overlapping cron jobs wait for each other"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    connection = sqlite3.connect(path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def encode_histogram(response_times: Dict[int, int]) -> bytes:
+    """Compressed locust response time histogram (rounded ms: count)"""
+    return zlib.compress(json.dumps(sorted(response_times.items())).encode("utf-8"))
+
+
+def decode_histogram(blob: bytes) -> Dict[int, int]:
+    return {int(response_time): count for response_time, count in json.loads(zlib.decompress(blob))}
+
+
+def run_summary(stats) -> Dict:
+    """
+    Results of a run from locust RequestStats: the requests to the server
+    only, without the entries of the open loop, viewports and client saturation.
+    """
+    requests = failures = content_length = 0
+    response_times: Dict[int, int] = {}
+    start = end = None
+    for entry in stats.entries.values():
+        if entry.method in EXCLUDED_REQUEST_TYPES:
+            continue
+        requests += entry.num_requests
+        failures += entry.num_failures
+        content_length += entry.total_content_length
+        for response_time, count in entry.response_times.items():
+            response_times[response_time] = response_times.get(response_time, 0) + count
+        if entry.num_requests:
+            start = entry.start_time if start is None else min(start, entry.start_time)
+            end = entry.last_request_timestamp if end is None else max(end, entry.last_request_timestamp)
+    duration = max(end - start, 1e-9) if start is not None else 0.0
+    answered = sum(response_times.values())
+    percentile = lambda fraction: calculate_response_time_percentile(response_times, answered, fraction) if answered else 0
+    return {
+        "duration": round(duration, 3),
+        "requests": requests,
+        "failures": failures,
+        "error_rate": failures / requests if requests else 0.0,
+        "rps": requests / duration if duration else 0.0,
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p95": percentile(0.95),
+        "p99": percentile(0.99),
+        "max": max(response_times) if response_times else 0,
+        "bytes": content_length,
+        "response_times": response_times,
+    }
+
+
+def append_run(connection: sqlite3.Connection, config: Dict, summary: Dict, seed: Optional[int] = None, started: Optional[float] = None) -> int:
+    """Insert one run, returns its id"""
+    row = {column: config.get(column) for column in CONFIG_COLUMNS}
+    row.update({column: summary[column] for column in RESULT_COLUMNS})
+    row.update(
+        started=started if started is not None else time.time(),
+        config_key=config_key(config),
+        seed=seed,
+        histogram=encode_histogram(summary.get("response_times", {})),
+    )
+    columns = ", ".join(row)
+    with connection:
+        cursor = connection.execute(f"INSERT INTO runs ({columns}) VALUES ({', '.join('?' * len(row))})", list(row.values()))
+    return cursor.lastrowid
+
+
+def record(environment, service: str):
+    """
+    Append the summary of the test to --history-db, on test stop, on the
+    master (or local) runner only.
+    """
+    options = environment.parsed_options
+    if not getattr(options, "history_db", None) or type(environment.runner).__name__ == "WorkerRunner":
+        return
+    summary = run_summary(environment.stats)
+    if not summary["requests"]:
+        return
+    config = {
+        "service": service,
+        "host": environment.host,
+        "layer": options.layer_name or None,
+        "tile_matrix_set": getattr(options, "tile_matrix_set", None),
+        "tile_matrix": getattr(options, "tile_matrix", None),
+        "bbox_area": getattr(options, "bbox_area", None) if service == "WMS" else None,
+        "users": options.num_users,
+    }
+    connection = connect(options.history_db)
+    try:
+        run_id = append_run(connection, config, summary, seed=options.random_seed)
+        logger.info(f"Run {run_id} appended to {options.history_db} (configuration {config_key(config)})")
+        if options.history_compare > 0:
+            for row in compare_run(connection, run_id, options.history_compare):
+                if row["regression"]:
+                    logger.warning(
+                        f"Regression of {row['metric']}: {row['value']:.2f} against {row['mean']:.2f} "
+                        f"(limit {row['limit']:.2f}) over the last {row['runs']} runs"
+                    )
+    finally:
+        connection.close()
+
+
+def t_quantile(degrees: int) -> float:
+    """One-sided 95% Student t quantile, of the nearest lower tabulated degrees of freedom"""
+    tabulated = [value for value in T_QUANTILES if value <= degrees]
+    return T_QUANTILES[max(tabulated)] if degrees <= max(T_QUANTILES) else 1.645
+
+
+def prediction_limit(values: List[float], direction: int) -> Optional[float]:
+    """Upper (direction 1) or lower (-1) one-sided 95% prediction limit of the next value"""
+    if len(values) < 2:
+        return None
+    mean = statistics.fmean(values)
+    spread = t_quantile(len(values) - 1) * statistics.stdev(values) * math.sqrt(1 + 1 / len(values))
+    return mean + direction * spread
+
+
+def compare_run(connection: sqlite3.Connection, run_id: int, last: int = 10, min_effect: float = 0.1) -> List[Dict]:
+    """
+    Compare a run with the previous `last` runs of its configuration.
+
+    Parameters:
+    - connection: History database.
+    - run_id (int): Compared run.
+    - last (int): Number of previous runs of the baseline.
+    - min_effect (float): Minimum relative change of a regression (absolute for the error rate).
+
+    Returns:
+    - One row per metric: value, baseline mean, limit, runs and regression flag.
+    """
+    run = connection.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+    if run is None:
+        raise HistoryError(f"No run {run_id}")
+    baseline = connection.execute(
+        "SELECT * FROM runs WHERE config_key = ? AND started < ? ORDER BY started DESC LIMIT ?",
+        (run["config_key"], run["started"], last),
+    ).fetchall()
+    rows = []
+    for metric, direction in COMPARED_METRICS:
+        values = [row[metric] for row in baseline if row[metric] is not None]
+        limit = prediction_limit(values, direction)
+        mean = statistics.fmean(values) if values else None
+        regression = False
+        if limit is not None:
+            change = (run[metric] - mean) * direction
+            effect = change if metric == "error_rate" else change / max(abs(mean), 1e-9)
+            regression = (run[metric] - limit) * direction > 0 and effect > (0.01 if metric == "error_rate" else min_effect)
+        rows.append(
+            {"metric": metric, "value": run[metric], "mean": mean, "limit": limit, "runs": len(values), "regression": regression}
+        )
+    return rows
+
+
+def latest_runs(connection: sqlite3.Connection, key: Optional[str] = None) -> List[sqlite3.Row]:
+    """Latest run of every configuration, or of one configuration"""
+    query = "SELECT * FROM runs WHERE id IN (SELECT id FROM runs r WHERE r.config_key = runs.config_key ORDER BY started DESC LIMIT 1)"
+    if key:
+        return connection.execute(query + " AND config_key = ?", (key,)).fetchall()
+    return connection.execute(query + " ORDER BY service, host, layer").fetchall()
+
+
+def format_comparison(run: sqlite3.Row, rows: List[Dict]) -> str:
+    """Comparison table of one run"""
+    lines = [
+        f"{run['service']} {run['host']} {run['layer'] or ''} {run['tile_matrix'] or ''} "
+        f"{run['users']} users, run {run['id']} ({time.strftime('%Y-%m-%d %H:%M', time.localtime(run['started']))}, "
+        f"configuration {run['config_key']})",
+        f"  {'metric':<10} {'value':>10} {'mean':>10} {'limit':>10} {'runs':>5}",
+    ]
+    for row in rows:
+        mean = f"{row['mean']:.3f}" if row["mean"] is not None else "-"
+        limit = f"{row['limit']:.3f}" if row["limit"] is not None else "-"
+        flag = "  REGRESSION" if row["regression"] else ""
+        lines.append(f"  {row['metric']:<10} {row['value']:>10.3f} {mean:>10} {limit:>10} {row['runs']:>5}{flag}")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Command line of the history database, exits with 1 when a regression is found"""
+    parser = argparse.ArgumentParser(description="Benchmark run history: list the configurations and compare their last run")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    list_parser = subparsers.add_parser("list", help="Configurations and their number of runs")
+    list_parser.add_argument("database", help="SQLite history database (--history-db)")
+    compare_parser = subparsers.add_parser("compare", help="Compare the last run of each configuration with the previous ones")
+    compare_parser.add_argument("database", help="SQLite history database (--history-db)")
+    compare_parser.add_argument("--last", type=int, default=10, help="Number of previous runs of the baseline. Defaults to 10")
+    compare_parser.add_argument("--min-effect", type=float, default=0.1, help="Minimum relative change of a regression. Defaults to 0.1")
+    compare_parser.add_argument("--config", default=None, help="Only compare this configuration key")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.database):
+        raise SystemExit(f"No history database {args.database}")
+    connection = connect(args.database)
+    if args.command == "list":
+        for row in connection.execute(
+            "SELECT config_key, service, host, layer, tile_matrix, users, COUNT(*) AS runs, MAX(started) AS last "
+            "FROM runs GROUP BY config_key ORDER BY service, host, layer"
+        ):
+            print(
+                f"{row['config_key']} {row['service']} {row['host']} {row['layer'] or ''} {row['tile_matrix'] or ''} "
+                f"{row['users']} users: {row['runs']} runs, last {time.strftime('%Y-%m-%d %H:%M', time.localtime(row['last']))}"
+            )
+        return 0
+    regressions = 0
+    for run in latest_runs(connection, args.config):
+        rows = compare_run(connection, run["id"], args.last, args.min_effect)
+        regressions += sum(row["regression"] for row in rows)
+        print(format_comparison(run, rows))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
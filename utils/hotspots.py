@@ -0,0 +1,253 @@
+"""Spatially weighted (hotspot) workloads
+
+Real traffic concentrates on a few areas (cities, the coast), uniform bboxes
+and tiles give cache hit rates and latencies that do not match production.
+Request centres (WMS) or tiles (WMTS) are drawn instead from weighted items,
+read from a file in the CRS of the layer (WMS) or of the TileMatrixSet (WMTS):
+
+- an ESRI ASCII grid (.asc) of weights, e.g. a population raster, a random
+  point is drawn in the chosen cell;
+- a CSV of weighted points with x,y,weight columns, e.g. city centres;
+- a CSV of ranked tiles with tilematrix,tilecol,tilerow columns (WMTS only),
+  most requested first, e.g. from the access logs.
+
+With a Zipf exponent the weights are replaced by 1/rank^exponent, the rank
+being the file order of a CSV or the decreasing weight of a grid cell.
+Items are drawn in O(1) with an alias table (Vose's method) built once per
+process, each user has its own random stream.
+"""
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import array
+import csv
+import logging
+import math
+import random
+
+from utils.bbox_grid import tile_matrix_grid
+
+logger = logging.getLogger(__name__)
+
+
+class HotspotError(ValueError):
+    """Custom exception for invalid hotspot files."""
+
+    pass
+
+
+class AliasTable:
+    """
+    Discrete distribution over range(len(weights)) drawn in O(1) (Vose's alias method).
+
+    Example:
+    table = AliasTable([10, 1, 1])
+    index = table.sample(rng)  # 0 five times out of six
+    """
+
+    def __init__(self, weights: Sequence[float]):
+        count = len(weights)
+        total = math.fsum(weights)
+        if count == 0 or total <= 0:
+            raise HotspotError("Hotspot weights must have at least one positive weight")
+        if min(weights) < 0:
+            raise HotspotError("Hotspot weights must not be negative")
+
+        self.probability = array.array("d", (weight * count / total for weight in weights))
+        self.alias = array.array("I", bytes(4 * count))
+        small = [index for index, probability in enumerate(self.probability) if probability < 1.0]
+        large = [index for index, probability in enumerate(self.probability) if probability >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.alias[less] = more
+            self.probability[more] -= 1.0 - self.probability[less]
+            (small if self.probability[more] < 1.0 else large).append(more)
+        # left overs are 1.0 up to rounding errors
+        for index in small + large:
+            self.probability[index] = 1.0
+
+    def __len__(self) -> int:
+        return len(self.probability)
+
+    def sample(self, rng: random.Random) -> int:
+        index = rng.randrange(len(self.probability))
+        return index if rng.random() < self.probability[index] else self.alias[index]
+
+
+def zipf_weights(count: int, exponent: float) -> List[float]:
+    """Weights 1/rank^exponent of `count` ranked items, rank 1 first"""
+    return [1.0 / rank**exponent for rank in range(1, count + 1)]
+
+
+class WeightGrid:
+    """Grid of weights, cell (0, 0) is the top left one"""
+
+    def __init__(self, minx: float, maxy: float, cell_size: float, cols: int, rows: int, weights: Sequence[float]):
+        if len(weights) != cols * rows:
+            raise HotspotError(f"Hotspot grid has {len(weights)} values, expected {cols} x {rows}")
+        self.minx = minx
+        self.maxy = maxy
+        self.cell_size = cell_size
+        self.cols = cols
+        self.rows = rows
+        self.weights = weights
+
+    def cell_bbox(self, index: int) -> Tuple[float, float, float, float]:
+        """(minx, miny, maxx, maxy) of the cell at row major `index`"""
+        row, col = divmod(index, self.cols)
+        minx = self.minx + col * self.cell_size
+        maxy = self.maxy - row * self.cell_size
+        return minx, maxy - self.cell_size, minx + self.cell_size, maxy
+
+
+def read_ascii_grid(path: str) -> WeightGrid:
+    """
+    Read an ESRI ASCII grid (.asc) of weights, NODATA cells have no weight.
+    """
+    header: Dict[str, float] = {}
+    values: List[float] = []
+    with open(path, encoding="utf-8") as grid_file:
+        for line in grid_file:
+            parts = line.split()
+            if not parts:
+                continue
+            if not values and parts[0][0].isalpha():
+                header[parts[0].lower()] = float(parts[1])
+            else:
+                values.extend(float(value) for value in parts)
+    try:
+        cols, rows, cell_size = int(header["ncols"]), int(header["nrows"]), header["cellsize"]
+        if "xllcenter" in header:
+            minx, miny = header["xllcenter"] - cell_size / 2, header["yllcenter"] - cell_size / 2
+        else:
+            minx, miny = header["xllcorner"], header["yllcorner"]
+    except KeyError as e:
+        raise HotspotError(f"{path} is not an ESRI ASCII grid, missing {e}")
+    nodata = header.get("nodata_value")
+    weights = [0.0 if value == nodata or value < 0 else value for value in values]
+    return WeightGrid(minx, miny + rows * cell_size, cell_size, cols, rows, weights)
+
+
+def read_csv(path: str) -> Tuple[List[tuple], List[float]]:
+    """
+    Read a CSV of weighted points (x,y[,weight]) or ranked tiles
+    (tilematrix,tilecol,tilerow[,weight]), items without weight get 1.
+
+    Returns:
+    - The items, (x, y) points or (tilematrix, tilecol, tilerow) tiles, in file order.
+    - Their weights.
+    """
+    items, weights = [], []
+    with open(path, encoding="utf-8", newline="") as csv_file:
+        reader = csv.DictReader(csv_file)
+        fields = {field.strip().lower(): field for field in reader.fieldnames or []}
+        if {"x", "y"} <= fields.keys():
+            columns, kind = ("x", "y"), float
+        elif {"tilematrix", "tilecol", "tilerow"} <= fields.keys():
+            columns, kind = ("tilematrix", "tilecol", "tilerow"), None
+        else:
+            raise HotspotError(f"{path} must have x,y or tilematrix,tilecol,tilerow columns")
+        for line in reader:
+            values = [line[fields[column]].strip() for column in columns]
+            if kind is float:
+                items.append((float(values[0]), float(values[1])))
+            else:
+                items.append((values[0], int(values[1]), int(values[2])))
+            weights.append(float(line[fields["weight"]]) if "weight" in fields else 1.0)
+    return items, weights
+
+
+class Hotspots:
+    """
+    Weighted items of a hotspot file and their alias table, read once per process.
+    """
+
+    def __init__(self, path: str, zipf: Optional[float] = None):
+        """
+        Parameters:
+        - path (str): .asc weight grid or .csv weighted points or ranked tiles.
+        - zipf (float): Optional. Zipf exponent, weights are replaced by 1/rank^zipf.
+        """
+        self.path = path
+        self.grid: Optional[WeightGrid] = None
+        if path.lower().endswith(".asc"):
+            self.grid = read_ascii_grid(path)
+            weights = list(self.grid.weights)
+            # cells with weight only, in decreasing weight (the Zipf ranking)
+            self.items = sorted((index for index, weight in enumerate(weights) if weight > 0), key=lambda index: -weights[index])
+            weights = [weights[index] for index in self.items]
+        else:
+            self.items, weights = read_csv(path)
+        if zipf is not None:
+            weights = zipf_weights(len(self.items), zipf)
+        self.table = AliasTable(weights)
+        self.has_tiles = self.grid is None and bool(self.items) and isinstance(self.items[0][0], str)
+        logger.info(f"Hotspots {path}: {len(self.items)} weighted {'tiles' if self.has_tiles else 'areas'}")
+
+    def points(self, rng: random.Random, radius: float = 0.0) -> Iterator[Tuple[float, float]]:
+        """
+        Yield (x, y) points: uniform in the drawn grid cell, or the drawn point
+        moved by up to `radius` in x and y.
+        """
+        if self.has_tiles:
+            raise HotspotError(f"{self.path} has ranked tiles, not points")
+        while True:
+            item = self.items[self.table.sample(rng)]
+            if self.grid is not None:
+                minx, miny, maxx, maxy = self.grid.cell_bbox(item)
+                yield rng.uniform(minx, maxx), rng.uniform(miny, maxy)
+            elif radius:
+                yield item[0] + rng.uniform(-radius, radius), item[1] + rng.uniform(-radius, radius)
+            else:
+                yield item
+
+    def ranked_tiles(self, rng: random.Random) -> Iterator[Tuple[str, int, int]]:
+        """Yield ranked (tilematrix, tilecol, tilerow) tiles"""
+        if not self.has_tiles:
+            raise HotspotError(f"{self.path} has no tilematrix,tilecol,tilerow columns")
+        while True:
+            yield self.items[self.table.sample(rng)]
+
+
+# Hotspots shared by the users of the process, key is (path, zipf)
+_hotspots: Dict[tuple, Hotspots] = {}
+
+
+def load_hotspots(path: str, zipf: Optional[float] = None) -> Hotspots:
+    """Return the hotspots of `path`, read once per process"""
+    key = (path, zipf)
+    if key not in _hotspots:
+        _hotspots[key] = Hotspots(path, zipf)
+    return _hotspots[key]
+
+
+def point_tiles(
+    points: Iterator[Tuple[float, float]],
+    tile_matrix,
+    matrix_range: Tuple[int, int, int, int],
+    crs: Optional[str] = None,
+) -> Iterator[Tuple[int, int]]:
+    """
+    Yield the (col, row) tile of each point on an owslib TileMatrix of the
+    TileMatrixSet CRS `crs` (x is the longitude in a geographic CRS), points
+    outside `matrix_range` (min_col, max_col, min_row, max_row) are moved to its border.
+    """
+    grid = tile_matrix_grid(tile_matrix, crs)
+    min_col, max_col, min_row, max_row = matrix_range
+    for x, y in points:
+        col, row = grid.cell(x, y)
+        yield min(max(col, min_col), max_col), min(max(row, min_row), max_row)
+
+
+# Example of class usage
+if __name__ == "__main__":
+    rng = random.Random(1640)
+    table = AliasTable([6, 3, 1, 0])
+    counts = [0] * 4
+    for _ in range(100000):
+        counts[table.sample(rng)] += 1
+    assert counts[3] == 0 and abs(counts[0] / 100000 - 0.6) < 0.01 and abs(counts[2] / 100000 - 0.1) < 0.01, counts
+
+    zipf = AliasTable(zipf_weights(1000, 1.0))
+    head = sum(zipf.sample(rng) < 10 for _ in range(100000)) / 100000
+    expected = sum(zipf_weights(10, 1.0)) / sum(zipf_weights(1000, 1.0))
+    assert abs(head - expected) < 0.01, (head, expected)
+    print(f"alias table frequencies {counts}, zipf top 10 share {head:.3f} (expected {expected:.3f})")
@@ -0,0 +1,280 @@
+"""Live Prometheus/OpenMetrics endpoint of the benchmark requests
+
+Long soak tests are only visible in the locust web UI or the final report.
+With --metrics-port the master (or local runner) serves a /metrics endpoint
+to be scraped by Prometheus, with a series per service, layer and TileMatrix
+(WMS requests have no TileMatrix):
+
+- ogc_benchmark_requests_total: requests, `rate()` is the request rate;
+- ogc_benchmark_failures_total: failed requests by error class, the HTTP
+  status (http_500) or the exception (ServiceExceptionError, BlankImageError,
+  ConnectionRefusedError...);
+- ogc_benchmark_response_bytes_total: body bytes, `rate()` is bytes per second;
+- ogc_benchmark_response_time_seconds: histogram of the response times;
+- ogc_benchmark_users: running users.
+
+The locust statistics can not be used: without a name every GetMap and GetTile
+URL is its own entry. The users add each request to the series of their layer
+(and TileMatrix) in O(1): counters and a fixed bucket histogram. Workers send
+the increments of their series to the master with their stats reports (every
+3 seconds), the master adds them to its own series. The counters only grow
+for the life of the process, Prometheus computes rates over them.
+"""
+from bisect import bisect_left
+from typing import Dict, List, Optional, Tuple
+import logging
+
+from gevent.pywsgi import WSGIServer
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "ogc_benchmark"
+# upper bounds of the response time histogram buckets, in ms, and +Inf
+BUCKETS = (25, 50, 100, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000)
+# key of the series increments in the stats reports of the workers
+REPORT_KEY = "ogc_metrics"
+
+PROMETHEUS_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+OPENMETRICS_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+class MetricsError(Exception):
+    """Custom exception for the metrics endpoint"""
+
+
+class Series:
+    """Requests, failures by error class, bytes and response time histogram of one layer (and TileMatrix)"""
+
+    __slots__ = ("requests", "bytes", "time_sum", "buckets", "failures")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.bytes = 0
+        # response times in ms
+        self.time_sum = 0.0
+        # count per bucket (not cumulative), the last one is +Inf
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.failures: Dict[str, int] = {}
+
+    def add(self, response_time: float, length: int = 0, error: Optional[str] = None):
+        """
+        Add one request.
+
+        Parameters:
+        - response_time (float): Response time in ms.
+        - length (int): Body size in bytes.
+        - error (str): Error class of a failed request, None when it succeeded.
+        """
+        self.requests += 1
+        self.bytes += length or 0
+        self.time_sum += response_time
+        self.buckets[bisect_left(BUCKETS, response_time)] += 1
+        if error is not None:
+            self.failures[error] = self.failures.get(error, 0) + 1
+
+    def data(self) -> List:
+        return [self.requests, self.bytes, self.time_sum, list(self.buckets), dict(self.failures)]
+
+    def merge(self, data: List):
+        """Add the values of another series (Series.data())"""
+        requests, length, time_sum, buckets, failures = data
+        if len(buckets) != len(self.buckets):
+            raise MetricsError(f"Histogram of {len(buckets)} buckets, expected {len(self.buckets)}")
+        self.requests += requests
+        self.bytes += length
+        self.time_sum += time_sum
+        for index, count in enumerate(buckets):
+            self.buckets[index] += count
+        for error, count in failures.items():
+            self.failures[error] = self.failures.get(error, 0) + count
+
+
+# series of the process by (service, layer, tile matrix)
+_series: Dict[Tuple[str, str, str], Series] = {}
+_server: Optional[WSGIServer] = None
+
+
+def series(service: str, layer: str, tile_matrix: str = "") -> Series:
+    """Series of a layer (and TileMatrix), created on its first request"""
+    key = (service, layer, tile_matrix)
+    found = _series.get(key)
+    if found is None:
+        found = _series[key] = Series()
+    return found
+
+
+def enabled(parsed_options) -> bool:
+    return getattr(parsed_options, "metrics_port", 0) > 0
+
+
+def error_class(response) -> Optional[str]:
+    """
+    Error class of a response after its `with` block: None when it succeeded,
+    the HTTP status for error statuses, otherwise the exception name.
+    """
+    exception = response.request_meta["exception"]
+    if exception is None:
+        return None
+    status = response.status_code or 0
+    if status >= 400:
+        return f"http_{status}"
+    return type(exception).__name__
+
+
+def drain() -> List:
+    """Increments of the series since the last call, which are reset"""
+    increments = []
+    for key, values in _series.items():
+        if values.requests:
+            increments.append([*key, values.data()])
+            values.reset()
+    return increments
+
+
+def on_report_to_master(client_id, data, **kwargs):
+    """Add the series increments to the stats report of a worker"""
+    increments = drain()
+    if increments:
+        data[REPORT_KEY] = increments
+
+
+def on_worker_report(client_id, data, **kwargs):
+    """Add the series increments of a worker to the series of the master"""
+    for service, layer, tile_matrix, values in data.get(REPORT_KEY, []):
+        series(service, layer, tile_matrix).merge(values)
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def labels(key: Tuple[str, str, str], **extra) -> str:
+    service, layer, tile_matrix = key
+    pairs = {"service": service, "layer": layer, **({"tile_matrix": tile_matrix} if tile_matrix else {}), **extra}
+    return "{" + ",".join(f'{name}="{escape(str(value))}"' for name, value in pairs.items()) + "}"
+
+
+def bound(value: float) -> str:
+    """Bucket bound in seconds"""
+    return f"{value / 1000:g}"
+
+
+def exposition(users: Optional[int] = None, openmetrics: bool = False) -> str:
+    """
+    Text exposition of the series of the process, in the Prometheus 0.0.4 text
+    format or in the OpenMetrics format.
+
+    Parameters:
+    - users (int): Optional. Running users.
+    - openmetrics (bool): OpenMetrics format: counter families without the
+      _total suffix and a final # EOF.
+    """
+    counter = (lambda name: name) if openmetrics else (lambda name: f"{name}_total")
+    lines = []
+    families = [
+        ("requests", "Requests sent", lambda values: [("", values.requests)]),
+        ("failures", "Failed requests by error class", lambda values: sorted(values.failures.items())),
+        ("response_bytes", "Response body bytes", lambda values: [("", values.bytes)]),
+    ]
+    keys = sorted(_series)
+    for family, help_text, samples in families:
+        name = f"{PREFIX}_{family}"
+        lines += [f"# HELP {counter(name)} {help_text}", f"# TYPE {counter(name)} counter"]
+        for key in keys:
+            for error, value in samples(_series[key]):
+                extra = {"error": error} if error else {}
+                lines.append(f"{name}_total{labels(key, **extra)} {value}")
+    name = f"{PREFIX}_response_time_seconds"
+    lines += [f"# HELP {name} Response time of the requests", f"# TYPE {name} histogram"]
+    for key in keys:
+        values = _series[key]
+        cumulative = 0
+        for upper, count in zip([*map(bound, BUCKETS), "+Inf"], values.buckets):
+            cumulative += count
+            lines.append(f"{name}_bucket{labels(key, le=upper)} {cumulative}")
+        lines.append(f"{name}_sum{labels(key)} {values.time_sum / 1000:.6f}")
+        lines.append(f"{name}_count{labels(key)} {values.requests}")
+    if users is not None:
+        name = f"{PREFIX}_users"
+        lines += [f"# HELP {name} Running users", f"# TYPE {name} gauge", f"{name} {users}"]
+    if openmetrics:
+        lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+
+def application(environment):
+    """WSGI application of the /metrics endpoint"""
+
+    def app(environ, start_response):
+        if environ.get("PATH_INFO") != "/metrics":
+            start_response("404 Not Found", [("Content-Type", "text/plain")])
+            return [b"Not found, the metrics are at /metrics\n"]
+        openmetrics = "application/openmetrics-text" in environ.get("HTTP_ACCEPT", "")
+        runner = environment.runner
+        body = exposition(runner.user_count if runner else None, openmetrics).encode()
+        start_response("200 OK", [("Content-Type", OPENMETRICS_TYPE if openmetrics else PROMETHEUS_TYPE)])
+        return [body]
+
+    return app
+
+
+def start_server(environment, port: int, host: str = "") -> WSGIServer:
+    """
+    Serve /metrics on a port, in the background of this process.
+
+    Parameters:
+    - environment: Locust environment, its runner gives the running users.
+    - port (int): Port, 0 for any free port.
+    - host (str): Interface, all of them by default.
+    """
+    global _server
+    _server = WSGIServer((host, port), application(environment), log=None)
+    _server.start()
+    logger.info(f"Metrics endpoint on http://{host or '0.0.0.0'}:{_server.server_port}/metrics")
+    return _server
+
+
+def stop_server():
+    global _server
+    if _server is not None:
+        _server.stop()
+        _server = None
+
+
+def register(environment):
+    """
+    On init: workers send their series with their stats reports (they only
+    get --metrics-port from the master with the spawn message, the reports
+    are empty without it). With --metrics-port the master adds them to its
+    own series and serves /metrics, like a local runner.
+    """
+    runner_type = type(environment.runner).__name__
+    if runner_type == "WorkerRunner":
+        environment.events.report_to_master.add_listener(on_report_to_master)
+        return
+    if not enabled(environment.parsed_options):
+        return
+    if runner_type == "MasterRunner":
+        environment.events.worker_report.add_listener(on_worker_report)
+    if _server is None:
+        start_server(environment, environment.parsed_options.metrics_port)
+
+
+# Example of function usage
+if __name__ == "__main__":
+    tiles = series("WMTS", "ortos", "06")
+    tiles.add(40, 20000)
+    tiles.add(120, 30000)
+    tiles.add(6000, 0, "http_500")
+    worker = drain()
+    assert tiles.requests == 0 and worker[0][:3] == ["WMTS", "ortos", "06"]
+    on_worker_report("worker", {REPORT_KEY: worker})
+    on_worker_report("worker", {REPORT_KEY: worker})
+    assert tiles.requests == 6 and tiles.failures == {"http_500": 2}
+    text = exposition(users=10)
+    assert 'ogc_benchmark_response_time_seconds_bucket{service="WMTS",layer="ortos",tile_matrix="06",le="0.05"} 2' in text
+    assert 'ogc_benchmark_failures_total{service="WMTS",layer="ortos",tile_matrix="06",error="http_500"} 2' in text
+    print(text)
@@ -0,0 +1,383 @@
+"""Local WMS/WMTS stand-in server
+
+A lightweight gevent WSGI server answering the requests of wms.py, wmts.py
+and mixed.py, to test the harness offline and measure how many requests per
+second one load generator can send:
+
+- GetCapabilities: a WMS 1.1.1 and a WMTS 1.0.0 document of a layer over
+  mainland Portugal (EPSG:3763, PTTM_06 like TileMatrixSet), with ETag and
+  304 Not Modified answers. With `layers` > 1 the documents get that many
+  layers (the "very large" variants of services with thousands of layers);
+- GetMap and GetTile: PNG or JPEG images of the requested size (the tile size
+  for GetTile), built once per size and format, compressible about 10 times
+  like imagery;
+- injection of a fixed latency with a random jitter, HTTP 500 errors, XML
+  ServiceExceptions (HTTP 200) and blank images, at configurable rates.
+
+In a test, start it in the current process:
+
+server = MockServer(latency=0.02, exception_rate=0.01).start()
+... server.wms_url, server.wmts_url ...
+server.stop()
+
+or in its own process, so it does not share the CPU of the load generator:
+
+python -m utils.mock_server --port 8080 --latency 0.02 --layers 5000
+"""
+from typing import Dict, Optional, Tuple
+import argparse
+import hashlib
+import logging
+import math
+import random
+import struct
+import zlib
+from urllib.parse import parse_qsl
+
+import gevent
+from gevent.pywsgi import WSGIServer
+
+from utils.bbox_grid import PIXEL_SIZE
+
+logger = logging.getLogger(__name__)
+
+# layer extent, EPSG:3763 and WGS84
+EXTENT = (-144205.734375, -326024.8125, 162129.09375, 276083.78125)
+WGS84_EXTENT = (-9.6, 36.9, -6.1, 42.2)
+LAYER = "mock"
+TILE_MATRIX_SET = "PTTM_06"
+TILE_SIZE = 256
+# scale denominator of the first TileMatrix, halved at each level
+TOP_SCALE = 2000000.0
+DEFAULT_LEVELS = 12
+# raw pixel size over image size of the served images (blank images are above utils.validation's 100)
+COMPRESSION_RATIO = 10
+
+
+class MockServerError(ValueError):
+    """Custom exception for invalid mock server settings."""
+
+    pass
+
+
+def wms_capabilities(url: str, layers: int = 1) -> bytes:
+    """WMS 1.1.1 GetCapabilities of the `mock` layer and `layers` - 1 others (mock1, mock2...)"""
+    minx, miny, maxx, maxy = EXTENT
+    lon_min, lat_min, lon_max, lat_max = WGS84_EXTENT
+    online = f'<OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="{url}?"/>'
+    body = [
+        f'<Layer queryable="1"><Name>{LAYER if index == 0 else f"{LAYER}{index}"}</Name><Title>Mock layer {index}</Title>'
+        f"<Abstract>Mock layer {index}</Abstract><SRS>EPSG:3763</SRS><SRS>EPSG:4326</SRS><SRS>EPSG:3857</SRS>"
+        f'<LatLonBoundingBox minx="{lon_min}" miny="{lat_min}" maxx="{lon_max}" maxy="{lat_max}"/>'
+        f'<BoundingBox SRS="EPSG:3763" minx="{minx}" miny="{miny}" maxx="{maxx}" maxy="{maxy}"/>'
+        f"<Style><Name>default</Name><Title>Default</Title></Style></Layer>"
+        for index in range(layers)
+    ]
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><WMT_MS_Capabilities version="1.1.1">'
+        f"<Service><Name>OGC:WMS</Name><Title>Mock WMS</Title>{online}</Service><Capability><Request>"
+        f"<GetCapabilities><Format>application/vnd.ogc.wms_xml</Format><DCPType><HTTP><Get>{online}</Get></HTTP></DCPType></GetCapabilities>"
+        f"<GetMap><Format>image/png</Format><Format>image/jpeg</Format><DCPType><HTTP><Get>{online}</Get></HTTP></DCPType></GetMap>"
+        "</Request><Exception><Format>application/vnd.ogc.se_xml</Format></Exception>"
+        f"<Layer><Title>Root</Title><SRS>EPSG:3763</SRS>{''.join(body)}</Layer></Capability></WMT_MS_Capabilities>"
+    ).encode("utf-8")
+
+
+def tile_matrices(levels: int = DEFAULT_LEVELS):
+    """(identifier, scale denominator, matrix width, matrix height) of the TileMatrixSet over the extent"""
+    minx, miny, maxx, maxy = EXTENT
+    for level in range(levels):
+        scale = TOP_SCALE / 2**level
+        span = scale * PIXEL_SIZE * TILE_SIZE
+        yield f"{level:02d}", scale, math.ceil((maxx - minx) / span), math.ceil((maxy - miny) / span)
+
+
+def wmts_capabilities(url: str, layers: int = 1, levels: int = DEFAULT_LEVELS) -> bytes:
+    """WMTS 1.0.0 GetCapabilities of the `mock` layer and `layers` - 1 others, on a PTTM_06 like TileMatrixSet"""
+    minx, _, _, maxy = EXTENT
+    lon_min, lat_min, lon_max, lat_max = WGS84_EXTENT
+    matrices = list(tile_matrices(levels))
+    limits = "".join(
+        f"<TileMatrixLimits><TileMatrix>{identifier}</TileMatrix><MinTileRow>0</MinTileRow><MaxTileRow>{height - 1}</MaxTileRow>"
+        f"<MinTileCol>0</MinTileCol><MaxTileCol>{width - 1}</MaxTileCol></TileMatrixLimits>"
+        for identifier, _, width, height in matrices
+    )
+    body = [
+        f"<Layer><ows:Title>Mock layer {index}</ows:Title><ows:WGS84BoundingBox><ows:LowerCorner>{lon_min} {lat_min}</ows:LowerCorner>"
+        f"<ows:UpperCorner>{lon_max} {lat_max}</ows:UpperCorner></ows:WGS84BoundingBox>"
+        f"<ows:Identifier>{LAYER if index == 0 else f'{LAYER}{index}'}</ows:Identifier>"
+        f'<Style isDefault="true"><ows:Identifier>default</ows:Identifier></Style><Format>image/png</Format><Format>image/jpeg</Format>'
+        f"<TileMatrixSetLink><TileMatrixSet>{TILE_MATRIX_SET}</TileMatrixSet><TileMatrixSetLimits>{limits}</TileMatrixSetLimits>"
+        f"</TileMatrixSetLink></Layer>"
+        for index in range(layers)
+    ]
+    tile_matrix_set = "".join(
+        f"<TileMatrix><ows:Identifier>{identifier}</ows:Identifier><ScaleDenominator>{scale}</ScaleDenominator>"
+        f"<TopLeftCorner>{minx} {maxy}</TopLeftCorner><TileWidth>{TILE_SIZE}</TileWidth><TileHeight>{TILE_SIZE}</TileHeight>"
+        f"<MatrixWidth>{width}</MatrixWidth><MatrixHeight>{height}</MatrixHeight></TileMatrix>"
+        for identifier, scale, width, height in matrices
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><Capabilities xmlns="http://www.opengis.net/wmts/1.0" '
+        'xmlns:ows="http://www.opengis.net/ows/1.1" xmlns:xlink="http://www.w3.org/1999/xlink" version="1.0.0">'
+        "<ows:ServiceIdentification><ows:Title>Mock WMTS</ows:Title><ows:ServiceType>OGC WMTS</ows:ServiceType>"
+        "<ows:ServiceTypeVersion>1.0.0</ows:ServiceTypeVersion></ows:ServiceIdentification><ows:OperationsMetadata>"
+        f'<ows:Operation name="GetTile"><ows:DCP><ows:HTTP><ows:Get xlink:href="{url}?"><ows:Constraint name="GetEncoding">'
+        "<ows:AllowedValues><ows:Value>KVP</ows:Value></ows:AllowedValues></ows:Constraint></ows:Get></ows:HTTP></ows:DCP>"
+        "</ows:Operation></ows:OperationsMetadata><Contents>"
+        + "".join(body)
+        + f"<TileMatrixSet><ows:Identifier>{TILE_MATRIX_SET}</ows:Identifier>"
+        f"<ows:SupportedCRS>urn:ogc:def:crs:EPSG::3763</ows:SupportedCRS>{tile_matrix_set}</TileMatrixSet>"
+        "</Contents></Capabilities>"
+    ).encode("utf-8")
+
+
+def png_image(width: int, height: int, blank: bool = False) -> bytes:
+    """
+    RGB PNG of noise with 2 significant bits per sample (about 10 times
+    compressible), or of a single colour when blank.
+    """
+    size = width * height * 3
+    if blank:
+        pixels = b"\x80\x40\x20" * (width * height)
+    else:
+        levels = bytes((value & 0xC0) | 0x20 for value in range(256))
+        pixels = random.Random(size).randbytes(size).translate(levels)
+    row = width * 3
+    raw = b"".join(b"\x00" + pixels[start : start + row] for start in range(0, size, row))
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(raw, 6))
+        + chunk(b"IEND", b"")
+    )
+
+
+def jpeg_image(width: int, height: int, blank: bool = False) -> bytes:
+    """
+    Baseline grey JPEG of the requested size. Each 8x8 block is a zero DC
+    difference and an end of block (one bit each, with single code Huffman
+    tables). Unless blank, comment segments pad it to the size of an image
+    about 10 times compressible.
+    """
+    segment = lambda marker, data: b"\xff" + bytes((marker,)) + struct.pack(">H", len(data) + 2) + data
+    blocks = math.ceil(width / 8) * math.ceil(height / 8)
+    # two zero bits per block, padded with one bits
+    scan = bytes(blocks * 2 // 8) + (bytes((0xFF >> (blocks * 2 % 8),)) if blocks * 2 % 8 else b"")
+    single_code = b"\x01" + bytes(15) + b"\x00"
+    head = (
+        b"\xff\xd8"
+        + segment(0xE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+        + segment(0xDB, b"\x00" + b"\x01" * 64)
+        + segment(0xC0, struct.pack(">BHHB", 8, height, width, 1) + b"\x01\x11\x00")
+        + segment(0xC4, b"\x00" + single_code)
+        + segment(0xC4, b"\x10" + single_code)
+    )
+    tail = segment(0xDA, b"\x01\x01\x00\x00\x3f\x00") + scan + b"\xff\xd9"
+    padding = b""
+    if not blank:
+        missing = width * height * 3 // COMPRESSION_RATIO - len(head) - len(tail)
+        comments = []
+        while missing > 4:
+            length = min(missing - 4, 65533)
+            comments.append(segment(0xFE, b"\x20" * length))
+            missing -= length + 4
+        padding = b"".join(comments)
+    return head + padding + tail
+
+
+def exception_report(service: str, code: str, message: str) -> bytes:
+    """WMS 1.1.1 ServiceExceptionReport or OWS ExceptionReport (WMTS)"""
+    if service == "WMTS":
+        return (
+            '<?xml version="1.0" encoding="UTF-8"?><ows:ExceptionReport xmlns:ows="http://www.opengis.net/ows/1.1" version="1.0.0">'
+            f'<ows:Exception exceptionCode="{code}"><ows:ExceptionText>{message}</ows:ExceptionText></ows:Exception></ows:ExceptionReport>'
+        ).encode("utf-8")
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><ServiceExceptionReport version="1.1.1">'
+        f'<ServiceException code="{code}">{message}</ServiceException></ServiceExceptionReport>'
+    ).encode("utf-8")
+
+
+class MockServer:
+    """
+    WMS/WMTS stand-in server, see the module documentation.
+
+    Example:
+    server = MockServer(latency=0.01).start()
+    requests.get(server.wms_url + "?SERVICE=WMS&REQUEST=GetCapabilities")
+    server.stop()
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        exception_rate: float = 0.0,
+        blank_rate: float = 0.0,
+        layers: int = 1,
+        levels: int = DEFAULT_LEVELS,
+        seed: Optional[int] = None,
+    ):
+        """
+        Parameters:
+        - host (str): Interface to listen on.
+        - port (int): Port, 0 for a free port (see `port` after start()).
+        - latency (float): Seconds before answering a GetMap or GetTile.
+        - jitter (float): Maximum random seconds added to the latency.
+        - error_rate (float): Fraction of the GetMap and GetTile answered with HTTP 500.
+        - exception_rate (float): Fraction answered with a ServiceException (HTTP 200).
+        - blank_rate (float): Fraction answered with a single colour image.
+        - layers (int): Number of layers of the capabilities documents.
+        - levels (int): Number of TileMatrix of the TileMatrixSet.
+        - seed (int): Optional. Seed of the injected latencies and failures.
+        """
+        for name, rate in (("error", error_rate), ("exception", exception_rate), ("blank", blank_rate)):
+            if not 0.0 <= rate <= 1.0:
+                raise MockServerError(f"The {name} rate must be between 0 and 1, got {rate}")
+        if layers < 1 or levels < 1:
+            raise MockServerError(f"The capabilities need at least one layer and one level, got {layers} and {levels}")
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.exception_rate = exception_rate
+        self.blank_rate = blank_rate
+        self.layers = layers
+        self.levels = levels
+        self.rng = random.Random(seed)
+        self.server: Optional[WSGIServer] = None
+        # requests of each REQUEST parameter (lowercase)
+        self.requests: Dict[str, int] = {}
+        self._capabilities: Dict[str, Tuple[bytes, str]] = {}
+        self._images: Dict[Tuple, bytes] = {}
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def wms_url(self) -> str:
+        return f"{self.url}/wms"
+
+    @property
+    def wmts_url(self) -> str:
+        return f"{self.url}/wmts"
+
+    def capabilities(self, service: str) -> Tuple[bytes, str]:
+        """Document of a service and its ETag, built on the first request"""
+        if service not in self._capabilities:
+            if service == "WMTS":
+                xml = wmts_capabilities(self.wmts_url, self.layers, self.levels)
+            else:
+                xml = wms_capabilities(self.wms_url, self.layers)
+            self._capabilities[service] = (xml, f'"{hashlib.sha1(xml).hexdigest()[:16]}"')
+        return self._capabilities[service]
+
+    def image(self, image_format: str, width: int, height: int, blank: bool) -> bytes:
+        key = (image_format, width, height, blank)
+        if key not in self._images:
+            build = jpeg_image if image_format == "image/jpeg" else png_image
+            self._images[key] = build(width, height, blank)
+        return self._images[key]
+
+    def app(self, environ, start_response):
+        """WSGI application, KVP requests only"""
+        params = {key.lower(): value for key, value in parse_qsl(environ.get("QUERY_STRING", ""))}
+        request = params.get("request", "").lower()
+        self.requests[request] = self.requests.get(request, 0) + 1
+        service = params.get("service", "WMTS" if "wmts" in environ.get("PATH_INFO", "").lower() else "WMS").upper()
+
+        if request == "getcapabilities":
+            xml, etag = self.capabilities(service)
+            if environ.get("HTTP_IF_NONE_MATCH") == etag:
+                start_response("304 Not Modified", [("ETag", etag)])
+                return [b""]
+            start_response("200 OK", [("Content-Type", "application/xml"), ("Content-Length", str(len(xml))), ("ETag", etag)])
+            return [xml]
+        if request not in ("getmap", "gettile"):
+            return self.respond_xml(start_response, exception_report(service, "OperationNotSupported", f"Unknown request {request}"), "400 Bad Request")
+
+        if self.latency or self.jitter:
+            gevent.sleep(self.latency + self.rng.uniform(0, self.jitter))
+        draw = self.rng.random()
+        if draw < self.error_rate:
+            start_response("500 Internal Server Error", [("Content-Type", "text/plain")])
+            return [b"Injected error"]
+        if draw < self.error_rate + self.exception_rate:
+            return self.respond_xml(start_response, exception_report(service, "NoApplicableCode", "Injected exception"))
+        try:
+            if request == "getmap":
+                width, height = int(params["width"]), int(params["height"])
+            else:
+                width = height = TILE_SIZE
+        except (KeyError, ValueError):
+            return self.respond_xml(start_response, exception_report(service, "MissingParameterValue", "WIDTH and HEIGHT are required"))
+        image_format = params.get("format", "image/png").split(";")[0].lower()
+        body = self.image(image_format, width, height, draw < self.error_rate + self.exception_rate + self.blank_rate)
+        start_response("200 OK", [("Content-Type", image_format), ("Content-Length", str(len(body)))])
+        return [body]
+
+    @staticmethod
+    def respond_xml(start_response, body: bytes, status: str = "200 OK"):
+        start_response(status, [("Content-Type", "application/vnd.ogc.se_xml"), ("Content-Length", str(len(body)))])
+        return [body]
+
+    def start(self) -> "MockServer":
+        """Serve in the background greenlets of the current process"""
+        self.server = WSGIServer((self.host, self.port), self.app, log=None)
+        self.server.start()
+        self.port = self.server.server_port
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.stop()
+            self.server = None
+
+    def serve_forever(self):
+        self.server = WSGIServer((self.host, self.port), self.app, log=None)
+        self.server.init_socket()
+        self.port = self.server.server_port
+        logger.info(f"Mock WMS at {self.wms_url}, WMTS at {self.wmts_url} (layer {LAYER}, TileMatrixSet {TILE_MATRIX_SET})")
+        self.server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local WMS/WMTS stand-in server for the benchmarks")
+    parser.add_argument("--host", default="127.0.0.1", help="Interface to listen on. Defaults to 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="Port. Defaults to 8080")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before answering a GetMap or GetTile. Defaults to 0")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random seconds added to the latency. Defaults to 0")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of HTTP 500 answers. Defaults to 0")
+    parser.add_argument("--exception-rate", type=float, default=0.0, help="Fraction of ServiceException answers. Defaults to 0")
+    parser.add_argument("--blank-rate", type=float, default=0.0, help="Fraction of single colour images. Defaults to 0")
+    parser.add_argument("--layers", type=int, default=1, help="Layers of the capabilities, e.g. 5000 for a very large document. Defaults to 1")
+    parser.add_argument("--levels", type=int, default=DEFAULT_LEVELS, help=f"TileMatrix of the TileMatrixSet. Defaults to {DEFAULT_LEVELS}")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the injected latencies and failures")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    MockServer(
+        args.host,
+        args.port,
+        args.latency,
+        args.jitter,
+        args.error_rate,
+        args.exception_rate,
+        args.blank_rate,
+        args.layers,
+        args.levels,
+        args.seed,
+    ).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
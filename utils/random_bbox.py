@@ -1,7 +1,12 @@
-from typing import Generator, Tuple
+from typing import Generator, Iterable, List, Optional, Tuple
 import random
 import math
 
+from utils.crs import center_latitude, crs_info, ground_size, varies_with_latitude
+
+# bboxes drawn per call of random_bboxes() by generate_random_bbox()
+BATCH_SIZE = 256
+
 
 class BBoxError(ValueError):
     """Custom exception for bounding box errors."""
@@ -9,6 +14,95 @@ class BBoxError(ValueError):
     pass
 
 
+def bbox_size(area: float, ratio: float) -> Tuple[float, float]:
+    """
+    Width and height in meters of a bbox of `area` square kilometers and
+    width/height `ratio`.
+    """
+    height_km = math.sqrt(area / ratio)
+    width_km = ratio * height_km
+    return width_km * 1000, height_km * 1000  # Convert km to meters
+
+
+def check_bbox_args(
+    full_bbox_minx: float, full_bbox_miny: float, full_bbox_maxx: float, full_bbox_maxy: float, area: float, ratio: float
+):
+    """Raise BBoxError if the full bounding box, area or ratio are invalid"""
+    if full_bbox_maxx <= full_bbox_minx or full_bbox_maxy <= full_bbox_miny:
+        raise BBoxError("Invalid full bounding box dimensions.")
+    if area <= 0:
+        raise BBoxError("Area must be greater than 0.")
+    if ratio <= 0:
+        raise BBoxError("Aspect ratio must be greater than 0.")
+
+
+def random_bboxes(
+    full_bbox_minx: float,
+    full_bbox_miny: float,
+    full_bbox_maxx: float,
+    full_bbox_maxy: float,
+    area: float,
+    ratio: float,
+    rng: random.Random,
+    count: int,
+    crs: Optional[str] = None,
+) -> List[Tuple[float, float, float, float]]:
+    """
+    Draw a batch of `count` random sub-bounding boxes of `area` square kilometres
+    on the ground within the full extent bounding box.
+
+    In a projected CRS the sides are converted from metres to CRS units once. In a
+    geographic CRS (x is the longitude, y the latitude) the height in degrees is
+    fixed and the width depends on the latitude of each bbox, so the ground area
+    stays the same at every latitude. In web mercator both sides depend on the
+    latitude of the bbox center, which is drawn first.
+
+    Parameters:
+    - full_bbox_minx, full_bbox_miny, full_bbox_maxx, full_bbox_maxy (float): Coordinates of the full extent bounding box.
+    - area (float): The area of the sub-bounding box in square kilometers.
+    - ratio (float): The width to height ratio of the sub-bounding box.
+    - rng (random.Random): Random number generator.
+    - count (int): Number of bboxes.
+    - crs (str): Optional. CRS of the bboxes, e.g. "EPSG:4326". Defaults to a projected CRS in metres.
+
+    Returns:
+    - A list of (minx, miny, maxx, maxy) tuples.
+    """
+    info = crs_info(crs)
+    width_m, height_m = bbox_size(area, ratio)
+    uniform = rng.uniform
+
+    if info.web_mercator:
+        bboxes = []
+        for _ in range(count):
+            center_y = uniform(full_bbox_miny, full_bbox_maxy)
+            side_length_x, side_length_y = ground_size(width_m, height_m, info, latitude=center_latitude(info, center_y))
+            y = min(max(center_y - side_length_y / 2, full_bbox_miny), max(full_bbox_maxy - side_length_y, full_bbox_miny))
+            x = uniform(full_bbox_minx, max(full_bbox_maxx - side_length_x, full_bbox_minx))
+            bboxes.append((x, y, x + side_length_x, y + side_length_y))
+        return bboxes
+
+    if not info.geographic:
+        side_length_x, side_length_y = ground_size(width_m, height_m, info)
+        max_start_x = full_bbox_maxx - side_length_x
+        max_start_y = full_bbox_maxy - side_length_y
+        starts = [
+            (uniform(full_bbox_minx, max_start_x), uniform(full_bbox_miny, max_start_y))
+            for _ in range(count)
+        ]
+        return [(x, y, x + side_length_x, y + side_length_y) for x, y in starts]
+
+    _, side_length_y = ground_size(width_m, height_m, info)
+    max_start_y = max(full_bbox_maxy - side_length_y, full_bbox_miny)
+    bboxes = []
+    for _ in range(count):
+        y = uniform(full_bbox_miny, max_start_y)
+        side_length_x, _ = ground_size(width_m, height_m, info, latitude=y + side_length_y / 2)
+        x = uniform(full_bbox_minx, max(full_bbox_maxx - side_length_x, full_bbox_minx))
+        bboxes.append((x, y, x + side_length_x, y + side_length_y))
+    return bboxes
+
+
 def generate_random_bbox(
     full_bbox_minx: float,
     full_bbox_miny: float,
@@ -17,6 +111,9 @@ def generate_random_bbox(
     seed: int,
     area: float,
     ratio: float,
+    rng: Optional[random.Random] = None,
+    crs: Optional[str] = None,
+    batch_size: int = BATCH_SIZE,
 ) -> Generator[Tuple[float, float, float, float], None, None]:
     """
     Generate a deterministic random sub-bounding box within a specified full extent bounding box.
@@ -26,6 +123,11 @@ def generate_random_bbox(
     - area (float): The area of the sub-bounding box in square kilometers (default is 10).
     - ratio (float): The width to height ratio of the sub-bounding box (default is 1.0, representing a square).
     - seed (int): Optional. A seed value for the random number generator to ensure deterministic output.
+    - rng (random.Random): Optional. Random number generator to use instead of one seeded with `seed`,
+      e.g. the per user stream from `utils.seeding.user_random`.
+    - crs (str): Optional. CRS of the full bounding box, the ground area is kept in
+      geographic CRS (x is then the longitude). Defaults to a projected CRS in metres.
+    - batch_size (int): Bboxes drawn at once by random_bboxes(), the sequence does not depend on it.
 
     Yields:
     - A tuple of floats representing the sub-bounding box in the format (minx, miny, maxx, maxy).
@@ -33,42 +135,66 @@ def generate_random_bbox(
     Raises:
     - BBoxError: If the full bounding box dimensions or the specified area are invalid.
     """
-    if seed is not None:
-        random.seed(
-            seed
-        )  # Seed the random number generator to ensure deterministic output
+    if rng is None:
+        # Own generator seeded to ensure deterministic output, the global random
+        # module state is shared by all simulated users
+        rng = random.Random(seed)
 
-    if full_bbox_maxx <= full_bbox_minx or full_bbox_maxy <= full_bbox_miny:
-        raise BBoxError("Invalid full bounding box dimensions.")
-    if area <= 0:
-        raise BBoxError("Area must be greater than 0.")
-    if ratio <= 0:
-        raise BBoxError("Aspect ratio must be greater than 0.")
-
-    height_km = math.sqrt(area / ratio)
-    width_km = ratio * height_km
-    side_length_x, side_length_y = (
-        width_km * 1000,
-        height_km * 1000,
-    )  # Convert km to meters
-
-    max_start_x = full_bbox_maxx - side_length_x
-    max_start_y = full_bbox_maxy - side_length_y
+    check_bbox_args(full_bbox_minx, full_bbox_miny, full_bbox_maxx, full_bbox_maxy, area, ratio)
 
     while True:
-        random_start_x = random.uniform(full_bbox_minx, max_start_x)
-        random_start_y = random.uniform(full_bbox_miny, max_start_y)
-
-        yield (
-            random_start_x,
-            random_start_y,
-            random_start_x + side_length_x,
-            random_start_y + side_length_y,
+        yield from random_bboxes(
+            full_bbox_minx, full_bbox_miny, full_bbox_maxx, full_bbox_maxy, area, ratio, rng, batch_size, crs
         )
 
 
+def generate_centered_bbox(
+    full_bbox_minx: float,
+    full_bbox_miny: float,
+    full_bbox_maxx: float,
+    full_bbox_maxy: float,
+    centers: Iterable[Tuple[float, float]],
+    area: float,
+    ratio: float,
+    crs: Optional[str] = None,
+) -> Generator[Tuple[float, float, float, float], None, None]:
+    """
+    Generate sub-bounding boxes centered on the given points (e.g. drawn from
+    hotspots), moved inside the full extent bounding box when needed.
+
+    Parameters:
+    - full_bbox_minx, full_bbox_miny, full_bbox_maxx, full_bbox_maxy (float): Coordinates of the full extent bounding box.
+    - centers (iterable): (x, y) centers of the sub-bounding boxes.
+    - area (float): The area of the sub-bounding box in square kilometers.
+    - ratio (float): The width to height ratio of the sub-bounding box.
+    - crs (str): Optional. CRS of the full bounding box, see generate_random_bbox().
+
+    Yields:
+    - A tuple of floats representing the sub-bounding box in the format (minx, miny, maxx, maxy).
+    """
+    check_bbox_args(full_bbox_minx, full_bbox_miny, full_bbox_maxx, full_bbox_maxy, area, ratio)
+
+    info = crs_info(crs)
+    width_m, height_m = bbox_size(area, ratio)
+    side_length_x, side_length_y = ground_size(width_m, height_m, info)
+    max_start_x = max(full_bbox_maxx - side_length_x, full_bbox_minx)
+    max_start_y = max(full_bbox_maxy - side_length_y, full_bbox_miny)
+
+    for x, y in centers:
+        if varies_with_latitude(info):
+            # the width in degrees (and the height in web mercator) depends on the latitude of the center
+            side_length_x, side_length_y = ground_size(width_m, height_m, info, latitude=center_latitude(info, y))
+            max_start_x = max(full_bbox_maxx - side_length_x, full_bbox_minx)
+            max_start_y = max(full_bbox_maxy - side_length_y, full_bbox_miny)
+        start_x = min(max(x - side_length_x / 2, full_bbox_minx), max_start_x)
+        start_y = min(max(y - side_length_y / 2, full_bbox_miny), max_start_y)
+        yield (start_x, start_y, start_x + side_length_x, start_y + side_length_y)
+
+
 # Example of function usage and testing
 if __name__ == "__main__":
+    from utils.crs import web_mercator_latitude
+
     try:
         test1 = {"area": 5, "ratio": 1.2, "seed": 42}
         test1_result = (
@@ -82,6 +208,28 @@ if __name__ == "__main__":
         )
         assert test1_result == next(bbox_generator)
 
+        centered = generate_centered_bbox(0, 0, 10000, 10000, [(5000, 5000), (0, 9999)], area=4, ratio=1.0)
+        assert next(centered) == (4000.0, 4000.0, 6000.0, 6000.0)
+        assert next(centered) == (0, 8000.0, 2000.0, 10000.0)
+
+        # the same ground area in degrees, wider in longitude at higher latitudes
+        geographic = random_bboxes(-10.0, 0.0, 10.0, 70.0, area=100, ratio=1.0, rng=random.Random(1), count=1000, crs="EPSG:4326")
+        for minx, miny, maxx, maxy in geographic:
+            latitude = math.radians((miny + maxy) / 2)
+            ground_area = (maxx - minx) * math.cos(latitude) * (maxy - miny) * 111.195**2
+            assert abs(ground_area - 100) < 0.5 and -10.0 <= minx and maxy <= 70.0, ground_area
+
+        # web mercator: both sides grow with 1/cos(latitude) of the center
+        mercator = random_bboxes(-1e6, 0.0, 1e6, 1e7, area=100, ratio=1.0, rng=random.Random(1), count=1000, crs="EPSG:3857")
+        for minx, miny, maxx, maxy in mercator:
+            scale = math.cos(math.radians(web_mercator_latitude((miny + maxy) / 2)))
+            ground_area = (maxx - minx) * scale * (maxy - miny) * scale / 1e6
+            assert abs(ground_area - 100) < 0.5 and 0.0 <= miny and maxy <= 1e7, ground_area
+
+        # the sequence does not depend on the batch size
+        batches = generate_random_bbox(-144205.734375, -326024.8125, 162129.09375, 276083.78125, batch_size=3, **test1)
+        assert test1_result == next(batches)
+
     except BBoxError as e:
         # TODO: Better exception
         print(f"Error generating bbox: {e}")
@@ -0,0 +1,131 @@
+"""Periodic reports of a test: a greenlet adding a row every interval
+
+The connection churn, the cache hit ratio, the client CPU of the workers and
+the client saturation are all reported the same way: a greenlet wakes up
+every interval and adds a row, logged as it is added, the last row is added
+when the test stops, and the rows are written to a CSV file. `PeriodicReporter`
+runs the greenlet and writes the file, the reporters only override `report()`
+(and `summary()` for the end of the test).
+
+The running reporters of the process are kept by class, the modules start
+and stop theirs from the test_start and test_stop listeners of the
+locustfiles with `start` and `stop`.
+"""
+from typing import Dict, List, Optional
+import csv
+import logging
+
+import gevent
+
+logger = logging.getLogger(__name__)
+
+
+class PeriodicReporter:
+    """
+    Base class of the reports added every interval of a test.
+
+    Example:
+    class QueueReporter(PeriodicReporter):
+        title = "Queue report"
+
+        def report(self):
+            self.rows.append({"timestamp": time.time(), "queued": queue.qsize()})
+
+    reporter = QueueReporter(environment, interval=10, output="queue.csv")
+    reporter.start()
+    ...
+    reporter.stop()
+    """
+
+    # name of the report in the log, when its CSV file is written
+    title = "Report"
+
+    def __init__(self, environment, interval: float = 10.0, output: Optional[str] = None):
+        """
+        Parameters:
+        - environment: Locust environment.
+        - interval (float): Seconds between two reports.
+        - output (str): Optional. CSV file of the reports.
+        """
+        self.environment = environment
+        self.interval = interval
+        self.output = output
+        self.greenlet = None
+        self.rows: List[Dict] = []
+
+    def start(self):
+        self.greenlet = gevent.spawn(self.run)
+
+    def run(self):
+        while True:
+            gevent.sleep(self.interval)
+            self.report()
+
+    def report(self):
+        """Add the rows of the interval since the previous report"""
+        raise NotImplementedError
+
+    def summary(self):
+        """Log the summary of the test, after the last report"""
+
+    def stop(self):
+        """Stop the reports, add the last one, log the summary and write the CSV file"""
+        if self.greenlet is None:
+            return
+        self.greenlet.kill()
+        self.greenlet = None
+        self.report()
+        self.summary()
+        self.write_csv()
+
+    def write_csv(self):
+        if not self.output or not self.rows:
+            return
+        with open(self.output, "w", encoding="utf-8", newline="") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(self.rows[0]))
+            writer.writeheader()
+            writer.writerows(self.rows)
+        logger.info(f"{self.title} written to {self.output}")
+
+
+# running reporters of the process by class
+_reporters: Dict[type, PeriodicReporter] = {}
+
+
+def start(reporter: PeriodicReporter) -> PeriodicReporter:
+    """Start a reporter, replacing the running one of its class"""
+    stop(type(reporter))
+    _reporters[type(reporter)] = reporter
+    reporter.start()
+    return reporter
+
+
+def stop(reporter_class: type):
+    """Stop the running reporter of a class, if any: the last report covers the end of the test"""
+    reporter = _reporters.pop(reporter_class, None)
+    if reporter is not None:
+        reporter.stop()
+
+
+def running(reporter_class: type) -> Optional[PeriodicReporter]:
+    return _reporters.get(reporter_class)
+
+
+# Example of class usage
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    class CountReporter(PeriodicReporter):
+        title = "Count report"
+
+        def report(self):
+            self.rows.append({"report": len(self.rows)})
+
+    output = os.path.join(tempfile.mkdtemp(), "count.csv")
+    reporter = start(CountReporter(None, interval=0.05, output=output))
+    gevent.sleep(0.12)
+    stop(CountReporter)
+    assert running(CountReporter) is None and len(reporter.rows) == 3
+    with open(output, encoding="utf-8") as csv_file:
+        assert csv_file.read().split() == ["report", "0", "1", "2"]
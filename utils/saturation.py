@@ -0,0 +1,295 @@
+"""Client saturation: CPU, event loop lag and request path costs of the load generator
+
+With many users in one process the response times also measure the client:
+a user whose response has arrived waits for the gevent loop to run it again,
+and the time spent drawing bboxes or tiles, building URLs and writing logs
+is CPU not available to read the responses. Rising latencies are then the
+client queueing, not the server.
+
+`ClientMonitor` samples, in every process running users (local runner or
+workers):
+
+- the CPU of the process over each interval (time.process_time());
+- the event loop lag: how late a greenlet sleeping 0.1 s wakes up;
+- the time per call of the sections timed by the users with `add`: drawing
+  the next bbox or tile and building the URL (one call per request), and
+  writing a log record (one call per record).
+
+Each interval is logged and written to the CSV file of the process, and a
+table of the whole test is logged at the end. They are kept apart from the
+locust statistics, which only count the requests. A process whose CPU or loop
+lag p95 is over its limit logs a warning and adds a single CLIENT "saturated"
+failure: the results are not valid and locust exits with an error code.
+"""
+from typing import Dict, List, Optional
+import logging
+import time
+
+import gevent
+from locust.stats import calculate_response_time_percentile
+
+from utils import distributed, reporting, seeding
+
+logger = logging.getLogger(__name__)
+
+# request_type of the saturated failure in locust statistics
+REQUEST_TYPE = "CLIENT"
+
+# sections of the request path timed by the users
+DRAW = "draw"
+URL = "url"
+LOGGING = "logging"
+SECTIONS = (DRAW, URL, LOGGING)
+
+# seconds between two event loop lag samples
+LAG_INTERVAL = 0.1
+# limits of a saturated client: CPU percent (p95 of the intervals) and loop lag p95 in ms
+CPU_LIMIT = distributed.CPU_THRESHOLD
+LAG_LIMIT = 50.0
+
+
+class ClientSaturatedError(Exception):
+    """The load generator was the bottleneck of the test"""
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest rank percentile, 0 when there are no values"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class ClientMonitor(reporting.PeriodicReporter):
+    """
+    Sample the CPU, the event loop lag and the sections of the request path
+    of this process, report them every interval and check the saturation at
+    the end of the test.
+
+    Example:
+    monitor = ClientMonitor(environment, interval=5, output="client.csv")
+    monitor.start()
+    ...
+    monitor.stop()
+    """
+
+    title = "Client saturation report"
+
+    def __init__(self, environment, interval: float = 5.0, output: Optional[str] = None):
+        """
+        Parameters:
+        - environment: Locust environment of the process running the users.
+        - interval (float): Seconds between two reports.
+        - output (str): Optional. CSV file of the reports.
+        """
+        super().__init__(environment, interval, output)
+        # calls and seconds of every section, since the start and at the last report
+        self.sections: Dict[str, List] = {section: [0, 0.0] for section in SECTIONS}
+        self.reported: Dict[str, List] = {section: [0, 0.0] for section in SECTIONS}
+        # loop lag samples by ms
+        self.lags: Dict[int, int] = {}
+        self.interval_lag = 0.0
+        self.wall = time.perf_counter()
+        self.cpu = self.start_cpu = time.process_time()
+        self.handlers: List[logging.Handler] = []
+
+    def add(self, section: str, seconds: float):
+        totals = self.sections[section]
+        totals[0] += 1
+        totals[1] += seconds
+
+    def start(self):
+        self.time_logging()
+        self.wall = time.perf_counter()
+        self.cpu = self.start_cpu = time.process_time()
+        super().start()
+
+    def run(self):
+        """Sample the loop lag every LAG_INTERVAL, report every interval"""
+        next_report = time.perf_counter() + self.interval
+        while True:
+            start = time.perf_counter()
+            gevent.sleep(LAG_INTERVAL)
+            now = time.perf_counter()
+            lag = max(now - start - LAG_INTERVAL, 0.0) * 1000
+            self.lags[round(lag)] = self.lags.get(round(lag), 0) + 1
+            self.interval_lag = max(self.interval_lag, lag)
+            if now >= next_report:
+                self.report()
+                next_report += self.interval
+
+    def time_logging(self):
+        """Time the records written by the handlers of the root logger, in the LOGGING section"""
+        for handler in logging.getLogger().handlers:
+
+            def handle(record, handle=handler.handle):
+                start = time.perf_counter()
+                try:
+                    return handle(record)
+                finally:
+                    self.add(LOGGING, time.perf_counter() - start)
+
+            handler.handle = handle
+            self.handlers.append(handler)
+
+    def untime_logging(self):
+        for handler in self.handlers:
+            # the instance attribute hides the method of the class
+            del handler.handle
+        self.handlers = []
+
+    def report(self):
+        """Add the CPU, the loop lag and the time per call of the sections since the last report"""
+        wall, cpu = time.perf_counter(), time.process_time()
+        elapsed = max(wall - self.wall, 1e-9)
+        cpu_time = cpu - self.cpu
+        self.wall, self.cpu = wall, cpu
+        row = {
+            "timestamp": round(time.time(), 3),
+            "worker": seeding.worker_index(self.environment),
+            "users": self.environment.runner.user_count if self.environment.runner else 0,
+            "cpu": round(cpu_time / elapsed * 100, 1),
+            "loop_lag_max_ms": round(self.interval_lag, 1),
+        }
+        self.interval_lag = 0.0
+        for section, (calls, seconds) in self.sections.items():
+            reported = self.reported[section]
+            calls, seconds = calls - reported[0], seconds - reported[1]
+            reported[0], reported[1] = self.sections[section]
+            row[f"{section}_us"] = round(seconds / calls * 1e6, 1) if calls else 0.0
+            # share of the CPU time of the process
+            row[f"{section}_cpu_share"] = round(seconds / cpu_time * 100, 1) if cpu_time > 0 else 0.0
+        self.rows.append(row)
+        logger.info(
+            f"Client: CPU {row['cpu']:.0f}%, loop lag max {row['loop_lag_max_ms']:.0f} ms, "
+            + ", ".join(f"{section} {row[f'{section}_us']:.0f} us/call ({row[f'{section}_cpu_share']:.1f}% CPU)" for section in SECTIONS)
+        )
+
+    def log_table(self):
+        """Log the CPU and loop lag percentiles of the test and the total cost of the sections"""
+        cpu = [row["cpu"] for row in self.rows]
+        cpu_time = max(time.process_time() - self.start_cpu, 1e-9)
+        lines = [
+            f"{'Client':<12} {'p50':>8} {'p95':>8} {'max':>8}",
+            f"{'CPU %':<12} {percentile(cpu, 0.5):>8.0f} {percentile(cpu, 0.95):>8.0f} {max(cpu):>8.0f}",
+            f"{'loop lag ms':<12} {self.lag_percentile(0.5):>8.0f} {self.lag_percentile(0.95):>8.0f} {max(self.lags, default=0):>8.0f}",
+            "",
+            f"{'Section':<12} {'calls':>8} {'us/call':>8} {'total s':>8} {'CPU %':>8}",
+        ]
+        for section, (calls, seconds) in self.sections.items():
+            per_call = seconds / calls * 1e6 if calls else 0.0
+            lines.append(f"{section:<12} {calls:>8} {per_call:>8.1f} {seconds:>8.2f} {seconds / cpu_time * 100:>8.1f}")
+        logger.info("Client saturation report\n" + "\n".join(lines))
+
+    def lag_percentile(self, fraction: float) -> float:
+        return calculate_response_time_percentile(self.lags, sum(self.lags.values()), fraction)
+
+    def saturation(self) -> List[str]:
+        """Reasons why this process was saturated, empty when it was not"""
+        reasons = []
+        cpu = percentile([row["cpu"] for row in self.rows], 0.95)
+        if cpu >= CPU_LIMIT:
+            reasons.append(f"CPU p95 {cpu:.0f}% over {CPU_LIMIT:.0f}%")
+        lag = self.lag_percentile(0.95)
+        if lag >= LAG_LIMIT:
+            reasons.append(f"event loop lag p95 {lag:.0f} ms over {LAG_LIMIT:.0f} ms")
+        return reasons
+
+    def stop(self):
+        """Stop timing the log records, then the sampling (see PeriodicReporter.stop)"""
+        self.untime_logging()
+        super().stop()
+
+    def summary(self):
+        """Log the table of the test and the saturation of the client"""
+        self.log_table()
+        reasons = self.saturation()
+        worker = distributed.label(seeding.worker_index(self.environment)) if distributed.is_worker(self.environment) else "local"
+        if reasons:
+            message = f"Client {worker} saturated: {', '.join(reasons)}"
+            logger.warning(f"{message}: response times include client queueing, the results are not valid, add workers or reduce the users")
+            self.environment.events.request.fire(
+                request_type=REQUEST_TYPE,
+                name="saturated",
+                response_time=0,
+                response_length=0,
+                exception=ClientSaturatedError(message),
+                context={},
+            )
+        else:
+            logger.info(
+                f"Client {worker} not saturated: CPU p95 {percentile([row['cpu'] for row in self.rows], 0.95):.0f}%, "
+                f"event loop lag p95 {self.lag_percentile(0.95):.0f} ms"
+            )
+
+
+# client monitor of the process, local runner or workers only, read by add() on every request
+_monitor: Optional[ClientMonitor] = None
+
+
+def add(section: str, start: float):
+    """
+    Add the time since `start` (time.perf_counter()) to a section of the
+    request path, when the client is monitored.
+    """
+    if _monitor is not None:
+        _monitor.add(section, time.perf_counter() - start)
+
+
+def start_monitor(environment):
+    """
+    Start the client monitor of a test with --client-report-interval, in the
+    processes running users only (not on the master).
+    """
+    global _monitor
+    options = environment.parsed_options
+    if getattr(options, "client_report_interval", 0) <= 0 or distributed.is_master(environment):
+        return
+    _monitor = reporting.start(ClientMonitor(environment, options.client_report_interval, options.client_report_output))
+
+
+def stop_monitor():
+    """Stop the client monitor, reporting its saturation"""
+    global _monitor
+    _monitor = None
+    reporting.stop(ClientMonitor)
+
+
+def add_arguments(parser):
+    """Add the client saturation report options to the locust command line parser"""
+    parser.add_argument(
+        "--client-report-interval",
+        type=float,
+        default=0.0,
+        help="Seconds between two reports of the CPU, event loop lag and time per call spent drawing bboxes/tiles, building URLs and logging of the processes running users, logged apart from the requests. A saturated client adds a CLIENT failure at the end. Defaults to 0, no report",
+    )
+    parser.add_argument(
+        "--client-report-output",
+        type=str,
+        default=None,
+        help="CSV file of the client saturation reports (CPU, loop lag and section costs per interval)",
+    )
+
+
+# Example of function usage
+if __name__ == "__main__":
+    from locust.env import Environment
+
+    environment = Environment()
+    fired = []
+    environment.events.request.add_listener(lambda **kwargs: fired.append((kwargs["name"], kwargs["exception"])))
+    monitor = ClientMonitor(environment, interval=0.2)
+    for _ in range(100):
+        monitor.add(URL, 5e-6)
+    monitor.start()
+    gevent.sleep(0)
+    # a busy loop starves the sampling greenlet: CPU and loop lag are over their limits
+    end = time.perf_counter() + 0.5
+    while time.perf_counter() < end:
+        pass
+    gevent.sleep(0.3)
+    monitor.stop()
+    assert monitor.rows[0]["url_us"] == 5.0
+    # only the saturated failure is a request
+    assert len(fired) == 1 and fired[0][0] == "saturated" and isinstance(fired[0][1], ClientSaturatedError)
+    print(monitor.saturation())
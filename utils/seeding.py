@@ -0,0 +1,89 @@
+"""Independent random streams per worker and simulated user
+
+Every simulated user gets its own `random.Random`, seeded from the run seed,
+the locust worker index and the user index, so that sequences are reproducible
+for a given run, differ between users and workers and do not share the state
+of the global `random` module.
+"""
+from typing import Optional
+import hashlib
+import random
+
+# slot of this worker among the workers of the test, their number and the
+# users of the whole test, sent by the master on test start (utils.distributed)
+_worker_slot: Optional[int] = None
+_worker_total: Optional[int] = None
+_test_users: Optional[int] = None
+
+
+def derive_seed(run_seed: int, *keys) -> int:
+    """
+    Derive a 64 bit seed from the run seed and any number of keys
+    (e.g. worker index, user index, stream name).
+
+    The same arguments always give the same seed, on any platform and process
+    (unlike the builtin hash() of str).
+    """
+    key = ":".join(str(part) for part in (run_seed, *keys))
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def user_random(run_seed: int, worker_index: int, user_index: int, stream: str = "") -> random.Random:
+    """
+    Return the random number generator of one stream of a simulated user.
+
+    Parameters:
+    - run_seed (int): The --random-seed of the run.
+    - worker_index (int): Index of the locust worker, 0 when not distributed.
+    - user_index (int): Index of the simulated user in the worker.
+    - stream (str): Optional. Name of the stream, for users with several independent sequences.
+    """
+    return random.Random(derive_seed(run_seed, worker_index, user_index, stream))
+
+
+def assign_worker(slot: int, total: int, users: Optional[int] = None):
+    """Set the slot of this worker, 0 to total - 1, and the users of the test, given by the master"""
+    global _worker_slot, _worker_total, _test_users
+    _worker_slot, _worker_total, _test_users = slot, total, users
+
+
+def worker_index(environment) -> int:
+    """
+    Index of the locust worker running `environment`, 0 when not distributed.
+    The slot given by the master is used when set: locust indexes are not
+    reused when a worker reconnects, so they can be above the worker count.
+    """
+    if _worker_slot is not None:
+        return _worker_slot
+    runner = environment.runner
+    index = getattr(runner, "worker_index", 0) if runner is not None else 0
+    return max(index, 0)
+
+
+def worker_count(environment) -> int:
+    """
+    Number of locust workers of the test, 1 when not distributed.
+    The count sent by the master is used when set, otherwise workers use
+    --expect-workers, sent by the master with the spawn message.
+    """
+    if _worker_total is not None:
+        return _worker_total
+    if environment.runner is None or type(environment.runner).__name__ != "WorkerRunner":
+        return 1
+    return max(getattr(environment.parsed_options, "expect_workers", 1) or 1, 1)
+
+
+def test_user_count(environment) -> int:
+    """
+    Users of the whole test, 0 when unknown. Workers use the count sent by
+    the master: their runner only knows their own share, and -u is not sent
+    with the spawn message (it is a default locust option). The master and
+    the local runner use their target user count, set before test start
+    from -u or from the web UI.
+    """
+    if _test_users is not None:
+        return _test_users
+    runner = environment.runner
+    if runner is not None and type(runner).__name__ != "WorkerRunner" and getattr(runner, "target_user_count", 0):
+        return runner.target_user_count
+    return getattr(environment.parsed_options, "num_users", None) or 0
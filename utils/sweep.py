@@ -0,0 +1,205 @@
+"""WMS GetMap parameter sweeps
+
+Render cost depends on the image size, the output format, the CRS (reprojection)
+and the bbox area (number of source tiles/features read). A sweep runs every
+combination of the given values in one test, each combination being its own
+entry in locust statistics, and ends with one comparison table:
+
+- mixed: each user cycles through the combinations, all of them run at the
+  same time under the same load;
+- staged (--sweep-stage-time): all users run one combination at a time, for a
+  fixed time each, the test ends after the last one.
+"""
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+import csv
+
+
+class SweepArgError(ValueError):
+    """Custom exception for invalid sweep values."""
+
+    pass
+
+
+class SweepCase(NamedTuple):
+    """One combination of GetMap parameters"""
+
+    width: int
+    height: int
+    format: str
+    crs: str
+    area: float
+
+    @property
+    def name(self) -> str:
+        """Name of the combination in locust statistics, e.g. "512x512 image/png EPSG:3763 100km2" """
+        return f"{self.width}x{self.height} {self.format} {self.crs} {self.area:g}km2"
+
+    @property
+    def megapixels(self) -> float:
+        return self.width * self.height / 1e6
+
+
+def parse_list(value: Optional[str]) -> List[str]:
+    """Split a comma separated option value, empty values are left out"""
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+
+def parse_image_sizes(value: str) -> List[Tuple[int, int]]:
+    """
+    Parse "256,512x256,1024x1024" image sizes, a single number is a square image.
+    """
+    sizes = []
+    for item in parse_list(value):
+        try:
+            width, _, height = item.lower().partition("x")
+            width, height = int(width), int(height or width)
+        except ValueError:
+            raise SweepArgError(f"Image size must be WIDTHxHEIGHT (e.g. 512x512), got {item!r}")
+        if width < 1 or height < 1:
+            raise SweepArgError(f"Image size must be at least 1x1, got {item!r}")
+        sizes.append((width, height))
+    return sizes
+
+
+def parse_areas(value: str) -> List[float]:
+    """Parse "1,10,100" bbox areas in square kilometers"""
+    try:
+        areas = [float(item) for item in parse_list(value)]
+    except ValueError:
+        raise SweepArgError(f"Bbox areas must be numbers, got {value!r}")
+    if any(area <= 0 for area in areas):
+        raise SweepArgError(f"Bbox areas must be greater than 0, got {value!r}")
+    return areas
+
+
+def check_available(values: Sequence[str], available: Sequence[str], label: str):
+    """
+    Raise SweepArgError if a value is not advertised by the service, e.g. a
+    format missing from the GetMap formats.
+    """
+    missing = [value for value in values if value not in available]
+    if missing:
+        raise SweepArgError(f"{label} {missing} not available, available values are {list(available)}")
+
+
+def sweep_cases(
+    sizes: Sequence[Tuple[int, int]], formats: Sequence[str], crs_list: Sequence[str], areas: Sequence[float]
+) -> List[SweepCase]:
+    """
+    Every combination of the values, the last values changing fastest.
+    """
+    return [
+        SweepCase(width, height, image_format, crs, area)
+        for width, height in sizes
+        for image_format in formats
+        for crs in crs_list
+        for area in areas
+    ]
+
+
+def stage_index(elapsed: float, stage_time: float) -> int:
+    """Index of the combination running `elapsed` seconds after the start of a staged sweep"""
+    return int(elapsed // stage_time)
+
+
+def comparison_rows(stats, cases: Iterable[SweepCase], request_type: str = "GET") -> List[Dict]:
+    """
+    One row of results per combination, from locust RequestStats.
+
+    Parameters:
+    - stats: environment.stats of the test.
+    - cases (list of SweepCase): The combinations of the sweep.
+    - request_type (str): Method of the requests in locust statistics.
+    """
+    rows = []
+    for case in cases:
+        entry = stats.get(case.name, request_type)
+        median = entry.get_response_time_percentile(0.5) if entry.num_requests else 0
+        rows.append(
+            {
+                "name": case.name,
+                "width": case.width,
+                "height": case.height,
+                "format": case.format,
+                "crs": case.crs,
+                "area": case.area,
+                "requests": entry.num_requests,
+                "failures": entry.num_failures,
+                "median": median,
+                "p95": entry.get_response_time_percentile(0.95) if entry.num_requests else 0,
+                "average": entry.avg_response_time,
+                "average_size": entry.avg_content_length,
+                # render cost per output megapixel
+                "ms_per_megapixel": entry.avg_response_time / case.megapixels,
+                "rps": entry.total_rps,
+            }
+        )
+    return rows
+
+
+def dimension_summary(rows: List[Dict]) -> Dict[str, Dict[str, float]]:
+    """
+    Average median response time of each value of the swept parameters (e.g.
+    of each format over all sizes, CRSs and areas), for the parameters with
+    more than one value.
+    """
+    summary = {}
+    for dimension in ("format", "crs", "area", "size"):
+        medians: Dict[str, List[float]] = {}
+        for row in rows:
+            if not row["requests"]:
+                continue
+            if dimension == "size":
+                value = f"{row['width']}x{row['height']}"
+            elif dimension == "area":
+                value = f"{row['area']:g}km2"
+            else:
+                value = row[dimension]
+            medians.setdefault(value, []).append(row["median"])
+        if len(medians) > 1:
+            summary[dimension] = {value: sum(values) / len(values) for value, values in medians.items()}
+    return summary
+
+
+def format_table(rows: List[Dict]) -> str:
+    """Comparison table of the combinations, then the swept parameter values from fastest to slowest"""
+    width = max([len(row["name"]) for row in rows] + [11])
+    lines = [
+        f"{'Combination':<{width}} {'reqs':>7} {'fails':>6} {'med ms':>8} {'p95 ms':>8} {'avg ms':>8} {'avg KB':>8} {'ms/Mpx':>8} {'req/s':>7}",
+        "-" * (width + 72),
+    ]
+    for row in rows:
+        lines.append(
+            f"{row['name']:<{width}} {row['requests']:>7} {row['failures']:>6} {row['median']:>8.0f} "
+            f"{row['p95']:>8.0f} {row['average']:>8.0f} {row['average_size'] / 1024:>8.1f} "
+            f"{row['ms_per_megapixel']:>8.0f} {row['rps']:>7.2f}"
+        )
+    for dimension, medians in dimension_summary(rows).items():
+        ranking = sorted(medians.items(), key=lambda item: item[1])
+        lines.append(
+            f"Median by {dimension}: " + ", ".join(f"{value} {median:.0f}ms" for value, median in ranking)
+        )
+    return "\n".join(lines)
+
+
+def write_csv(path: str, rows: List[Dict]):
+    """Write the comparison rows to a CSV file"""
+    with open(path, "w", encoding="utf-8", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# Example of function usage
+if __name__ == "__main__":
+    assert parse_image_sizes("256, 512x256") == [(256, 256), (512, 256)]
+    assert parse_areas("1,10") == [1.0, 10.0]
+    cases = sweep_cases([(256, 256), (512, 512)], ["image/png", "image/jpeg"], ["EPSG:3763"], [1.0, 10.0])
+    assert len(cases) == 8 and cases[1].name == "256x256 image/png EPSG:3763 10km2"
+    assert stage_index(61, 30) == 2
+    try:
+        check_available(["image/webp"], ["image/png"], "Formats")
+        raise AssertionError("image/webp is not available")
+    except SweepArgError:
+        pass
+    print("\n".join(case.name for case in cases))
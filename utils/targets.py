@@ -0,0 +1,331 @@
+"""Mixed multi-service, multi-layer workloads
+
+A production server answers WMS and WMTS requests for many layers at the same
+time, and the contention between them is what a single layer benchmark does
+not show. A targets file lists the services and layers of one run, with
+their request parameters and traffic weights, as JSON (or YAML when PyYAML
+is installed):
+
+    {
+      "defaults": {"bbox_area": 100},
+      "targets": [
+        {"service": "WMS", "host": "https://ortos.dgterritorio.gov.pt/wms/ortosat2023",
+         "layer": "ortoSat2023-CorVerdadeira", "weight": 3},
+        {"service": "WMTS", "host": "https://cartografia.dgterritorio.gov.pt/ortos2021/service",
+         "layer": "Ortos2021-RGB", "tile_matrix_set": "PTTM_06", "tile_matrix": "05:08", "weight": 1}
+      ]
+    }
+
+Each target is resolved against its capabilities once per process (targets
+of the same service url share one parsed document) into a small object that
+draws the url of a request from a random number generator. Users hold no
+per target state, only their random stream, so thousands of them fit in one
+worker.
+"""
+from typing import Dict, List, Optional, Tuple
+import json
+import logging
+
+try:
+    import yaml
+except ImportError:  # optional, targets files are then JSON only
+    yaml = None
+
+from utils.capabilities import load_layer_capabilities
+from utils.coverage import layer_tile_ranges
+from utils.crs import axis_swapped, layer_bbox, swap_axes
+from utils.hotspots import AliasTable
+from utils.random_bbox import check_bbox_args, random_bboxes
+from utils.tile_matrix_mix import parse_tile_matrix
+from utils.url_template import QueryTemplate, encode_bbox, encode_value
+
+logger = logging.getLogger(__name__)
+
+WMS = "WMS"
+WMTS = "WMTS"
+
+# keys of a target, and of the defaults
+TARGET_KEYS = {
+    WMS: {"service", "host", "name", "layer", "weight", "capabilities_file", "format", "crs", "width", "height", "bbox_area", "bbox_ratio"},
+    WMTS: {"service", "host", "name", "layer", "weight", "capabilities_file", "format", "tile_matrix_set", "tile_matrix"},
+}
+
+
+class TargetConfigError(ValueError):
+    """Custom exception for invalid targets files."""
+
+    pass
+
+
+class WMSTarget:
+    """
+    GetMap requests of random bboxes of one WMS layer.
+
+    Example:
+    target = WMSTarget("https://host/wms", layer="ortos", bbox_area=100)
+    url, width, height = target.request(rng)
+    """
+
+    service = WMS
+
+    def __init__(
+        self,
+        host: str,
+        layer: Optional[str] = None,
+        name: Optional[str] = None,
+        weight: float = 1.0,
+        capabilities_file: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        format: str = "image/png",
+        crs: Optional[str] = None,
+        width: int = 512,
+        height: int = 512,
+        bbox_area: float = 100.0,
+        bbox_ratio: float = 1.0,
+    ):
+        """
+        Parameters:
+        - host (str): Service url.
+        - layer (str): Optional. Layer name, the first layer of the service by default.
+        - name (str): Optional. Name in locust statistics, "WMS <layer>" by default.
+        - weight (float): Share of the requests of the run.
+        - capabilities_file (str): Optional. Local XML file used instead of a download.
+        - cache_dir (str): Optional. Directory of the on-disk GetCapabilities cache.
+        - format (str): GetMap format.
+        - crs (str): Optional. GetMap CRS, the CRS of the layer bbox by default.
+        - width, height (int): Image size.
+        - bbox_area (float): Bbox area in square kilometres.
+        - bbox_ratio (float): Bbox width/height ratio.
+        """
+        wms = load_layer_capabilities(WMS, host, layer, capabilities_file=capabilities_file, cache_dir=cache_dir)
+        self.layer = layer or list(wms.contents)[0]
+        if self.layer not in wms.contents:
+            raise TargetConfigError(f"Layer '{self.layer}' not in {host}, available layers are {list(wms.contents)}")
+        layer_metadata = wms.contents[self.layer]
+        self.name = name or f"{WMS} {self.layer}"
+        self.weight = weight
+        self.format = format
+        self.crs = crs or layer_metadata.boundingBox[-1]
+        self.width, self.height = width, height
+        self.extent = layer_bbox(layer_metadata, self.crs, wms.version)
+        if self.extent is None:
+            raise TargetConfigError(f"Layer '{self.layer}' has no BoundingBox in {self.crs} in {host}")
+        check_bbox_args(*self.extent, bbox_area, bbox_ratio)
+        self.bbox_area, self.bbox_ratio = bbox_area, bbox_ratio
+        # GetMap is version 1.3.0, geographic CRS like EPSG:4326 are latitude first
+        self.axis_swapped = axis_swapped(self.crs)
+        self.url_template = QueryTemplate(
+            host,
+            {
+                "service": "WMS",
+                "version": "1.3.0",
+                "request": "GetMap",
+                "layers": self.layer,
+                "styles": "",
+                "bbox": None,
+                "width": str(width),
+                "height": str(height),
+                "crs": self.crs,
+                "format": format,
+            },
+            ("bbox",),
+        )
+
+    def request(self, rng) -> Tuple[str, int, int]:
+        """Url of the next GetMap, and the image size of the response"""
+        bbox = random_bboxes(*self.extent, self.bbox_area, self.bbox_ratio, rng, 1, self.crs)[0]
+        if self.axis_swapped:
+            bbox = swap_axes(bbox)
+        return self.url_template.render_encoded(bbox=encode_bbox(bbox)), self.width, self.height
+
+
+class WMTSTarget:
+    """
+    GetTile requests of random tiles of one WMTS layer, over a weighted mix of
+    TileMatrix levels.
+
+    Example:
+    target = WMTSTarget("https://host/wmts", layer="ortos", tile_matrix="05:08")
+    url, width, height = target.request(rng)
+    """
+
+    service = WMTS
+
+    def __init__(
+        self,
+        host: str,
+        layer: Optional[str] = None,
+        name: Optional[str] = None,
+        weight: float = 1.0,
+        capabilities_file: Optional[str] = None,
+        cache_dir: Optional[str] = None,
+        format: Optional[str] = None,
+        tile_matrix_set: Optional[str] = None,
+        tile_matrix: Optional[str] = None,
+    ):
+        """
+        Parameters:
+        - host (str): Service url.
+        - layer (str): Optional. Layer identifier, the first layer of the service by default.
+        - name (str): Optional. Name in locust statistics, "WMTS <layer>" by default.
+        - weight (float): Share of the requests of the run.
+        - capabilities_file (str): Optional. Local XML file used instead of a download.
+        - cache_dir (str): Optional. Directory of the on-disk GetCapabilities cache.
+        - format (str): Optional. Tile format, the first format of the layer by default.
+        - tile_matrix_set (str): Optional. TileMatrixSet, the first one of the layer by default.
+        - tile_matrix (str): Optional. TileMatrix mix (see utils.tile_matrix_mix), the middle level by default.
+        """
+        wmts = load_layer_capabilities(
+            WMTS, host, layer, tile_matrix_set, capabilities_file=capabilities_file, cache_dir=cache_dir
+        )
+        self.layer = layer or list(wmts.contents)[0]
+        if self.layer not in wmts.contents:
+            raise TargetConfigError(f"Layer '{self.layer}' not in {host}, available layers are {list(wmts.contents)}")
+        layer_metadata = wmts.contents[self.layer]
+        self.name = name or f"{WMTS} {self.layer}"
+        self.weight = weight
+        self.format = format or layer_metadata.formats[0]
+        self.tile_matrix_set = tile_matrix_set or list(layer_metadata.tilematrixsetlinks)[0]
+        if self.tile_matrix_set not in layer_metadata.tilematrixsetlinks:
+            raise TargetConfigError(
+                f"TileMatrixSet {self.tile_matrix_set} not linked to layer '{self.layer}', "
+                f"available values are {list(layer_metadata.tilematrixsetlinks)}"
+            )
+        matrix_set = wmts.tilematrixsets[self.tile_matrix_set]
+        identifiers = list(matrix_set.tilematrix)
+        try:
+            weighted_levels = parse_tile_matrix(tile_matrix or identifiers[len(identifiers) // 2], identifiers)
+        except ValueError as error:
+            raise TargetConfigError(f"Target {self.name}: {error}")
+        ranges = layer_tile_ranges(layer_metadata, matrix_set)
+        weighted_levels = [(level, weight) for level, weight in weighted_levels if level in ranges]
+        if not weighted_levels:
+            raise TargetConfigError(f"Target {self.name}: no tile of layer '{self.layer}' in TileMatrix {tile_matrix}")
+        self.levels = [level for level, _ in weighted_levels]
+        self.table = AliasTable([weight for _, weight in weighted_levels])
+        # (min_col, max_col, min_row, max_row, tile width, tile height) of each level
+        self.tiles = [
+            (*ranges[level], matrix_set.tilematrix[level].tilewidth, matrix_set.tilematrix[level].tileheight)
+            for level in self.levels
+        ]
+        self.url_template = QueryTemplate(
+            host,
+            {
+                "service": "WMTS",
+                "version": "1.0.0",
+                "request": "GetTile",
+                "layer": self.layer,
+                "style": "default",
+                "tilematrix": None,
+                "tilematrixset": self.tile_matrix_set,
+                "tilerow": None,
+                "tilecol": None,
+                "format": self.format,
+            },
+            ("tilematrix", "tilerow", "tilecol"),
+        )
+
+    def request(self, rng) -> Tuple[str, int, int]:
+        """Url of the next GetTile, and the tile size of the response"""
+        index = self.table.sample(rng) if len(self.levels) > 1 else 0
+        min_col, max_col, min_row, max_row, width, height = self.tiles[index]
+        url = self.url_template.render_encoded(
+            tilematrix=encode_value(self.levels[index]),
+            tilecol=rng.randint(min_col, max_col),
+            tilerow=rng.randint(min_row, max_row),
+        )
+        return url, width, height
+
+
+TARGET_CLASSES = {WMS: WMSTarget, WMTS: WMTSTarget}
+
+
+def read_targets_file(path: str) -> Dict:
+    """Parse a JSON (or, with PyYAML, YAML) targets file"""
+    with open(path, encoding="utf-8") as targets_file:
+        text = targets_file.read()
+    if path.lower().endswith((".yaml", ".yml")):
+        if yaml is None:
+            raise TargetConfigError(f"PyYAML is not installed, {path} can not be read, use a JSON targets file")
+        config = yaml.safe_load(text)
+    else:
+        try:
+            config = json.loads(text)
+        except json.JSONDecodeError as error:
+            raise TargetConfigError(f"Invalid JSON targets file {path}: {error}")
+    if not isinstance(config, dict) or not config.get("targets"):
+        raise TargetConfigError(f"Targets file {path} must have a non empty 'targets' list")
+    return config
+
+
+def load_targets(path: str, host: Optional[str] = None, cache_dir: Optional[str] = None) -> List:
+    """
+    Resolve the targets of a targets file against their capabilities.
+
+    Parameters:
+    - path (str): JSON or YAML targets file.
+    - host (str): Optional. Service url of the targets without a host (--host).
+    - cache_dir (str): Optional. Directory of the on-disk GetCapabilities cache.
+
+    Returns:
+    - list of WMSTarget and WMTSTarget.
+
+    Raises:
+    - TargetConfigError: If a target is invalid.
+    """
+    config = read_targets_file(path)
+    defaults = config.get("defaults") or {}
+    targets = []
+    for index, item in enumerate(config["targets"]):
+        service = str(item.get("service", defaults.get("service", ""))).upper()
+        if service not in TARGET_CLASSES:
+            raise TargetConfigError(f"Target {index} of {path}: service must be WMS or WMTS, got {service!r}")
+        # defaults only apply to the keys of the service
+        values = {key: value for key, value in defaults.items() if key in TARGET_KEYS[service]}
+        values.update(item)
+        unknown = set(values) - TARGET_KEYS[service]
+        if unknown:
+            raise TargetConfigError(f"Target {index} of {path}: unknown {service} keys {sorted(unknown)}")
+        values.pop("service", None)
+        values.setdefault("host", host)
+        if not values["host"]:
+            raise TargetConfigError(f"Target {index} of {path} has no host")
+        if float(values.get("weight", 1.0)) < 0:
+            raise TargetConfigError(f"Target {index} of {path}: negative weight")
+        targets.append(TARGET_CLASSES[service](cache_dir=cache_dir, **values))
+    names = [target.name for target in targets]
+    if len(set(names)) != len(names):
+        raise TargetConfigError(f"Targets of {path} must have different names, give them a 'name'")
+    return targets
+
+
+class TargetMix:
+    """
+    Weighted draw of the target of each request.
+
+    Example:
+    mix = TargetMix(load_targets("targets.json"))
+    target = mix.sample(rng)
+    """
+
+    def __init__(self, targets: List):
+        self.targets = [target for target in targets if target.weight > 0]
+        if not self.targets:
+            raise TargetConfigError("No target with a positive weight")
+        self.table = AliasTable([target.weight for target in self.targets])
+
+    def sample(self, rng):
+        return self.targets[self.table.sample(rng)]
+
+
+# Example of function usage
+if __name__ == "__main__":
+    import random
+    import sys
+
+    # python -m utils.targets targets.json
+    mix = TargetMix(load_targets(sys.argv[1]))
+    rng = random.Random(1640)
+    for _ in range(5):
+        target = mix.sample(rng)
+        print(target.name, target.request(rng)[0])
@@ -0,0 +1,126 @@
+"""Weighted mixes of WMTS TileMatrix levels
+
+Performance varies a lot between the levels of a pyramid (low levels are
+cached, high levels are often rendered on demand). `--tile-matrix` accepts a
+mix of levels, the level of each request is drawn from it:
+
+- "07": a single level;
+- "05,06,07": a list, equal weights;
+- "05:10": a range, inclusive, in the TileMatrixSet order;
+- "05:08=1,09=2,10=4": weights, a range weight applies to each of its levels.
+"""
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+import random
+
+from utils.hotspots import AliasTable
+
+
+def parse_tile_matrix(spec: str, identifiers: Sequence[str]) -> List[Tuple[str, float]]:
+    """
+    Parse a --tile-matrix mix.
+
+    Parameters:
+    - spec (str): The mix, e.g. "05:08=1,09=2".
+    - identifiers (list of str): TileMatrix identifiers of the TileMatrixSet, in order.
+
+    Returns:
+    - (identifier, weight) of each level, in the order of the spec.
+
+    Raises:
+    - ValueError: If a level is not in the TileMatrixSet or a weight is invalid.
+    """
+    identifiers = list(identifiers)
+    weights: Dict[str, float] = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        levels, _, weight = item.partition("=")
+        try:
+            weight = float(weight) if weight else 1.0
+        except ValueError:
+            raise ValueError(f"Invalid weight in tilematrix {item!r}")
+        if weight < 0:
+            raise ValueError(f"Negative weight in tilematrix {item!r}")
+        if levels in identifiers:
+            # identifiers may contain ":" (e.g. EPSG:3857:5)
+            selected = [levels]
+        elif ":" in levels:
+            # first and last levels of the range, split at the ":" between two identifiers
+            parts = levels.split(":")
+            bounds = [
+                (":".join(parts[:index]), ":".join(parts[index:]))
+                for index in range(1, len(parts))
+                if ":".join(parts[:index]) in identifiers and ":".join(parts[index:]) in identifiers
+            ]
+            if not bounds:
+                raise ValueError(f"The tilematrix range {levels} is not on the tilematrixset")
+            first, last = bounds[0]
+            start, stop = sorted((identifiers.index(first), identifiers.index(last)))
+            selected = identifiers[start : stop + 1]
+        else:
+            raise ValueError(f"The tilematrix {levels} is not on the tilematrixset")
+        for level in selected:
+            weights[level] = weight
+    if not weights or sum(weights.values()) <= 0:
+        raise ValueError(f"The tilematrix mix {spec!r} has no level with a positive weight")
+    return [(level, weight) for level, weight in weights.items() if weight > 0]
+
+
+class TileMatrixMix:
+    """
+    (matrix, col, row) tiles, the level of each tile is drawn from the weighted
+    levels and its col and row from the tile iterator of the level.
+
+    Example:
+    mix = TileMatrixMix([("05", 1.0), ("06", 2.0)], {"05": tiles_05, "06": tiles_06}, rng)
+    tile_matrix, tile_col, tile_row = next(mix)
+    """
+
+    def __init__(
+        self,
+        weighted_levels: List[Tuple[str, float]],
+        tiles: Dict[str, Iterator[Tuple[int, int]]],
+        rng: Optional[random.Random] = None,
+    ):
+        """
+        Parameters:
+        - weighted_levels (list): (identifier, weight) of the levels, from parse_tile_matrix().
+        - tiles (dict): Identifier to an iterator of (col, row) tiles of the level.
+        - rng (random.Random): Optional. Random number generator of the level draws.
+        """
+        self.levels = [level for level, _ in weighted_levels]
+        self.table = AliasTable([weight for _, weight in weighted_levels])
+        self.tiles = tiles
+        self.rng = rng or random.Random()
+
+    def next_level(self) -> str:
+        """Draw a level, without random draw when there is only one"""
+        if len(self.levels) == 1:
+            return self.levels[0]
+        return self.levels[self.table.sample(self.rng)]
+
+    def __iter__(self) -> Iterator[Tuple[str, int, int]]:
+        return self
+
+    def __next__(self) -> Tuple[str, int, int]:
+        level = self.next_level()
+        col, row = next(self.tiles[level])
+        return level, col, row
+
+
+# Example of function usage
+if __name__ == "__main__":
+    identifiers = [f"{level:02d}" for level in range(15)]
+    assert parse_tile_matrix("07", identifiers) == [("07", 1.0)]
+    assert parse_tile_matrix("05:07", identifiers) == [("05", 1.0), ("06", 1.0), ("07", 1.0)]
+    assert parse_tile_matrix("05:06=1,10=4", identifiers) == [("05", 1.0), ("06", 1.0), ("10", 4.0)]
+    assert parse_tile_matrix("EPSG:3857:2:EPSG:3857:3", ["EPSG:3857:1", "EPSG:3857:2", "EPSG:3857:3"]) == [
+        ("EPSG:3857:2", 1.0),
+        ("EPSG:3857:3", 1.0),
+    ]
+    try:
+        parse_tile_matrix("99", identifiers)
+        raise AssertionError("99 is not a level")
+    except ValueError:
+        pass
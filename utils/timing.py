@@ -0,0 +1,309 @@
+"""Per request timing breakdown: DNS, connect, TLS, time to first byte and download
+
+A locust response time mixes the phases of a request, but they point to
+different bottlenecks: slow rendering shows in the time to first byte, large
+images in the download, broken keep-alive in the connect and TLS times.
+
+The connection pool and HTTP client of geventhttpclient (used by
+FastHttpUser) are replaced by subclasses that time each phase of the current
+greenlet's request:
+
+- DNS: name resolution, new connections only;
+- CONNECT: TCP connect, new connections only;
+- TLS: TLS handshake, new https connections only;
+- TTFB: from the connection being ready to the response headers (request sent,
+  server processing);
+- DOWNLOAD: from the headers to the end of the body, with the body size.
+
+Each phase is recorded as its own request type (named after the layer and
+format) in `phase_stats`, a locust RequestStats apart from the environment
+statistics: the phases are not requests, in the locust statistics they would
+be counted in the Aggregated requests, requests per second and percentiles of
+the reports. Workers send their phase entries to the master with their stats
+reports. The count of CONNECT entries against TTFB entries shows the share of
+requests that opened a new connection.
+"""
+from typing import Dict, List, Optional
+import csv
+import logging
+import time
+
+import gevent.local
+from geventhttpclient.client import HTTPClient, HTTPClientPool
+from geventhttpclient.connectionpool import ConnectionPool, SSLConnectionPool
+from geventhttpclient.url import URL
+from locust.stats import RequestStats, StatsEntry
+
+logger = logging.getLogger(__name__)
+
+# request_type of the phase entries in locust statistics
+DNS = "DNS"
+CONNECT = "CONNECT"
+TLS = "TLS"
+TTFB = "TTFB"
+DOWNLOAD = "DOWNLOAD"
+REQUEST_TYPES = (DNS, CONNECT, TLS, TTFB, DOWNLOAD)
+
+# key of the phase entries in the stats reports of the workers
+REPORT_KEY = "timing_phases"
+
+# phases of the request of the current greenlet
+_local = gevent.local.local()
+
+# phase entries of the process, and of the workers on the master
+phase_stats = RequestStats(use_response_times_cache=False)
+
+
+class Phases:
+    """time.perf_counter() marks and durations (seconds) of one request"""
+
+    __slots__ = ("start", "dns", "connect", "tls", "new_connection", "ready", "headers")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.dns = self.connect = self.tls = 0.0
+        self.new_connection = False
+        # connection ready (from the pool or new), response headers received
+        self.ready: Optional[float] = None
+        self.headers: Optional[float] = None
+
+
+def current_phases() -> Optional[Phases]:
+    """Phases of the request of the current greenlet, None when it is not timed"""
+    return getattr(_local, "phases", None)
+
+
+class TimedConnectionPool(ConnectionPool):
+    """ConnectionPool timing name resolution and TCP connect"""
+
+    def _resolve(self):
+        start = time.perf_counter()
+        try:
+            return super()._resolve()
+        finally:
+            phases = current_phases()
+            if phases is not None:
+                phases.dns += time.perf_counter() - start
+
+    def _connect_socket(self, sock, address):
+        start = time.perf_counter()
+        sock = super()._connect_socket(sock, address)
+        phases = current_phases()
+        if phases is not None:
+            phases.connect += time.perf_counter() - start
+            phases.new_connection = True
+        return sock
+
+    def get_socket(self):
+        sock = super().get_socket()
+        phases = current_phases()
+        if phases is not None:
+            phases.ready = time.perf_counter()
+        return sock
+
+
+class TimedSSLConnectionPool(SSLConnectionPool, TimedConnectionPool):
+    """SSLConnectionPool timing the TLS handshake apart from the TCP connect"""
+
+    def _connect_socket(self, sock, address):
+        start = time.perf_counter()
+        phases = current_phases()
+        connect = phases.connect if phases is not None else 0.0
+        sock = super()._connect_socket(sock, address)
+        if phases is not None:
+            # the TCP connect of this socket is timed by TimedConnectionPool
+            phases.tls += time.perf_counter() - start - (phases.connect - connect)
+        return sock
+
+
+class TimedHTTPClient(HTTPClient):
+    """HTTPClient with a timed connection pool, marking the response headers"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # same pool, only the timed methods differ
+        self._connection_pool.__class__ = TimedSSLConnectionPool if self.ssl else TimedConnectionPool
+
+    def request(self, *args, **kwargs):
+        response = super().request(*args, **kwargs)
+        phases = current_phases()
+        if phases is not None:
+            phases.headers = time.perf_counter()
+        return response
+
+
+class TimedClientPool(HTTPClientPool):
+    """HTTPClientPool of TimedHTTPClient"""
+
+    def get_client(self, url):
+        if not isinstance(url, URL):
+            url = URL(url)
+        client_key = url.host, url.port
+        try:
+            return self.clients[client_key]
+        except KeyError:
+            client = TimedHTTPClient.from_url(url, **self.client_args)
+            self.clients[client_key] = client
+            return client
+
+
+def install(session):
+    """
+    Time the requests of a FastHttpSession (`self.client` of a FastHttpUser),
+    before its first request.
+    """
+    user_agent = session.client
+    client_args = user_agent.clientpool.client_args
+    user_agent.clientpool.close()
+    user_agent.clientpool = TimedClientPool(**client_args)
+
+
+def start():
+    """Start timing the next request of the current greenlet"""
+    _local.phases = Phases()
+
+
+def report(environment, name: str, response_length: int = 0):
+    """
+    Add the phase entries of the request of the current greenlet to
+    `phase_stats`, once its body is read (in the `with` block of a
+    catch_response=True request).
+    Connection phases are only reported for new connections, TTFB and
+    DOWNLOAD only for requests that got a response.
+
+    Parameters:
+    - environment: Locust environment of the user.
+    - name (str): Name of the phase entries, e.g. the layer and format.
+    - response_length (int): Body size, reported with the DOWNLOAD phase.
+    """
+    phases = current_phases()
+    if phases is None:
+        return
+    _local.phases = None
+    end = time.perf_counter()
+    durations = []
+    if phases.new_connection:
+        durations += [(DNS, phases.dns, 0), (CONNECT, phases.connect, 0)]
+        if phases.tls:
+            durations.append((TLS, phases.tls, 0))
+    if phases.ready is not None and phases.headers is not None:
+        durations += [(TTFB, phases.headers - phases.ready, 0), (DOWNLOAD, end - phases.headers, response_length)]
+    for request_type, duration, length in durations:
+        phase_stats.log_request(request_type, name, duration * 1000, length)
+
+
+def on_test_start(environment, **kwargs):
+    phase_stats.clear_all()
+
+
+def on_report_to_master(client_id, data, **kwargs):
+    """Add the phase entries since the last report to the stats report of a worker, they are reset"""
+    entries = phase_stats.serialize_stats()
+    if entries:
+        data[REPORT_KEY] = entries
+
+
+def on_worker_report(client_id, data, **kwargs):
+    """Add the phase entries of a worker to the phase entries of the master"""
+    for entry_data in data.get(REPORT_KEY, []):
+        entry = StatsEntry.unserialize(entry_data)
+        phase_stats.get(entry.name, entry.method).extend(entry)
+
+
+def register(environment):
+    """
+    On init: phase entries are cleared on test start, workers send theirs to
+    the master (they only get --timing-breakdown with the spawn message).
+    """
+    environment.events.test_start.add_listener(on_test_start)
+    runner_type = type(environment.runner).__name__
+    if runner_type == "WorkerRunner":
+        environment.events.report_to_master.add_listener(on_report_to_master)
+    elif runner_type == "MasterRunner":
+        environment.events.worker_report.add_listener(on_worker_report)
+
+
+def throughput_rows(stats) -> List[Dict]:
+    """
+    One row per phase entry name (layer and format), from locust RequestStats:
+    phase percentiles, new connections and the download throughput.
+    """
+    rows = []
+    for (name, method), download in sorted(stats.entries.items()):
+        if method != DOWNLOAD or not download.num_requests:
+            continue
+        # stats.get() would add empty entries to the report
+        ttfb, connect, tls = (stats.entries.get((name, phase)) for phase in (TTFB, CONNECT, TLS))
+        megabytes = download.total_content_length / 1e6
+        duration = max(download.last_request_timestamp - download.start_time, 1e-9)
+        rows.append(
+            {
+                "name": name,
+                "requests": download.num_requests,
+                "new_connections": connect.num_requests if connect else 0,
+                "connect_median": connect.get_response_time_percentile(0.5) if connect else 0,
+                "tls_median": tls.get_response_time_percentile(0.5) if tls else 0,
+                "ttfb_median": ttfb.get_response_time_percentile(0.5) if ttfb else 0,
+                "ttfb_p95": ttfb.get_response_time_percentile(0.95) if ttfb else 0,
+                "download_median": download.get_response_time_percentile(0.5),
+                "download_p95": download.get_response_time_percentile(0.95),
+                "megabytes": megabytes,
+                # body transfer rate of a single request
+                "transfer_mb_s": megabytes / max(download.total_response_time / 1000, 1e-9),
+                # bytes received per second over the test
+                "throughput_mb_s": megabytes / duration,
+            }
+        )
+    return rows
+
+
+def format_table(rows: List[Dict]) -> str:
+    """Timing breakdown table, in milliseconds and MB/s"""
+    width = max([len(row["name"]) for row in rows] + [4])
+    lines = [
+        f"{'Name':<{width}} {'reqs':>7} {'conns':>6} {'conn':>6} {'tls':>6} {'ttfb':>6} {'ttfb95':>7} "
+        f"{'dl':>6} {'dl95':>6} {'MB':>8} {'MB/s req':>9} {'MB/s':>7}",
+        "-" * (width + 90),
+    ]
+    for row in rows:
+        lines.append(
+            f"{row['name']:<{width}} {row['requests']:>7} {row['new_connections']:>6} {row['connect_median']:>6.0f} "
+            f"{row['tls_median']:>6.0f} {row['ttfb_median']:>6.0f} {row['ttfb_p95']:>7.0f} {row['download_median']:>6.0f} "
+            f"{row['download_p95']:>6.0f} {row['megabytes']:>8.2f} {row['transfer_mb_s']:>9.2f} {row['throughput_mb_s']:>7.2f}"
+        )
+    return "\n".join(lines)
+
+
+def log_report(environment):
+    """
+    Log (and write to --timing-output) the timing breakdown table at the end
+    of a test with --timing-breakdown, on the master (or local) runner only.
+    """
+    options = environment.parsed_options
+    if not getattr(options, "timing_breakdown", False) or type(environment.runner).__name__ == "WorkerRunner":
+        return
+    rows = throughput_rows(phase_stats)
+    if not rows:
+        return
+    logger.info(f"Timing breakdown (median and p95 ms, MB/s):\n{format_table(rows)}")
+    if options.timing_output:
+        with open(options.timing_output, "w", encoding="utf-8", newline="") as csv_file:
+            writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+        logger.info(f"Timing breakdown written to {options.timing_output}")
+
+
+# Example of function usage
+if __name__ == "__main__":
+    from locust.stats import RequestStats
+
+    stats = RequestStats()
+    for _ in range(10):
+        stats.log_request(TTFB, "layer image/png", 120, 0)
+        stats.log_request(DOWNLOAD, "layer image/png", 30, 300_000)
+    stats.log_request(CONNECT, "layer image/png", 5, 0)
+    rows = throughput_rows(stats)
+    assert rows[0]["new_connections"] == 1 and rows[0]["megabytes"] == 3.0
+    assert abs(rows[0]["transfer_mb_s"] - 10.0) < 1e-9
+    print(format_table(rows))
@@ -0,0 +1,174 @@
+"""Precompiled request url templates
+
+Only a few query parameters change between two requests of a simulated user
+(bbox, tilerow, tilecol), the host and the static OGC parameters are parsed and
+url encoded once into a template.
+"""
+from typing import Dict, Iterable
+import functools
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse, quote_plus
+
+
+def build_url(host: str, params: Dict[str, object]) -> str:
+    """
+    Merge `params` into the query of `host` and return the full url.
+
+    Reference implementation, parses and encodes everything on each call.
+    The host may already contain query parameters, e.g.
+    https://host/cgi-bin/mapserv.exe?map=/mapfiles/my.map
+
+    Parameters:
+    - host (str): The base url, optionally with query parameters.
+    - params (dict): The query parameters of the request, overriding the host ones.
+
+    Returns:
+    - The full url.
+    """
+    # Parse the base URL
+    url_parts = urlparse(host)
+
+    # Extract existing query parameters
+    query_params = parse_qs(url_parts.query)
+
+    # Update the query parameters with the new ones
+    query_params.update(params)
+
+    # Rebuild the query string
+    new_query = urlencode(query_params, doseq=True)
+
+    # Construct the new URL
+    new_url_parts = url_parts._replace(query=new_query)
+    return urlunparse(new_url_parts)
+
+
+class QueryTemplate:
+    """
+    Url template compiled once from a host and the static query parameters.
+
+    `render` only url encodes the variable fields and produces the same url as
+    `build_url(host, {**static_params, **variable_params})`.
+
+    Example:
+    template = QueryTemplate(host, {"service": "WMTS", ...}, ("tilerow", "tilecol"))
+    url = template.render(tilerow=108, tilecol=56)
+    """
+
+    # marker put in place of the variable fields before encoding, urlencode
+    # turns it into %00<name>%00 which can not appear in an encoded query
+    _MARKER = "\x00"
+
+    def __init__(self, host: str, params: Dict[str, object], fields: Iterable[str]):
+        """
+        Parameters:
+        - host (str): The base url, optionally with query parameters.
+        - params (dict): The static query parameters of the request.
+        - fields (iterable of str): Names of the query parameters set on each render.
+        """
+        self.fields = tuple(fields)
+        placeholders = {field: f"{self._MARKER}{field}{self._MARKER}" for field in self.fields}
+        url = build_url(host, {**params, **placeholders})
+
+        # str.format template, static text is escaped
+        template = url.replace("{", "{{").replace("}", "}}")
+        for field in self.fields:
+            encoded = quote_plus(placeholders[field])
+            template = template.replace(encoded, "{" + field + "}")
+        self.template = template
+
+    def render(self, **values) -> str:
+        """
+        Return the url with the variable fields set to `values`, which are url
+        encoded as `urlencode` would do.
+        """
+        return self.template.format(
+            **{field: quote_plus(str(value)) for field, value in values.items()}
+        )
+
+    def render_encoded(self, **values) -> str:
+        """
+        Return the url with the variable fields set to `values`, which must be
+        already url encoded, e.g. integers or the output of `encode_bbox`.
+        """
+        return self.template.format(**values)
+
+
+@functools.lru_cache(maxsize=1024)
+def encode_value(value) -> str:
+    """
+    Url encode a value as urlencode would, cached for values repeated between
+    requests (e.g. TileMatrix identifiers).
+    """
+    return quote_plus(str(value))
+
+
+def encode_bbox(bbox: Iterable[float]) -> str:
+    """
+    Url encode a bbox as urlencode would encode ",".join(map(str, bbox)).
+
+    str(float) only has "+" as unsafe character besides the "," separator
+    (exponent of very large numbers e.g. 1e+16).
+    """
+    bbox_str = "%2C".join(map(str, bbox))
+    if "+" in bbox_str:
+        bbox_str = bbox_str.replace("+", "%2B")
+    return bbox_str
+
+
+# Example of class usage and micro-benchmark against the reference implementation
+if __name__ == "__main__":
+    import timeit
+
+    host = "https://ortos.dgterritorio.gov.pt/cgi-bin/mapserv.exe?map=/ms4w/apps/mapfile/mosaico2023.map"
+    params = {
+        "service": "WMS",
+        "version": "1.3.0",
+        "request": "GetMap",
+        "layers": "ortoSat2023-CorVerdadeira",
+        "styles": "",
+        "bbox": None,
+        "width": "512",
+        "height": "512",
+        "crs": "EPSG:3763",
+        "format": "image/png",
+    }
+    bbox_str = "-143566.40427116063,36617.15748174256,-133566.40427116063,46617.15748174256"
+    template = QueryTemplate(host, params, ("bbox",))
+    expected = build_url(host, {**params, "bbox": bbox_str})
+    assert template.render(bbox=bbox_str) == expected, (template.render(bbox=bbox_str), expected)
+    bbox = tuple(map(float, bbox_str.split(",")))
+    assert template.render_encoded(bbox=encode_bbox(bbox)) == expected
+    big_bbox = (1e16, -2.5e-07, 3e+20, 4.0)
+    assert template.render_encoded(bbox=encode_bbox(big_bbox)) == build_url(
+        host, {**params, "bbox": ",".join(map(str, big_bbox))}
+    )
+
+    wmts_host = "https://cartografia.dgterritorio.gov.pt/ortos2021/service?SERVICE=WMTS&a={b}"
+    wmts_params = {
+        "service": "WMTS",
+        "version": "1.0.0",
+        "request": "GetTile",
+        "layer": "Ortos2021-RGB",
+        "style": "default",
+        "tilematrix": "07",
+        "tilematrixset": "PTTM_06",
+        "tilerow": None,
+        "tilecol": None,
+        "format": "image%2Fpng",
+    }
+    wmts_template = QueryTemplate(wmts_host, wmts_params, ("tilerow", "tilecol"))
+    wmts_expected = build_url(wmts_host, {**wmts_params, "tilerow": 108, "tilecol": 56})
+    assert wmts_template.render(tilerow=108, tilecol=56) == wmts_expected
+    assert wmts_template.render_encoded(tilerow=108, tilecol=56) == wmts_expected
+
+    # per request cost, including the bbox/tile to string conversion
+    number = 100000
+    timings = {
+        "wms build_url": lambda: build_url(host, {**params, "bbox": ",".join(map(str, bbox))}),
+        "wms QueryTemplate.render": lambda: template.render(bbox=",".join(map(str, bbox))),
+        "wms QueryTemplate.render_encoded": lambda: template.render_encoded(bbox=encode_bbox(bbox)),
+        "wmts build_url": lambda: build_url(wmts_host, {**wmts_params, "tilerow": 108, "tilecol": 56}),
+        "wmts QueryTemplate.render_encoded": lambda: wmts_template.render_encoded(tilerow=108, tilecol=56),
+    }
+    for name, func in timings.items():
+        seconds = timeit.timeit(func, number=number)
+        print(f"{name:<36} {seconds / number * 1e6:6.2f} us per request")
@@ -0,0 +1,273 @@
+"""Cheap validation of GetMap/GetTile responses
+
+Many servers answer an invalid request with HTTP 200 and an XML
+ServiceException, or a blank (e.g. fully transparent) image when the bbox
+misses the data. Both are fast, locust would count them as successes and
+overstate the throughput. `ResponseValidator` checks each response without
+decoding the image, only its first bytes are read:
+
+- the Content-Type and the magic bytes (PNG, JPEG, GIF, WebP, TIFF) must be the
+  requested format, an XML body is reported with its exceptionCode;
+- the PNG IHDR or JPEG SOF dimensions must be the requested width and height;
+- on a sampled fraction of the responses, the compression ratio of the image
+  data (PNG IDAT chunks, JPEG body) against its raw pixel size: an empty or
+  single colour image compresses hundreds of times, real maps and imagery
+  about 2 to 20 times.
+
+Invalid and blank responses are failures of their own exception type, so they
+are counted apart in the locust failures table.
+"""
+from typing import Optional, Tuple
+import random
+import re
+import struct
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SIGNATURE = b"\xff\xd8\xff"
+# magic bytes of the image formats, checks of other formats are skipped
+SIGNATURES = {
+    "image/png": (PNG_SIGNATURE,),
+    "image/jpeg": (JPEG_SIGNATURE,),
+    "image/gif": (b"GIF87a", b"GIF89a"),
+    "image/webp": (b"RIFF",),
+    "image/tiff": (b"II*\x00", b"MM\x00*"),
+}
+# PNG bytes per pixel of each color type, for 8 bit samples
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+# JPEG start of frame markers (not DHT, JPG and DAC)
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# bytes of the body searched for an exception code
+XML_HEAD_SIZE = 2048
+
+DEFAULT_BLANK_RATIO = 100.0
+
+
+class InvalidResponseError(Exception):
+    """The response is not an image of the requested format and size."""
+
+    pass
+
+
+class ServiceExceptionError(InvalidResponseError):
+    """The service answered with an XML ServiceException/ExceptionReport."""
+
+    pass
+
+
+class BlankImageError(Exception):
+    """The image is empty or of a single colour."""
+
+    pass
+
+
+def base_format(mime_type: Optional[str]) -> str:
+    """Mime type without its parameters, e.g. "image/png" for "image/png; mode=8bit" """
+    return (mime_type or "").split(";")[0].strip().lower()
+
+
+def exception_code(body: bytes) -> str:
+    """exceptionCode (or code) attribute of a ServiceException body, "unknown" without one"""
+    match = re.search(rb'(?:exceptionCode|code)\s*=\s*["\']([^"\']+)', body[:XML_HEAD_SIZE])
+    return match.group(1).decode("utf-8", "replace") if match else "unknown"
+
+
+def png_size(body: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) of the PNG IHDR chunk"""
+    if len(body) < 24 or body[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", body[16:24])
+
+
+def jpeg_size(body: bytes) -> Optional[Tuple[int, int]]:
+    """(width, height) of the JPEG SOF segment, the segments before it are skipped by their length"""
+    position = 2
+    while position + 9 <= len(body):
+        if body[position] != 0xFF:
+            return None
+        marker = body[position + 1]
+        if marker == 0xFF:
+            # fill byte
+            position += 1
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", body[position + 5 : position + 9])
+            return width, height
+        position += 2 + struct.unpack(">H", body[position + 2 : position + 4])[0]
+    return None
+
+
+def png_compression_ratio(body: bytes) -> Optional[float]:
+    """Raw pixel bytes over the IDAT chunk bytes, chunks are walked by their length"""
+    size = png_size(body)
+    if size is None:
+        return None
+    bit_depth, color_type = body[24], body[25]
+    channels = PNG_CHANNELS.get(color_type, 4)
+    # one filter byte per row
+    raw_size = size[1] * (1 + (size[0] * channels * bit_depth + 7) // 8)
+    data_size = 0
+    position = 8
+    while position + 8 <= len(body):
+        length = struct.unpack(">I", body[position : position + 4])[0]
+        chunk_type = body[position + 4 : position + 8]
+        if chunk_type == b"IDAT":
+            data_size += length
+        elif chunk_type == b"IEND":
+            break
+        position += 12 + length
+    return raw_size / data_size if data_size else float("inf")
+
+
+def jpeg_compression_ratio(body: bytes) -> Optional[float]:
+    """Raw pixel bytes (3 per pixel) over the JPEG size"""
+    size = jpeg_size(body)
+    if size is None:
+        return None
+    return size[0] * size[1] * 3 / len(body)
+
+
+class ResponseValidator:
+    """
+    Validate image responses against the requested format and size.
+
+    Example:
+    validator = ResponseValidator("image/png", blank_fraction=0.1)
+    error = validator.validate(200, response.headers, response.content, 512, 512)
+    if error:
+        response.failure(error)
+    """
+
+    def __init__(
+        self,
+        image_format: str,
+        blank_fraction: float = 0.0,
+        blank_ratio: float = DEFAULT_BLANK_RATIO,
+        rng: Optional[random.Random] = None,
+    ):
+        """
+        Parameters:
+        - image_format (str): Requested format, e.g. "image/png".
+        - blank_fraction (float): Fraction of the responses checked for blank images, 0 disables the check.
+        - blank_ratio (float): Compression ratio from which an image is blank.
+        - rng (random.Random): Optional. Random number generator of the sampling.
+        """
+        if not 0.0 <= blank_fraction <= 1.0:
+            raise ValueError(f"Blank image fraction must be between 0 and 1, got {blank_fraction}")
+        self.image_format = base_format(image_format)
+        self.blank_fraction = blank_fraction
+        self.blank_ratio = blank_ratio
+        self.rng = rng or random.Random()
+
+    def validate(
+        self, status_code: int, headers, body: Optional[bytes], width: int, height: int, image_format: Optional[str] = None
+    ) -> Optional[Exception]:
+        """
+        Return the InvalidResponseError or BlankImageError of a response, None
+        when it is valid. Only successful (200) responses are checked.
+
+        Parameters:
+        - status_code (int): HTTP status of the response.
+        - headers: Dict like response headers, case insensitive.
+        - body (bytes): Response body.
+        - width, height (int): Requested image size.
+        - image_format (str): Optional. Requested format, when not the one of the validator (sweeps).
+        """
+        if status_code != 200 or body is None:
+            return None
+        expected = base_format(image_format) if image_format else self.image_format
+        content_type = base_format(headers.get("Content-Type") if headers else None)
+        head = body[:16].lstrip()
+        if "xml" in content_type or head.startswith(b"<"):
+            return ServiceExceptionError(f"ServiceException {exception_code(body)}")
+        if content_type and content_type != expected:
+            return InvalidResponseError(f"Content-Type {content_type} instead of {expected}")
+        signatures = SIGNATURES.get(expected)
+        if signatures and not body.startswith(signatures):
+            return InvalidResponseError(f"Body is not {expected}")
+
+        if expected == "image/png":
+            size, ratio = png_size, png_compression_ratio
+        elif expected == "image/jpeg":
+            size, ratio = jpeg_size, jpeg_compression_ratio
+        else:
+            return None
+        actual = size(body)
+        if actual is None:
+            return InvalidResponseError(f"No {expected} image size")
+        if actual != (width, height):
+            # the sizes are left out of the message, all the size mismatches are counted together
+            return InvalidResponseError("Image size is not the requested size")
+        if self.blank_fraction and self.rng.random() < self.blank_fraction:
+            compression = ratio(body)
+            if compression is not None and compression >= self.blank_ratio:
+                return BlankImageError("Blank image")
+        return None
+
+
+def validator_from_options(parsed_options, image_format: str, rng: Optional[random.Random] = None) -> Optional[ResponseValidator]:
+    """ResponseValidator of the --validate-* options, None when --validate-responses is not set"""
+    if not getattr(parsed_options, "validate_responses", False):
+        return None
+    return ResponseValidator(
+        image_format,
+        blank_fraction=parsed_options.validate_blank_fraction,
+        blank_ratio=parsed_options.validate_blank_ratio,
+        rng=rng,
+    )
+
+
+def check_response(response, validator: ResponseValidator, width: int, height: int, image_format: Optional[str] = None):
+    """
+    Mark a catch_response=True response as failed when it is not valid,
+    before the `with` block exits. Returns the error.
+    """
+    error = validator.validate(response.status_code, response.headers, response.content, width, height, image_format)
+    if error is not None:
+        response.failure(error)
+    return error
+
+
+def add_arguments(parser):
+    """Add the --validate-* options of validator_from_options() to the locust command line parser"""
+    parser.add_argument(
+        "--validate-responses",
+        action="store_true",
+        default=False,
+        help="Check that responses are images of the requested format and size (Content-Type, magic bytes, PNG/JPEG header), ServiceExceptions and invalid images are counted as failures",
+    )
+    parser.add_argument(
+        "--validate-blank-fraction",
+        type=float,
+        default=0.0,
+        help="Fraction of the validated responses also checked for blank (empty or single colour) images. Defaults to 0",
+    )
+    parser.add_argument(
+        "--validate-blank-ratio",
+        type=float,
+        default=100.0,
+        help="Compression ratio (raw pixel size over image data size) from which an image is blank. Defaults to 100",
+    )
+
+
+# Example of class usage
+if __name__ == "__main__":
+    import zlib
+
+    def png(width, height, rows):
+        chunk = lambda kind, data: struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+        header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+        return PNG_SIGNATURE + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+    headers = {"Content-Type": "image/png"}
+    blank = png(256, 256, (b"\x00" + b"\x00" * 256 * 4) * 256)
+    noise = png(256, 256, random.Random(1).randbytes(257 * 256 * 4))
+    validator = ResponseValidator("image/png", blank_fraction=1.0)
+    assert validator.validate(200, headers, noise, 256, 256) is None
+    assert isinstance(validator.validate(200, headers, blank, 256, 256), BlankImageError)
+    assert isinstance(validator.validate(200, headers, noise, 512, 512), InvalidResponseError)
+    exception = b'<?xml version="1.0"?><ServiceExceptionReport><ServiceException code="InvalidCRS">'
+    error = validator.validate(200, {"Content-Type": "text/xml"}, exception, 256, 256)
+    assert isinstance(error, ServiceExceptionError) and str(error) == "ServiceException InvalidCRS"
+    jpeg = JPEG_SIGNATURE + b"\xe0\x00\x10" + b"\x00" * 14 + b"\xff\xc0\x00\x11\x08\x01\x00\x02\x00\x03"
+    assert jpeg_size(jpeg) == (512, 256)
+    print(f"blank ratio {png_compression_ratio(blank):.0f}, noise ratio {png_compression_ratio(noise):.2f}")
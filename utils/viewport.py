@@ -0,0 +1,255 @@
+"""Browser-like map viewer sessions over a WMTS TileMatrixSet
+
+A web map does not fetch one random tile at a time: it fetches every tile of
+its viewport (e.g. 4x3 to 6x4 tiles of 256px) over a few parallel
+connections, then the user pans to the neighbouring tiles or zooms to the next
+TileMatrix. `ViewerSession` yields the successive viewports of such a session,
+the requests themselves are sent by the locustfile.
+"""
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+import math
+import random
+
+from utils.bbox_grid import tile_matrix_grid
+from utils.coverage import TileRange
+
+# request_type of the viewport complete entries in locust statistics
+REQUEST_TYPE = "VIEWPORT"
+
+
+class ViewportError(Exception):
+    """Some tiles of a viewport failed, the viewport is not complete."""
+
+    pass
+
+
+class Level(NamedTuple):
+    """One TileMatrix of the pyramid, with its tile span in CRS units"""
+
+    identifier: str
+    matrix_width: int
+    matrix_height: int
+    left: float
+    top: float
+    tile_span_x: float
+    tile_span_y: float
+    # TileCol/TileRow range with tiles (inclusive), the whole matrix by default
+    min_col: int
+    max_col: int
+    min_row: int
+    max_row: int
+
+
+def pyramid_levels(tile_matrix_set, ranges: Optional[Dict[str, TileRange]] = None) -> List[Level]:
+    """
+    Return the levels of an owslib TileMatrixSet, from the smallest scale
+    (zoomed out) to the largest one.
+
+    Parameters:
+    - tile_matrix_set: owslib TileMatrixSet.
+    - ranges (dict): Optional. TileMatrix identifier to the (min_col, max_col, min_row, max_row)
+      tiles with data, e.g. from utils.coverage.layer_tile_ranges(). TileMatrix
+      missing from it are left out of the pyramid.
+    """
+    levels = []
+    for identifier, tile_matrix in tile_matrix_set.tilematrix.items():
+        if ranges is not None and identifier not in ranges:
+            continue
+        min_col, max_col, min_row, max_row = (
+            ranges[identifier]
+            if ranges is not None
+            else (0, tile_matrix.matrixwidth - 1, 0, tile_matrix.matrixheight - 1)
+        )
+        grid = tile_matrix_grid(tile_matrix, tile_matrix_set.crs)
+        levels.append(
+            Level(
+                identifier=identifier,
+                matrix_width=tile_matrix.matrixwidth,
+                matrix_height=tile_matrix.matrixheight,
+                left=grid.left,
+                top=grid.top,
+                tile_span_x=grid.span_x,
+                tile_span_y=grid.span_y,
+                min_col=min_col,
+                max_col=max_col,
+                min_row=min_row,
+                max_row=max_row,
+            )
+        )
+    return sorted(levels, key=lambda level: -level.tile_span_x)
+
+
+def parse_viewport_size(value: str) -> Tuple[int, int]:
+    """
+    Parse a "COLSxROWS" viewport size, e.g. "4x3".
+    """
+    try:
+        cols, rows = (int(part) for part in value.lower().split("x"))
+    except ValueError:
+        raise ValueError(f"Viewport size must be COLSxROWS (e.g. 4x3), got {value!r}")
+    if cols < 1 or rows < 1:
+        raise ValueError(f"Viewport size must be at least 1x1, got {value!r}")
+    return cols, rows
+
+
+class ViewerSession:
+    """
+    Successive viewports of a simulated map viewer.
+
+    A session starts at a random position of the start level, then each
+    viewport is a pan (shift of up to half the viewport) or, with
+    `zoom_probability`, a zoom in or out to the adjacent level around the same
+    center. After `session_length` viewports a new session starts.
+
+    Example:
+    session = ViewerSession(pyramid_levels(tile_matrix_set), "07", cols=4, rows=3, rng=rng)
+    tile_matrix, tiles = next(session)  # tiles is a list of (col, row), center first
+    """
+
+    def __init__(
+        self,
+        levels: List[Level],
+        start_level: str,
+        cols: int = 4,
+        rows: int = 3,
+        rng: Optional[random.Random] = None,
+        session_length: int = 10,
+        zoom_probability: float = 0.3,
+        origins: Optional[Dict[str, Iterator[Tuple[int, int]]]] = None,
+        start_levels: Optional[Iterator[str]] = None,
+    ):
+        """
+        Parameters:
+        - levels (list of Level): The pyramid, from pyramid_levels().
+        - start_level (str): TileMatrix identifier where sessions start.
+        - cols, rows (int): Viewport size in tiles.
+        - rng (random.Random): Optional. Random number generator of the session.
+        - session_length (int): Viewports of a session before jumping to a new random position.
+        - zoom_probability (float): Probability of a zoom instead of a pan.
+        - origins (dict): Optional. TileMatrix identifier to an iterator of (col, row) center
+          tiles of the new sessions on that level, e.g. a utils.coverage.CoverageSampler.
+          Levels missing from it start uniformly.
+        - start_levels (iterator): Optional. TileMatrix identifiers where each new session
+          starts, e.g. drawn from a utils.tile_matrix_mix.TileMatrixMix. Defaults to start_level.
+        """
+        self.levels = levels
+        self.start_index = [level.identifier for level in levels].index(start_level)
+        self.cols = cols
+        self.rows = rows
+        self.rng = rng or random.Random()
+        self.session_length = session_length
+        self.zoom_probability = zoom_probability
+        self.origins = origins or {}
+        self.start_levels = start_levels
+        self.identifiers = [level.identifier for level in levels]
+        self.viewports = 0
+        self.level_index = self.start_index
+        self.col = self.row = 0  # top left tile of the viewport
+
+    def __iter__(self) -> Iterator[Tuple[str, List[Tuple[int, int]]]]:
+        return self
+
+    def __next__(self) -> Tuple[str, List[Tuple[int, int]]]:
+        if self.viewports % self.session_length == 0:
+            self.jump()
+        elif self.rng.random() < self.zoom_probability and len(self.levels) > 1:
+            self.zoom()
+        else:
+            self.pan()
+        self.viewports += 1
+        return self.levels[self.level_index].identifier, self.tiles()
+
+    def size(self) -> Tuple[int, int]:
+        """Viewport size on the current level, smaller than the level if needed"""
+        level = self.levels[self.level_index]
+        return (
+            min(self.cols, level.max_col - level.min_col + 1),
+            min(self.rows, level.max_row - level.min_row + 1),
+        )
+
+    def clamp(self):
+        """Keep the viewport inside the tiles of the current level"""
+        level = self.levels[self.level_index]
+        cols, rows = self.size()
+        self.col = min(max(self.col, level.min_col), level.max_col - cols + 1)
+        self.row = min(max(self.row, level.min_row), level.max_row - rows + 1)
+
+    def jump(self):
+        """Start a new session at a random position of the start level"""
+        self.level_index = self.start_index
+        if self.start_levels is not None:
+            self.level_index = self.identifiers.index(next(self.start_levels))
+        level = self.levels[self.level_index]
+        cols, rows = self.size()
+        if level.identifier in self.origins:
+            col, row = next(self.origins[level.identifier])
+            self.col, self.row = col - (cols - 1) // 2, row - (rows - 1) // 2
+            self.clamp()
+            return
+        self.col = self.rng.randint(level.min_col, level.max_col - cols + 1)
+        self.row = self.rng.randint(level.min_row, level.max_row - rows + 1)
+
+    def pan(self):
+        """Shift the viewport by up to half its size, at least one tile"""
+        cols, rows = self.size()
+        half_cols, half_rows = max(cols // 2, 1), max(rows // 2, 1)
+        shift_col = shift_row = 0
+        while shift_col == 0 and shift_row == 0:
+            shift_col = self.rng.randint(-half_cols, half_cols)
+            shift_row = self.rng.randint(-half_rows, half_rows)
+        self.col += shift_col
+        self.row += shift_row
+        self.clamp()
+
+    def zoom(self):
+        """Zoom in or out to the adjacent level, keeping the viewport center"""
+        if self.level_index == 0:
+            step = 1
+        elif self.level_index == len(self.levels) - 1:
+            step = -1
+        else:
+            step = self.rng.choice((-1, 1))
+        level = self.levels[self.level_index]
+        cols, rows = self.size()
+        center_x = level.left + (self.col + cols / 2) * level.tile_span_x
+        center_y = level.top - (self.row + rows / 2) * level.tile_span_y
+
+        self.level_index += step
+        level = self.levels[self.level_index]
+        cols, rows = self.size()
+        self.col = math.floor((center_x - level.left) / level.tile_span_x - cols / 2 + 0.5)
+        self.row = math.floor((level.top - center_y) / level.tile_span_y - rows / 2 + 0.5)
+        self.clamp()
+
+    def tiles(self) -> List[Tuple[int, int]]:
+        """(col, row) of the viewport tiles, center first as web map clients load them"""
+        cols, rows = self.size()
+        center_col = self.col + (cols - 1) / 2
+        center_row = self.row + (rows - 1) / 2
+        tiles = [
+            (col, row)
+            for row in range(self.row, self.row + rows)
+            for col in range(self.col, self.col + cols)
+        ]
+        return sorted(tiles, key=lambda tile: (tile[0] - center_col) ** 2 + (tile[1] - center_row) ** 2)
+
+
+# Example of class usage
+if __name__ == "__main__":
+    levels = [
+        Level(f"{i:02d}", 2**i, 2**i, 0.0, 0.0, 1.0 / 2**i, 1.0 / 2**i, 0, 2**i - 1, 0, 2**i - 1)
+        for i in range(10)
+    ]
+    session = ViewerSession(levels, "05", cols=4, rows=3, rng=random.Random(1640), session_length=5)
+    for _ in range(12):
+        identifier, tiles = next(session)
+        level = levels[int(identifier)]
+        assert len(tiles) == min(4, level.matrix_width) * min(3, level.matrix_height)
+        assert all(0 <= col < level.matrix_width and 0 <= row < level.matrix_height for col, row in tiles)
+        print(identifier, tiles[0], len(tiles))
+
+    # sessions starting on drawn levels
+    session = ViewerSession(
+        levels, "05", rng=random.Random(1640), session_length=1, start_levels=iter(["02", "07"])
+    )
+    assert [next(session)[0] for _ in range(2)] == ["02", "07"]
@@ -0,0 +1,339 @@
+"""Precomputed workload plans
+
+A workload plan is a sequence of requests generated once and saved to a NumPy
+`.npy` file, so the same requests can be replayed against several servers and
+no random numbers are drawn while the benchmark is running:
+
+- WMS plans are float64 arrays of shape (N, 4), one (minx, miny, maxx, maxy) bbox per row,
+  x being the longitude in geographic CRS (swapped when sent to a latitude first WMS 1.3.0 CRS).
+- WMTS plans are structured arrays of shape (N,) with (matrix, col, row) fields.
+
+The files are written and read (through a memory map) with the standard
+library only, numpy can load them with `numpy.load(path, mmap_mode="r")`.
+
+Usage:
+python -m utils.workload wms --host <url> --count 100000 --random-seed 1640 --output plan.npy
+python -m utils.workload wmts --host <url> --tile-matrix 07 --count 100000 --output plan.npy
+"""
+from typing import Iterable, Iterator, Optional, Tuple
+import argparse
+import ast
+import itertools
+import json
+import logging
+import mmap
+import struct
+
+from utils.random_bbox import generate_random_bbox
+from utils.seeding import user_random
+
+logger = logging.getLogger(__name__)
+
+NPY_MAGIC = b"\x93NUMPY"
+
+WMS = "wms"
+WMTS = "wmts"
+
+# Tile matrix identifiers are stored as fixed length byte strings
+TILE_MATRIX_LENGTH = 16
+
+# numpy dtype description and struct format of a plan row
+ROW_FORMATS = {
+    WMS: ("<f8", "<4d"),
+    WMTS: (
+        [("matrix", f"|S{TILE_MATRIX_LENGTH}"), ("col", "<i4"), ("row", "<i4")],
+        f"<{TILE_MATRIX_LENGTH}sii",
+    ),
+}
+
+
+class WorkloadError(ValueError):
+    """Custom exception for invalid workload plan files."""
+
+    pass
+
+
+def npy_header(descr, shape: Tuple[int, ...]) -> bytes:
+    """Version 1.0 .npy header of a C order array"""
+    header = repr({"descr": descr, "fortran_order": False, "shape": shape})
+    # magic (6) + version (2) + header length (2) + header, padded to 64 bytes with a final newline
+    padding = 64 - (10 + len(header) + 1) % 64
+    header = header + " " * padding + "\n"
+    return NPY_MAGIC + b"\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+def read_npy_header(buffer) -> Tuple[dict, int]:
+    """Return the header dict of a .npy buffer and the offset of its data"""
+    if buffer[6] == 1:
+        (header_length,) = struct.unpack_from("<H", buffer, 8)
+        offset = 10 + header_length
+    else:
+        (header_length,) = struct.unpack_from("<I", buffer, 8)
+        offset = 12 + header_length
+    return ast.literal_eval(bytes(buffer[offset - header_length : offset]).decode("latin1")), offset
+
+
+def _npy_header(kind: str, count: int) -> bytes:
+    """.npy header of a plan with `count` rows"""
+    descr, _ = ROW_FORMATS[kind]
+    return npy_header(descr, (count, 4) if kind == WMS else (count,))
+
+
+def write_plan(path: str, kind: str, count: int, rows: Iterable[tuple]):
+    """
+    Write the first `count` rows of `rows` as a workload plan.
+
+    Parameters:
+    - path (str): Output .npy file.
+    - kind (str): "wms" for (minx, miny, maxx, maxy) rows, "wmts" for (matrix, col, row) rows.
+    - count (int): Number of rows.
+    - rows (iterable): Rows of the plan, e.g. a bbox or tile generator.
+    """
+    _, row_format = ROW_FORMATS[kind]
+    packer = struct.Struct(row_format)
+    written = 0
+    with open(path, "wb") as plan_file:
+        plan_file.write(_npy_header(kind, count))
+        chunk = bytearray()
+        for row in itertools.islice(rows, count):
+            if kind == WMTS:
+                matrix, col, row_index = row
+                row = (str(matrix).encode("ascii"), col, row_index)
+            chunk += packer.pack(*row)
+            written += 1
+            if len(chunk) >= 1 << 20:
+                plan_file.write(chunk)
+                chunk = bytearray()
+        plan_file.write(chunk)
+    if written != count:
+        raise WorkloadError(f"Only {written} of {count} rows were generated")
+
+
+class WorkloadPlan:
+    """
+    Read only, memory mapped, workload plan.
+
+    Example:
+    plan = WorkloadPlan("plan.npy")
+    minx, miny, maxx, maxy = plan[0]
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as plan_file:
+            self._mmap = mmap.mmap(plan_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:6] != NPY_MAGIC:
+            raise WorkloadError(f"{path} is not a .npy file")
+        header, self._offset = read_npy_header(self._mmap)
+
+        for kind, (descr, row_format) in ROW_FORMATS.items():
+            if header["descr"] == descr:
+                self.kind = kind
+                self._struct = struct.Struct(row_format)
+                break
+        else:
+            raise WorkloadError(f"{path} has an unknown row type {header['descr']}")
+        if header["fortran_order"]:
+            raise WorkloadError(f"{path} must be in C order")
+        self.count = header["shape"][0]
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> tuple:
+        row = self._struct.unpack_from(self._mmap, self._offset + index * self._struct.size)
+        if self.kind == WMTS:
+            matrix, col, row_index = row
+            return matrix.rstrip(b"\x00").decode("ascii"), col, row_index
+        return row
+
+    def shard(self, index: int, count: int) -> Tuple[int, int]:
+        """
+        Return the [start, stop) rows of shard `index` out of `count` contiguous
+        shards, e.g. one per distributed worker.
+        """
+        if not 0 <= index < count:
+            raise WorkloadError(f"Shard {index} is not in 0..{count - 1}")
+        return self.count * index // count, self.count * (index + 1) // count
+
+    def close(self):
+        self._mmap.close()
+
+
+class PlanCursor:
+    """
+    Rows of a shard of a plan, shared by all users of a process so that each
+    row is requested once (until the shard wraps around).
+    """
+
+    def __init__(self, plan: WorkloadPlan, start: int, stop: int):
+        if stop <= start:
+            raise WorkloadError(f"Workload plan {plan.path} has no rows in [{start}, {stop})")
+        self.plan = plan
+        self.start = start
+        self.length = stop - start
+        # next() on itertools.count does not yield to other greenlets
+        self._counter = itertools.count()
+
+    def __iter__(self) -> Iterator[tuple]:
+        return self
+
+    def __next__(self) -> tuple:
+        return self.plan[self.start + next(self._counter) % self.length]
+
+
+# Cursors shared by the users of the process, key is (path, shard index, shard count)
+_cursors = {}
+
+
+def plan_cursor(path: str, kind: str, shard_index: int = 0, shard_count: int = 1) -> PlanCursor:
+    """
+    Return the cursor over shard `shard_index` of the plan in `path`, shared by
+    all the users of the process.
+
+    Parameters:
+    - path (str): The .npy workload plan.
+    - kind (str): Expected kind of plan, "wms" or "wmts".
+    - shard_index (int): Shard of this process, e.g. the locust worker index.
+    - shard_count (int): Number of shards, e.g. the number of locust workers.
+    """
+    key = (path, shard_index, shard_count)
+    if key not in _cursors:
+        plan = WorkloadPlan(path)
+        if plan.kind != kind:
+            raise WorkloadError(f"{path} is a {plan.kind} workload plan, expected {kind}")
+        start, stop = plan.shard(shard_index, shard_count)
+        logger.info(f"Workload plan {path}: rows {start} to {stop} of {len(plan)}")
+        _cursors[key] = PlanCursor(plan, start, stop)
+    return _cursors[key]
+
+
+def tile_generator(
+    matrix: str, matrix_range: Tuple[int, int, int, int], seed: int, coverage_file: Optional[str] = None
+) -> Iterator[Tuple[str, int, int]]:
+    """
+    Yield (matrix, col, row) tiles as the first user of wmts.py draws them for `seed`.
+
+    Parameters:
+    - matrix (str): TileMatrix identifier.
+    - matrix_range (tuple): (min_col, max_col, min_row, max_row) tiles of the layer.
+    - seed (int): The --random-seed of the run.
+    - coverage_file (str): Optional. Coverage mask (utils.coverage) to draw tiles with data only.
+    """
+    if coverage_file:
+        from utils.coverage import load_mask
+
+        for col, row in load_mask(coverage_file).sampler(matrix, user_random(seed, 0, 0, "coverage")):
+            yield matrix, col, row
+    min_col, max_col, min_row, max_row = matrix_range
+    col_rng = user_random(seed, 0, 0, "col")
+    row_rng = user_random(seed, 0, 0, "row")
+    while True:
+        yield matrix, col_rng.randint(min_col, max_col), row_rng.randint(min_row, max_row)
+
+
+def _wms_extent(args) -> Tuple[Tuple[float, float, float, float], Optional[str]]:
+    """
+    (bbox, crs) of the plan, given on the command line or of the layer in
+    GetCapabilities. In geographic CRS x is the longitude.
+    """
+    if args.bbox:
+        return tuple(args.bbox), args.crs
+    from utils.capabilities import load_capabilities
+    from utils.crs import capabilities_bbox
+
+    wms = load_capabilities("WMS", args.host, capabilities_file=args.capabilities_file)
+    layer_name = args.layer_name or list(wms.contents)[0]
+    bounding_box = wms.contents[layer_name].boundingBox
+    return capabilities_bbox(bounding_box, bounding_box[-1], wms.version), args.crs or bounding_box[-1]
+
+
+def _wmts_matrix(args) -> Tuple[str, Tuple[int, int, int, int]]:
+    """
+    (identifier, (min_col, max_col, min_row, max_row)) of the tile matrix, given on
+    the command line or from GetCapabilities, within the layer limits and extent
+    """
+    if args.matrix_width and args.matrix_height:
+        return args.tile_matrix, (0, args.matrix_width - 1, 0, args.matrix_height - 1)
+    from utils.capabilities import load_capabilities
+    from utils.coverage import layer_tile_ranges
+
+    wmts = load_capabilities("WMTS", args.host, capabilities_file=args.capabilities_file)
+    layer = wmts.contents[args.layer_name or list(wmts.contents.keys())[0]]
+    tile_matrix_set = wmts.tilematrixsets[args.tile_matrix_set or list(layer.tilematrixsetlinks.keys())[0]]
+    tile_matrices = list(tile_matrix_set.tilematrix.keys())
+    tile_matrix = args.tile_matrix or tile_matrices[len(tile_matrices) // 2]
+    ranges = layer_tile_ranges(layer, tile_matrix_set)
+    if tile_matrix not in ranges:
+        raise WorkloadError(f"TileMatrix {tile_matrix} has no tiles in layer {layer.id}")
+    return tile_matrix, ranges[tile_matrix]
+
+
+def main(argv: Optional[list] = None):
+    parser = argparse.ArgumentParser(description="Generate a workload plan for wms.py/wmts.py --workload-file")
+    subparsers = parser.add_subparsers(dest="kind", required=True)
+
+    wms_parser = subparsers.add_parser(WMS, help="GetMap bboxes")
+    wms_parser.add_argument("--bbox", type=float, nargs=4, metavar=("MINX", "MINY", "MAXX", "MAXY"), help="Full extent, instead of the layer bbox from GetCapabilities")
+    wms_parser.add_argument("--bbox-area", type=float, default=100.0, help="Bounding box area in km2")
+    wms_parser.add_argument("--bbox-ratio", type=float, default=1.0, help="Bounding box width/height ratio")
+    wms_parser.add_argument("--crs", type=str, default=None, help="CRS of --bbox, the area is kept on the ground in geographic CRS. Defaults to the layer bbox CRS")
+
+    wmts_parser = subparsers.add_parser(WMTS, help="GetTile (matrix, col, row)")
+    wmts_parser.add_argument("--tile-matrix-set", type=str, default=None, help="Layer's TileMatrixSet, defaults to the first one")
+    wmts_parser.add_argument("--tile-matrix", type=str, default=None, help="TileMatrix, defaults to the median level")
+    wmts_parser.add_argument("--matrix-width", type=int, default=None, help="Number of cols, instead of reading GetCapabilities, with --matrix-height and --tile-matrix")
+    wmts_parser.add_argument("--matrix-height", type=int, default=None, help="Number of rows, instead of reading GetCapabilities, with --matrix-width and --tile-matrix")
+    wmts_parser.add_argument("--coverage-file", type=str, default=None, help="Coverage mask (python -m utils.coverage) to draw tiles with data only")
+
+    for subparser in (wms_parser, wmts_parser):
+        subparser.add_argument("--host", type=str, default="", help="Service url, to read the extent from GetCapabilities")
+        subparser.add_argument("--capabilities-file", type=str, default=None, help="Local GetCapabilities XML file")
+        subparser.add_argument("--layer-name", type=str, default="", help="Layer, defaults to the first one")
+        subparser.add_argument("--random-seed", type=int, default=1640, help="Random seed of the plan")
+        subparser.add_argument("--count", type=int, required=True, help="Number of requests in the plan")
+        subparser.add_argument("--output", type=str, required=True, help="Output .npy file")
+
+    args = parser.parse_args(argv)
+    if args.kind == WMTS and (args.matrix_width or args.matrix_height):
+        if not (args.matrix_width and args.matrix_height and args.tile_matrix):
+            wmts_parser.error("--matrix-width and --matrix-height must be given together, with --tile-matrix")
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+
+    if args.kind == WMS:
+        extent, crs = _wms_extent(args)
+        rows = generate_random_bbox(
+            *extent,
+            seed=args.random_seed,
+            area=args.bbox_area,
+            ratio=args.bbox_ratio,
+            rng=user_random(args.random_seed, 0, 0, "bbox"),
+            crs=crs,
+        )
+        meta = {"extent": extent, "crs": crs, "bbox_area": args.bbox_area, "bbox_ratio": args.bbox_ratio}
+    else:
+        tile_matrix, matrix_range = _wmts_matrix(args)
+        if len(tile_matrix.encode("ascii")) > TILE_MATRIX_LENGTH:
+            raise WorkloadError(f"TileMatrix identifier {tile_matrix} is longer than {TILE_MATRIX_LENGTH} characters")
+        rows = tile_generator(tile_matrix, matrix_range, args.random_seed, args.coverage_file)
+        meta = {
+            "tile_matrix_set": args.tile_matrix_set,
+            "tile_matrix": tile_matrix,
+            "tile_range": matrix_range,
+            "coverage_file": args.coverage_file,
+        }
+
+    write_plan(args.output, args.kind, args.count, rows)
+    # plain text provenance of the plan, not needed to replay it
+    with open(f"{args.output}.json", "w", encoding="utf-8") as meta_file:
+        json.dump(
+            {"kind": args.kind, "host": args.host, "layer_name": args.layer_name, "random_seed": args.random_seed, "count": args.count, **meta},
+            meta_file,
+            indent=2,
+        )
+    logger.info(f"Wrote {args.count} {args.kind} requests to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
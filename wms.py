@@ -1,11 +1,33 @@
 import sys, os
 import random
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+import itertools
+import time
 from locust import FastHttpUser, events, task, between, run_single_user
-from owslib.wms import WebMapService
-
-from utils.random_bbox import generate_random_bbox
 
+from utils.random_bbox import generate_centered_bbox, generate_random_bbox
+from utils.capabilities import load_capabilities, load_layer_capabilities
+from utils.url_template import QueryTemplate, encode_bbox
+from utils.seeding import user_random, worker_count, worker_index
+from utils.workload import WMS, plan_cursor
+from utils.arrival import ARRIVAL_PROCESSES, CONSTANT, OpenLoop, user_rate
+from utils.hotspots import load_hotspots
+from utils.bbox_grid import BBoxGridError, GridBBoxes, parse_bbox_grid, tile_matrix_grid
+from utils.crs import axis_swapped, crs_code, crs_info, layer_bbox, swap_axes
+from utils.sweep import (
+    SweepArgError,
+    check_available,
+    comparison_rows,
+    format_table,
+    parse_areas,
+    parse_image_sizes,
+    parse_list,
+    stage_index,
+    sweep_cases,
+    write_csv,
+)
+from utils import arrival, cache_status, capabilities, capacity, connections, distributed, heatmap, history, metrics, saturation, timing, validation
+
+import gevent
 import requests
 import logging
 
@@ -44,7 +66,7 @@ def init_parser(parser):
         "--bbox-area",
         type=float,
         default=100.0,
-        help="Bounding box area in square meters or square degrees, depending on projection used. Defaults is 100km2 or 10x10km on bbox-ratio=1.0",
+        help="Bounding box area in km2 on the ground, also in geographic CRS (EPSG:4326) where the width in degrees follows the latitude. Defaults is 100km2 or 10x10km on bbox-ratio=1.0",
     )
     parser.add_argument(
         "--bbox-ratio",
@@ -52,7 +74,406 @@ def init_parser(parser):
         default=1.0,
         help="Bounding box width/height ratio, better to keep it as 1.0 (square)",
     )
-    
+    parser.add_argument(
+        "--capabilities-file",
+        type=str,
+        default=None,
+        help="Local GetCapabilities XML file to use instead of requesting it from the host",
+    )
+    capabilities.add_arguments(parser)
+    parser.add_argument(
+        "--workload-file",
+        type=str,
+        default=None,
+        help="Workload plan (.npy) of bboxes made with 'python -m utils.workload wms', replayed instead of random bboxes",
+    )
+    parser.add_argument(
+        "--hotspot-file",
+        type=str,
+        default=None,
+        help="Hotspot weights: .asc weight grid, .csv of x,y,weight points, in the layer CRS. Bbox centers are drawn from it instead of uniformly",
+    )
+    parser.add_argument(
+        "--hotspot-zipf",
+        type=float,
+        default=None,
+        help="Zipf exponent, the hotspot weights are replaced by 1/rank^exponent (csv file order or decreasing grid weight)",
+    )
+    parser.add_argument(
+        "--hotspot-radius",
+        type=float,
+        default=0.0,
+        help="Hotspot points are moved randomly by up to this distance (CRS units) in x and y. Defaults to 0",
+    )
+    parser.add_argument(
+        "--target-rps",
+        type=float,
+        default=0.0,
+        help="Open loop mode: total requests per second sent on a fixed arrival schedule (split between users), latency is measured from the intended send time. 0 (default) keeps the closed loop wait_time",
+    )
+    parser.add_argument(
+        "--arrival-process",
+        type=str,
+        choices=ARRIVAL_PROCESSES,
+        default=CONSTANT,
+        help="Open loop arrival schedule, constant intervals or poisson arrivals. Defaults to constant",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=10,
+        help="Open loop maximum number of requests in flight per user. Defaults to 10",
+    )
+    parser.add_argument(
+        "--max-lag",
+        type=float,
+        default=1.0,
+        help="Open loop seconds a request may wait for a free slot before it is dropped. Defaults to 1.0",
+    )
+    parser.add_argument(
+        "--capacity-search",
+        action="store_true",
+        default=False,
+        help="Capacity search: run steps of growing users, then a binary search, to find the highest load meeting the --slo-* limits. -u and -t are not used",
+    )
+    parser.add_argument(
+        "--slo-p95",
+        type=float,
+        default=None,
+        help="Capacity search maximum 95th percentile response time in ms",
+    )
+    parser.add_argument(
+        "--slo-p99",
+        type=float,
+        default=None,
+        help="Capacity search maximum 99th percentile response time in ms",
+    )
+    parser.add_argument(
+        "--slo-error-rate",
+        type=float,
+        default=0.01,
+        help="Capacity search maximum fraction of failed requests. Defaults to 0.01",
+    )
+    parser.add_argument(
+        "--capacity-start-users",
+        type=int,
+        default=10,
+        help="Capacity search users of the first step. Defaults to 10",
+    )
+    parser.add_argument(
+        "--capacity-growth",
+        type=float,
+        default=2.0,
+        help="Capacity search user count factor between steps until the SLOs break. Defaults to 2.0",
+    )
+    parser.add_argument(
+        "--capacity-max-users",
+        type=int,
+        default=10000,
+        help="Capacity search highest user count tried. Defaults to 10000",
+    )
+    parser.add_argument(
+        "--capacity-step-time",
+        type=float,
+        default=60.0,
+        help="Capacity search seconds of each step, warm up included. Defaults to 60",
+    )
+    parser.add_argument(
+        "--capacity-warmup",
+        type=float,
+        default=10.0,
+        help="Capacity search seconds at the beginning of each step that are not measured. Defaults to 10",
+    )
+    parser.add_argument(
+        "--capacity-resolution",
+        type=float,
+        default=0.05,
+        help="Capacity search stops when the breaking and sustainable user counts are closer than this fraction. Defaults to 0.05",
+    )
+    parser.add_argument(
+        "--capacity-output",
+        type=str,
+        default=None,
+        help="Capacity search JSON result file (max rps, percentiles, breaking step). The result is also logged",
+    )
+    parser.add_argument(
+        "--sweep-sizes",
+        type=str,
+        default=None,
+        help="Sweep: comma separated image sizes WIDTHxHEIGHT, e.g. '256x256,512x512,1024x1024'. Defaults to 512x512",
+    )
+    parser.add_argument(
+        "--sweep-formats",
+        type=str,
+        default=None,
+        help="Sweep: comma separated GetMap formats of the service, e.g. 'image/png,image/jpeg,image/webp'. Defaults to image/png",
+    )
+    parser.add_argument(
+        "--sweep-crs",
+        type=str,
+        default=None,
+        help="Sweep: comma separated CRS of the layer, e.g. 'EPSG:3763,EPSG:3857'. Defaults to the CRS of the layer bbox",
+    )
+    parser.add_argument(
+        "--sweep-bbox-areas",
+        type=str,
+        default=None,
+        help="Sweep: comma separated bbox areas, e.g. '1,10,100'. Defaults to --bbox-area",
+    )
+    parser.add_argument(
+        "--sweep-stage-time",
+        type=float,
+        default=0.0,
+        help="Sweep: seconds of each combination, run one after the other, the test stops after the last one. 0 (default) runs all combinations at the same time",
+    )
+    parser.add_argument(
+        "--sweep-output",
+        type=str,
+        default=None,
+        help="Sweep: CSV file of the comparison table. The table is also logged at the end of the test",
+    )
+    parser.add_argument(
+        "--bbox-grid",
+        type=str,
+        default=None,
+        help="Grid aligned bboxes of one tile, like tiled WMS clients, on a LEFT,TOP,RESOLUTION grid (top left corner and CRS units per pixel) of --bbox-grid-tile-size tiles. --bbox-area is not used",
+    )
+    parser.add_argument(
+        "--bbox-grid-tile-size",
+        type=str,
+        default="256x256",
+        help="Image size of a --bbox-grid tile, WIDTHxHEIGHT. Defaults to 256x256",
+    )
+    parser.add_argument(
+        "--bbox-grid-wmts",
+        type=str,
+        default=None,
+        help="Grid aligned bboxes on a WMTS TileMatrix instead of --bbox-grid: WMTS url or GetCapabilities XML file of the grid (e.g. of the MapProxy/GeoWebCache cache)",
+    )
+    parser.add_argument(
+        "--bbox-grid-tile-matrix-set",
+        type=str,
+        default=None,
+        help="TileMatrixSet of --bbox-grid-wmts, must be in the layer CRS. Defaults to the first one",
+    )
+    parser.add_argument(
+        "--bbox-grid-tile-matrix",
+        type=str,
+        default=None,
+        help="TileMatrix of --bbox-grid-wmts. Defaults to the median level",
+    )
+    parser.add_argument(
+        "--bbox-repeat-probability",
+        type=float,
+        default=0.0,
+        help="Grid aligned bboxes: probability of requesting again one of the last cells of the user (expected cache hit rate). Defaults to 0",
+    )
+    parser.add_argument(
+        "--bbox-repeat-window",
+        type=int,
+        default=1000,
+        help="Grid aligned bboxes: number of recent cells of the user a repeat is drawn from. Defaults to 1000",
+    )
+    parser.add_argument(
+        "--cache-status",
+        action="store_true",
+        default=False,
+        help="Tag responses as HIT, MISS or UNKNOWN from their cache headers, each with its own statistics, and report the cache hit ratio over time",
+    )
+    parser.add_argument(
+        "--cache-headers",
+        type=str,
+        default=None,
+        help="Comma separated response headers giving the cache status, the first one found decides. Defaults to X-Cache,geowebcache-cache-result,X-Cache-Status,CF-Cache-Status,Age",
+    )
+    parser.add_argument(
+        "--cache-hit-values",
+        type=str,
+        default=None,
+        help="Comma separated header value words meaning a cache hit. Defaults to HIT,STALE,UPDATING,REVALIDATED",
+    )
+    parser.add_argument(
+        "--cache-miss-values",
+        type=str,
+        default=None,
+        help="Comma separated header value words meaning a cache miss. Defaults to MISS,EXPIRED,BYPASS,DYNAMIC,WMS",
+    )
+    parser.add_argument(
+        "--cache-report-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between two cache hit ratio reports. Defaults to 10",
+    )
+    parser.add_argument(
+        "--cache-report-output",
+        type=str,
+        default=None,
+        help="CSV file of the cache hit ratio reports (hits, misses, unknown and hit ratio per interval)",
+    )
+    validation.add_arguments(parser)
+    parser.add_argument(
+        "--timing-breakdown",
+        action="store_true",
+        default=False,
+        help="Report the DNS, connect, TLS, time to first byte and download time of each request as DNS/CONNECT/TLS/TTFB/DOWNLOAD entries, and the MB/s per layer and format at the end",
+    )
+    parser.add_argument(
+        "--timing-output",
+        type=str,
+        default=None,
+        help="CSV file of the timing breakdown and MB/s per layer and format",
+    )
+    connections.add_arguments(parser)
+    parser.add_argument(
+        "--connection-report-interval",
+        type=float,
+        default=0.0,
+        help="Seconds between two reports of the new connections per second and the latency, enables --timing-breakdown. Defaults to 0, no report",
+    )
+    parser.add_argument(
+        "--connection-report-output",
+        type=str,
+        default=None,
+        help="CSV file of the connection churn reports (new connections per second, requests per connection, p50 and p95 per interval)",
+    )
+    distributed.add_arguments(parser)
+    saturation.add_arguments(parser)
+    parser.add_argument(
+        "--history-db",
+        type=str,
+        default=None,
+        help="SQLite database the summary of the run is appended to (configuration, RPS, percentiles, error rate, bytes), compared with python -m utils.history compare",
+    )
+    parser.add_argument(
+        "--history-compare",
+        type=int,
+        default=0,
+        help="Number of previous runs of the same configuration in --history-db the run is compared with at the end of the test, regressions are logged as warnings. Defaults to 0, no comparison",
+    )
+    parser.add_argument(
+        "--heatmap-output",
+        type=str,
+        default=None,
+        help="Comma separated .csv, .geojson and .png files of the response times per cell of the bbox center over the layer extent, e.g. heatmap.csv,heatmap.png",
+    )
+    parser.add_argument(
+        "--heatmap-cells",
+        type=int,
+        default=128,
+        help="Maximum number of heatmap cells along the longest side of the layer extent. Defaults to 128",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Port of a live Prometheus/OpenMetrics /metrics endpoint on the master (or local runner): requests, failures by error class, bytes and response time histogram per layer, merged from the workers. Defaults to 0, no endpoint",
+    )
+
+
+def sweeping(parsed_options) -> bool:
+    """True when a --sweep-* list of GetMap parameters is set"""
+    return any(
+        getattr(parsed_options, option, None)
+        for option in ("sweep_sizes", "sweep_formats", "sweep_crs", "sweep_bbox_areas")
+    )
+
+
+def get_sweep_cases(parsed_options, wms, layer):
+    """
+    Combinations of the --sweep-* GetMap parameters of `layer`, formats and CRS
+    are checked against the capabilities. Raises SweepArgError.
+    """
+    sizes = parse_image_sizes(parsed_options.sweep_sizes) or [(512, 512)]
+    formats = parse_list(parsed_options.sweep_formats) or ["image/png"]
+    crs_list = parse_list(parsed_options.sweep_crs) or [layer.boundingBox[-1]]
+    areas = parse_areas(parsed_options.sweep_bbox_areas) or [parsed_options.bbox_area]
+    check_available(formats, wms.getOperationByName("GetMap").formatOptions, "GetMap formats")
+    check_available(crs_list, layer.crsOptions, f"CRS of layer '{layer.name}'")
+    return sweep_cases(sizes, formats, crs_list, areas)
+
+
+@events.init.add_listener
+def on_init(environment, **kwargs):
+    """
+    Replace the fixed -u/-t run by the capacity search load shape, receive
+    the work partitioning of the master on workers and their heatmaps,
+    open loop late requests, timing phases and live metrics on the master, which
+    serves --metrics-port.
+    """
+    if environment.parsed_options and environment.parsed_options.capacity_search:
+        capacity.enable(environment)
+    distributed.register(environment)
+    heatmap.register(environment)
+    arrival.register(environment)
+    timing.register(environment)
+    metrics.register(environment)
+
+
+# time.time() of the test start, the stages of a staged sweep are timed from it
+sweep_start = None
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **kwargs):
+    """
+    Fetch and parse the GetCapabilities once per process, before users are spawned.
+    """
+    host = environment.host or WMSBenchmark.host
+    if host:
+        wms = load_layer_capabilities(
+            "WMS",
+            host,
+            layer=environment.parsed_options.layer_name or None,
+            capabilities_file=environment.parsed_options.capabilities_file,
+            cache_dir=environment.parsed_options.capabilities_cache_dir,
+        )
+        if sweeping(environment.parsed_options):
+            # the combinations are also needed by the master, for the comparison table
+            layer = wms.contents.get(environment.parsed_options.layer_name) or list(wms.contents.values())[0]
+            WMSBenchmark.sweep_cases = get_sweep_cases(environment.parsed_options, wms, layer)
+            global sweep_start
+            sweep_start = time.time()
+            logger.info(f"Sweep of {len(WMSBenchmark.sweep_cases)} GetMap parameter combinations")
+    cache_status.start_reporter(environment)
+    if environment.parsed_options.target_rps > 0:
+        # the connection pool of each user must allow the open loop concurrency
+        WMSBenchmark.concurrency = max(
+            FastHttpUser.concurrency, environment.parsed_options.max_concurrency
+        )
+    # timeouts and an explicit pool size (--connections-per-user) of the users
+    connections.apply_options(WMSBenchmark, environment.parsed_options)
+    connections.start_reporter(environment)
+    distributed.start_reporter(environment)
+    saturation.start_monitor(environment)
+    heatmap.start(environment)
+    # capabilities parsed above and slots of the workers, before the users are spawned
+    distributed.send_setup(environment)
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **kwargs):
+    """
+    Log (and write to --sweep-output) the comparison table of a sweep, the
+    last cache hit ratio, connection churn, client CPU and client saturation
+    reports and the timing breakdown, append the summary of the run to --history-db and
+    write the --heatmap-output files (workers send their heatmap to the master).
+    """
+    cache_status.stop_reporter()
+    connections.stop_reporter()
+    distributed.stop_reporter()
+    saturation.stop_monitor()
+    arrival.log_report(environment)
+    timing.log_report(environment)
+    history.record(environment, "WMS")
+    heatmap.finish(environment)
+    if not WMSBenchmark.sweep_cases or type(environment.runner).__name__ == "WorkerRunner":
+        return
+    rows = comparison_rows(environment.stats, WMSBenchmark.sweep_cases)
+    logger.info(f"Sweep comparison table:\n{format_table(rows)}")
+    if environment.parsed_options.sweep_output:
+        write_csv(environment.parsed_options.sweep_output, rows)
+        logger.info(f"Sweep comparison table written to {environment.parsed_options.sweep_output}")
+
 
 class WMSBenchmark(FastHttpUser):
     """
@@ -68,14 +489,27 @@ class WMSBenchmark(FastHttpUser):
     # Defines a wait time of 1 to 2 seconds between consecutive tasks executed by a simulated user
     wait_time = between(1, 2)
 
+    # Index of the users spawned in this process, used to give each user its own random stream
+    user_indexes = itertools.count()
+
+    # GetMap parameter combinations of a sweep (--sweep-*), set on test start
+    sweep_cases = []
+
     def on_start(self):
         """
         On start, fetch the WMS capabilities to determine layers and other parameters.
         """
-        # Timout extended for very slow servers
-        self.client.timeout = 120  # timeout is in seconds
-
-        self.wms = WebMapService(self.host)
+        # Timeouts (extended for very slow servers) and the connection pool size are set
+        # on test start, headers of the connection mode are sent with every request
+        self.request_headers = connections.request_headers(self.environment.parsed_options)
+
+        self.wms = load_layer_capabilities(
+            "WMS",
+            self.host,
+            layer=self.environment.parsed_options.layer_name or None,
+            capabilities_file=self.environment.parsed_options.capabilities_file,
+            cache_dir=self.environment.parsed_options.capabilities_cache_dir,
+        )
         self.layers = self.get_layers()
         self.layer_name = self.environment.parsed_options.layer_name
         logger.info(f"layer_name is {'empty' if self.layer_name == '' else self.layer_name}")
@@ -100,33 +534,205 @@ class WMSBenchmark(FastHttpUser):
         # get layej proj
         # self.srs = "EPSG:3763"  #'EPSG:3763' layer.boundingBox[-1] # Assuming EPSG:3763 for demonstration. Extract from GetCapabilities for dynamic approach.
         self.crs = self.get_crs()
+        # GetMap is version 1.3.0, geographic CRS like EPSG:4326 are latitude first
+        self.axis_swapped = axis_swapped(self.crs)
+        logger.info(f"Using CRS: {self.crs} ({'geographic' if crs_info(self.crs).geographic else 'projected'})")
         # self.layer_mimetype = urllib.parse.quote(
         # For now the first format available later to do also as argument
         self.layer_mimetype = self.wms.getOperationByName("GetMap").formatOptions[0]  # ['image/jpeg']
         self.layer_mimetype = "image/png"
+        self.image_size = (512, 512)
         self.bbox = (
             self.get_bbox()
         )  # A generic BBOX, ideally parse GetCapabilities for valid ranges.
 
-        self.bbox_generator = generate_random_bbox(
-            *self.get_bbox(),
-            area=self.environment.parsed_options.bbox_area,
-            ratio=self.environment.parsed_options.bbox_ratio,
-            seed=self.environment.parsed_options.random_seed,
-        )
+        # each user has its own random stream, derived from the seed, worker and user index
+        self.worker_index = worker_index(self.environment)
+        self.user_index = next(self.user_indexes)
+        self.bbox_generator = self.get_bbox_generator()
         logger.info(f"bbox area in km2:{self.environment.parsed_options.bbox_area}")
         logger.info(f"bbox aspect ration:{self.environment.parsed_options.bbox_ratio}")
-        logger.info(f"bbox random seed:{self.environment.parsed_options.random_seed}")
+        logger.info(
+            f"bbox random seed:{self.environment.parsed_options.random_seed} "
+            f"(worker {self.worker_index}, user {self.user_index})"
+        )
+        if self.environment.parsed_options.hotspot_file:
+            logger.info(f"Using hotspots: {self.environment.parsed_options.hotspot_file}")
+        if self.environment.parsed_options.workload_file:
+            logger.info(f"Using workload plan: {self.environment.parsed_options.workload_file}")
+
+        self.open_loop = None
+        if self.environment.parsed_options.target_rps > 0:
+            self.open_loop = OpenLoop(
+                self.environment,
+                user_rate(self.environment, self.environment.parsed_options.target_rps),
+                self.environment.parsed_options.arrival_process,
+                self.environment.parsed_options.max_concurrency,
+                self.environment.parsed_options.max_lag,
+                rng=user_random(
+                    self.environment.parsed_options.random_seed,
+                    self.worker_index,
+                    self.user_index,
+                    "arrival",
+                ),
+            )
+
+        # cache HIT/MISS tagging of the responses (--cache-status)
+        self.cache_classifier = cache_status.classifier_from_options(self.environment.parsed_options)
+        # ServiceException, image format and size checks of the responses (--validate-responses)
+        self.validator = validation.validator_from_options(
+            self.environment.parsed_options,
+            self.layer_mimetype,
+            rng=user_random(
+                self.environment.parsed_options.random_seed, self.worker_index, self.user_index, "validation"
+            ),
+        )
+
+        self.grid_bboxes = None
+        if self.environment.parsed_options.bbox_grid or self.environment.parsed_options.bbox_grid_wmts:
+            # one cache grid cell per request, with the image size of a tile
+            self.grid_bboxes = self.get_grid_bboxes()
+            self.bbox_generator = self.grid_bboxes
+            self.image_size = (self.grid_bboxes.grid.tile_width, self.grid_bboxes.grid.tile_height)
+            logger.info(
+                f"Using grid aligned bboxes of {self.image_size[0]}x{self.image_size[1]} pixels, "
+                f"cells {self.grid_bboxes.range}, repeat probability {self.grid_bboxes.repeat_probability}"
+            )
+
+        # DNS, connect, TLS, time to first byte and download times (--timing-breakdown)
+        self.timing_breakdown = self.environment.parsed_options.timing_breakdown or connections.churn_enabled(
+            self.environment.parsed_options
+        )
+        if self.timing_breakdown:
+            timing.install(self.client)
+
+        # response times per cell of the bbox centers over the layer extent (--heatmap-output)
+        self.heatmap = None
+        if heatmap.enabled(self.environment.parsed_options):
+            self.heatmap = heatmap.layer_grid(
+                self.layer_name, self.bbox, self.crs, self.environment.parsed_options.heatmap_cells
+            )
+        # live request, failure, bytes and latency series of the layer (--metrics-port)
+        self.metrics = metrics.series("WMS", self.layer_name) if metrics.enabled(self.environment.parsed_options) else None
+
+        # host and static query parameters are only parsed and encoded once
+        self.url_template = QueryTemplate(self.host, self.get_url_params(), ("bbox",))
+
+        if self.sweep_cases:
+            # one bbox generator per CRS and area, one url template per combination
+            self.bbox_generators = {}
+            self.url_templates = {}
+            for case in self.sweep_cases:
+                if (case.crs, case.area) not in self.bbox_generators:
+                    self.bbox_generators[(case.crs, case.area)] = self.get_bbox_generator(case.crs, case.area)
+                self.url_templates[case] = QueryTemplate(self.host, self.get_url_params(case), ("bbox",))
+            # users start at different combinations, so all of them are under load at the same time
+            offset = self.user_index % len(self.sweep_cases)
+            self.sweep_cycle = itertools.cycle(self.sweep_cases[offset:] + self.sweep_cases[:offset])
+
+    def get_bbox(self, crs=None):
+        """
+        Get the bbox from layer.boundinBox, or the layer bbox in `crs` (WMS 1.3.0
+        BoundingBox elements, or the WGS84 bbox, projected to web mercator if needed).
+        In geographic CRS x is the longitude, whatever the axis order of the capabilities.
+        """
+        bbox = layer_bbox(self.layer, crs or self.crs, self.wms.version)
+        if bbox is not None:
+            return bbox
+        raise SweepArgError(f"Layer '{self.layer_name}' has no BoundingBox in {crs} in the capabilities")
 
-    def get_bbox(self):
+    def get_bbox_generator(self, crs=None, area=None):
         """
-        Get the bbox from layer.boundinBox
+        Bboxes of the user: random, centered on hotspots (--hotspot-file) or
+        replayed from a workload plan (--workload-file). A sweep has one
+        generator per CRS and bbox area, all from the same random stream.
         """
-        return (
-            self.layer.boundingBox[0],
-            self.layer.boundingBox[1],
-            self.layer.boundingBox[2],
-            self.layer.boundingBox[3],
+        options = self.environment.parsed_options
+        area = area or options.bbox_area
+        other_crs = crs not in (None, self.crs)
+        crs = crs or self.crs
+        if options.workload_file:
+            if other_crs or area != options.bbox_area:
+                raise SweepArgError("A workload plan has its own bboxes, it can not be swept over CRS or bbox areas")
+            # precomputed bboxes, the plan is split between workers
+            return plan_cursor(
+                options.workload_file,
+                WMS,
+                self.worker_index,
+                worker_count(self.environment),
+            )
+        if options.hotspot_file:
+            if other_crs:
+                raise SweepArgError("Hotspots are in the layer CRS, they can not be swept over CRS")
+            # bbox centers drawn from the hotspot weights instead of uniformly
+            return generate_centered_bbox(
+                *self.get_bbox(),
+                centers=load_hotspots(options.hotspot_file, options.hotspot_zipf).points(
+                    user_random(options.random_seed, self.worker_index, self.user_index, "hotspot"),
+                    options.hotspot_radius,
+                ),
+                area=area,
+                ratio=options.bbox_ratio,
+                crs=crs,
+            )
+        # each user has its own random stream, derived from the seed, worker and user index
+        return generate_random_bbox(
+            *self.get_bbox(crs),
+            area=area,
+            ratio=options.bbox_ratio,
+            seed=options.random_seed,
+            rng=user_random(options.random_seed, self.worker_index, self.user_index, "bbox"),
+            crs=crs,
+        )
+
+    def get_grid_bboxes(self):
+        """
+        Grid aligned bboxes of the user, on the --bbox-grid or --bbox-grid-wmts
+        TileMatrix grid. Raises BBoxGridError.
+        """
+        options = self.environment.parsed_options
+        if self.sweep_cases or options.workload_file:
+            raise BBoxGridError("Grid aligned bboxes can not be combined with a sweep or a workload plan")
+        if options.bbox_grid:
+            tile_width, tile_height = parse_image_sizes(options.bbox_grid_tile_size)[0]
+            grid = parse_bbox_grid(options.bbox_grid, tile_width, tile_height)
+        else:
+            source = options.bbox_grid_wmts
+            wmts = load_capabilities(
+                "WMTS",
+                source,
+                capabilities_file=source if os.path.isfile(source) else None,
+                cache_dir=options.capabilities_cache_dir,
+            )
+            tile_matrix_set_name = options.bbox_grid_tile_matrix_set or list(wmts.tilematrixsets)[0]
+            tile_matrix_set = wmts.tilematrixsets.get(tile_matrix_set_name)
+            if tile_matrix_set is None:
+                raise BBoxGridError(
+                    f"TileMatrixSet {tile_matrix_set_name} not in {source}, available values are {list(wmts.tilematrixsets)}"
+                )
+            if crs_code(tile_matrix_set.crs) != crs_code(self.crs):
+                raise BBoxGridError(f"TileMatrixSet {tile_matrix_set_name} is in {tile_matrix_set.crs}, not in the layer CRS {self.crs}")
+            tile_matrices = list(tile_matrix_set.tilematrix)
+            tile_matrix = options.bbox_grid_tile_matrix or tile_matrices[len(tile_matrices) // 2]
+            if tile_matrix not in tile_matrix_set.tilematrix:
+                raise BBoxGridError(f"TileMatrix {tile_matrix} not in {tile_matrix_set_name}, available values are {tile_matrices}")
+            grid = tile_matrix_grid(tile_matrix_set.tilematrix[tile_matrix], tile_matrix_set.crs)
+            logger.info(f"Using bbox grid of TileMatrix {tile_matrix_set_name}/{tile_matrix}")
+
+        centers = None
+        if options.hotspot_file:
+            # new cells are the cells of the hotspot points
+            centers = load_hotspots(options.hotspot_file, options.hotspot_zipf).points(
+                user_random(options.random_seed, self.worker_index, self.user_index, "hotspot"),
+                options.hotspot_radius,
+            )
+        return GridBBoxes(
+            grid,
+            self.get_bbox(),
+            rng=user_random(options.random_seed, self.worker_index, self.user_index, "grid"),
+            repeat_probability=options.bbox_repeat_probability,
+            window=options.bbox_repeat_window,
+            centers=centers,
         )
 
     def get_crs(self):
@@ -151,28 +757,144 @@ class WMSBenchmark(FastHttpUser):
     def load_map(self):
         """
         A task that loads a map image from the WMS layer using a random BBOX.
+        In open loop mode (--target-rps) requests are sent on the arrival schedule until the user stops.
+        """
+        if self.open_loop:
+            self.open_loop.run(self.request_map)
+        else:
+            self.request_map()
+
+    def request_map(self, intended=None):
+        """
+        GetMap request of the next bbox.
+
+        Parameters:
+        intended (float): Open loop intended send time (time.perf_counter), the
+                          response time is measured from it instead of the actual send time.
         """
         # For simplicity, selecting the first layer. Adjust as needed.
         # layer = self.layers[0] if self.layers else "no-layer-available"
 
-        # Lets get a random bbx
-        bbox = next(self.bbox_generator)
-        # bbox = next(generate_random_bbox(*self.bbox))
-        bbox_str = ",".join(map(str, bbox))
+        name = None
+        case = None
+        # bbox center in the layer CRS, for the heatmap
+        center = None
+        if self.sweep_cases:
+            # sweep (--sweep-*), each combination is its own entry in locust statistics
+            case = self.next_sweep_case()
+            if case is None:
+                return
+            name = case.name
+            start = time.perf_counter()
+            bbox = next(self.bbox_generators[(case.crs, case.area)])
+            saturation.add(saturation.DRAW, start)
+            if case.crs == self.crs:
+                center = ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+            if axis_swapped(case.crs):
+                bbox = swap_axes(bbox)
+            start = time.perf_counter()
+            url_path = self.url_templates[case].render_encoded(bbox=encode_bbox(bbox))
+            saturation.add(saturation.URL, start)
+        else:
+            # Lets get a random bbx
+            start = time.perf_counter()
+            bbox = next(self.bbox_generator)
+            saturation.add(saturation.DRAW, start)
+            # bbox = next(generate_random_bbox(*self.bbox))
+            center = ((bbox[0] + bbox[2]) / 2, (bbox[1] + bbox[3]) / 2)
+            if self.grid_bboxes:
+                # cells requested before by the user are expected cache hits
+                name = "grid repeat" if self.grid_bboxes.repeated else "grid new"
+            if self.axis_swapped:
+                # WMS 1.3.0 latitude first bbox, e.g. EPSG:4326
+                bbox = swap_axes(bbox)
+
+            start = time.perf_counter()
+            url_path = self.url_template.render_encoded(bbox=encode_bbox(bbox))
+            saturation.add(saturation.URL, start)
 
-        url_path = self.get_url(bbox_str)
-        
         # Making the GET request to load the map
-        logger.debug(f"URL for request: {url_path}")
-        response = self.client.get(url_path)
-    
+        logger.debug("URL for request: %s", url_path)
+        if self.timing_breakdown:
+            timing.start()
+        with self.client.get(url_path, name=name, headers=self.request_headers, catch_response=True) as response:
+            if self.timing_breakdown:
+                timing.report(
+                    self.environment,
+                    f"{self.layer_name} {case.format if case else self.layer_mimetype}",
+                    response.request_meta["response_length"],
+                )
+            if self.cache_classifier:
+                cache_status.tag_response(response, self.cache_classifier, name or "GetMap")
+            if self.validator:
+                if case:
+                    validation.check_response(response, self.validator, case.width, case.height, case.format)
+                else:
+                    validation.check_response(response, self.validator, *self.image_size)
+            if intended is not None:
+                response.request_meta["response_time"] = (time.perf_counter() - intended) * 1000
+        if self.heatmap and center:
+            self.heatmap.add_point(
+                *center, response.request_meta["response_time"], response.request_meta["exception"] is not None
+            )
+        if self.metrics:
+            self.metrics.add(
+                response.request_meta["response_time"], response.request_meta["response_length"], metrics.error_class(response)
+            )
+
+    def next_sweep_case(self):
+        """
+        Combination of the next request: the next one of the user cycle, or the
+        one of the current stage with --sweep-stage-time. After the last stage
+        the test is stopped and None is returned.
+        """
+        stage_time = self.environment.parsed_options.sweep_stage_time
+        if not stage_time:
+            return next(self.sweep_cycle)
+        index = stage_index(time.time() - sweep_start, stage_time)
+        if index < len(self.sweep_cases):
+            return self.sweep_cases[index]
+        if self.environment.runner.state not in ("stopping", "stopped", "quitting"):
+            logger.info("Sweep stages completed, stopping the test")
+            # not from this greenlet, stopping the runner kills the users
+            gevent.spawn(self.environment.runner.quit)
+        return None
+
+    def on_stop(self):
+        """
+        On stop, kill the open loop requests still in flight.
+        """
+        if self.open_loop:
+            self.open_loop.stop()
+
+    def get_url_params(self, case=None):
+        """
+        Query parameters of the WMS GetMap request, the bbox is set per request.
+        A sweep combination (utils.sweep.SweepCase) sets the size, format and CRS.
+        """
+        # TODO: obtain WMS and version from generic class arguments
+        return {
+            "service": "WMS",
+            "version": "1.3.0",
+            "request": "GetMap",
+            "layers": self.layer_name,
+            "styles": "",
+            "bbox": None,
+            "width": str(case.width if case else self.image_size[0]),
+            "height": str(case.height if case else self.image_size[1]),
+            "crs": case.crs if case else self.crs,
+            "format": case.format if case else self.layer_mimetype
+            }
+
     def get_url(self,bbox_str):
         """
         Construct a URL for a GetMap request to the WMS service.
 
-        This method constructs a URL using the base host URL and additional query parameters 
-        required for the WMS GetMap request. The `urllib.parse` module is used to handle cases 
-        where the base host URL already contains query parameters.
+        The host url (that may contain query parameters, e.g.
+        https://host/cgi-bin/mapserv.exe?map=/mapfiles/my.map) and the static
+        query parameters are parsed and encoded once in `on_start` into
+        `self.url_template`, only the bbox is encoded on each request.
+        The url is the same as the one built by `utils.url_template.build_url`.
 
         Parameters:
         bbox_str (str): A string representing the bounding box coordinates in the format 
@@ -187,46 +909,7 @@ class WMSBenchmark(FastHttpUser):
         # Example return URL:
         # "https://ortos.dgterritorio.gov.pt/cgi-bin/mapserv.exe?map=%2Fms4w%2Fapps%2Fmapfile%2Fmosaico2023.map&service=WMS&version=1.3.0&request=GetMap&layers=ortoSat2023-CorVerdadeira&styles=&bbox=-143566.40427116063%2C36617.15748174256%2C-133566.40427116063%2C46617.15748174256&width=512&height=512&crs=EPSG%3A3763&format=image%2Fpng"
         """
-        
-        """
-        From the bbox string numbers it creates a url based on class (self) information, 
-        implements urllib.parse due to https://host/cgi-bin/mapserv.exe?map=/mapfiles/my.map
-        url structure that implements ? on its url causing conflicts with url queries 
-        
-        bbox_str example -143566.40427116063,36617.15748174256,-133566.40427116063,46617.15748174256
-        """
-        # TODO: obtain WMS and version from generic class arguments
-        # TODO: Width/Height is not implementend
-        
-        params = {
-            "service": "WMS",
-            "version": "1.3.0",
-            "request": "GetMap",
-            "layers": self.layer_name,
-            "styles": "",
-            "bbox": bbox_str,
-            "width": "512",
-            "height": "512",
-            "crs": self.crs,
-            "format": self.layer_mimetype
-            }
-        # Parse the base URL
-        url_parts = urlparse(self.host)
-
-        # Extract existing query parameters
-        query_params = parse_qs(url_parts.query)
-
-        # Update the query parameters with the new ones
-        query_params.update(params)
-
-        # Rebuild the query string
-        new_query = urlencode(query_params, doseq=True)
-
-        # Construct the new URL
-        new_url_parts = url_parts._replace(query=new_query)
-        full_url = urlunparse(new_url_parts)
-
-        return full_url
+        return self.url_template.render(bbox=bbox_str)
 
 
 # Example running code snippet would be similar to your WMTS benchmark
@@ -252,6 +935,19 @@ if __name__ == "__main__":
     env.parsed_options.bbox_area = 100  # square km (10km x 10km)
     env.parsed_options.bbox_ratio = 1.0
     env.parsed_options.layer_name = "" # None default to pick up first layer
+    env.parsed_options.capabilities_file = None
+    env.parsed_options.capabilities_cache_dir = None
+    env.parsed_options.workload_file = None
+    env.parsed_options.hotspot_file = None
+    env.parsed_options.target_rps = 0.0
+    env.parsed_options.capacity_search = False
+    env.parsed_options.bbox_grid = None
+    env.parsed_options.bbox_grid_wmts = None
+    env.parsed_options.cache_status = False
+    env.parsed_options.validate_responses = False
+    env.parsed_options.timing_breakdown = False
+    env.parsed_options.accept_encoding = None
+    env.parsed_options.connection_close = False
     wms_benchmark.environment = env
     # Directly call the on_start to use the setup (if any exception handling, do here)
     try:
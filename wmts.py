@@ -1,10 +1,20 @@
 import sys, random
+import itertools
+import time
 import urllib.parse
 
-from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
-
 from locust import FastHttpUser, events, task, between
-from owslib.wmts import WebMapTileService
+
+from utils.capabilities import load_layer_capabilities
+from utils.url_template import QueryTemplate, encode_value
+from utils.seeding import user_random, worker_count, worker_index
+from utils.workload import WMTS, plan_cursor
+from utils.arrival import ARRIVAL_PROCESSES, CONSTANT, OpenLoop, user_rate
+from utils.hotspots import load_hotspots, point_tiles
+from utils.tile_matrix_mix import TileMatrixMix, parse_tile_matrix
+from utils import arrival, cache_status, capabilities, capacity, connections, coverage, distributed, heatmap, history, metrics, saturation, timing, validation, viewport
+
+from gevent.pool import Pool
 
 import logging
 
@@ -71,10 +81,335 @@ def init_parser(parser):
         "--tile-matrix",
         type=str,
         default=None,
-        help="Tilematrix of Tilematrixset to be used. In not set, if not set, will determine the median level of pyramid (Tilematrixset) and use it",
+        help="Tilematrix of Tilematrixset to be used, or a weighted mix drawn per request: list '05,06', range '05:10', weights '05:08=1,09=2'. In not set, if not set, will determine the median level of pyramid (Tilematrixset) and use it",
+    )
+    parser.add_argument(
+        "--capabilities-file",
+        type=str,
+        default=None,
+        help="Local GetCapabilities XML file to use instead of requesting it from the host",
+    )
+    capabilities.add_arguments(parser)
+    parser.add_argument(
+        "--workload-file",
+        type=str,
+        default=None,
+        help="Workload plan (.npy) of (matrix, col, row) tiles made with 'python -m utils.workload wmts', replayed instead of random tiles",
+    )
+    parser.add_argument(
+        "--hotspot-file",
+        type=str,
+        default=None,
+        help="Hotspot weights: .asc weight grid, .csv of x,y,weight points or tilematrix,tilecol,tilerow ranked tiles, in the TileMatrixSet CRS. Tiles are drawn from it instead of uniformly",
+    )
+    parser.add_argument(
+        "--hotspot-zipf",
+        type=float,
+        default=None,
+        help="Zipf exponent, the hotspot weights are replaced by 1/rank^exponent (csv file order or decreasing grid weight)",
+    )
+    parser.add_argument(
+        "--hotspot-radius",
+        type=float,
+        default=0.0,
+        help="Hotspot points are moved randomly by up to this distance (CRS units) in x and y. Defaults to 0",
+    )
+    parser.add_argument(
+        "--coverage-file",
+        type=str,
+        default=None,
+        help="Coverage mask (.npz) made with 'python -m utils.coverage' from a footprint, random tiles are only drawn where the layer has data",
+    )
+    parser.add_argument(
+        "--target-rps",
+        type=float,
+        default=0.0,
+        help="Open loop mode: total requests per second sent on a fixed arrival schedule (split between users), latency is measured from the intended send time. 0 (default) keeps the closed loop wait_time",
+    )
+    parser.add_argument(
+        "--arrival-process",
+        type=str,
+        choices=ARRIVAL_PROCESSES,
+        default=CONSTANT,
+        help="Open loop arrival schedule, constant intervals or poisson arrivals. Defaults to constant",
+    )
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=10,
+        help="Open loop maximum number of requests in flight per user. Defaults to 10",
+    )
+    parser.add_argument(
+        "--max-lag",
+        type=float,
+        default=1.0,
+        help="Open loop seconds a request may wait for a free slot before it is dropped. Defaults to 1.0",
+    )
+    parser.add_argument(
+        "--capacity-search",
+        action="store_true",
+        default=False,
+        help="Capacity search: run steps of growing users, then a binary search, to find the highest load meeting the --slo-* limits. -u and -t are not used",
+    )
+    parser.add_argument(
+        "--slo-p95",
+        type=float,
+        default=None,
+        help="Capacity search maximum 95th percentile response time in ms",
+    )
+    parser.add_argument(
+        "--slo-p99",
+        type=float,
+        default=None,
+        help="Capacity search maximum 99th percentile response time in ms",
+    )
+    parser.add_argument(
+        "--slo-error-rate",
+        type=float,
+        default=0.01,
+        help="Capacity search maximum fraction of failed requests. Defaults to 0.01",
+    )
+    parser.add_argument(
+        "--capacity-start-users",
+        type=int,
+        default=10,
+        help="Capacity search users of the first step. Defaults to 10",
+    )
+    parser.add_argument(
+        "--capacity-growth",
+        type=float,
+        default=2.0,
+        help="Capacity search user count factor between steps until the SLOs break. Defaults to 2.0",
+    )
+    parser.add_argument(
+        "--capacity-max-users",
+        type=int,
+        default=10000,
+        help="Capacity search highest user count tried. Defaults to 10000",
+    )
+    parser.add_argument(
+        "--capacity-step-time",
+        type=float,
+        default=60.0,
+        help="Capacity search seconds of each step, warm up included. Defaults to 60",
+    )
+    parser.add_argument(
+        "--capacity-warmup",
+        type=float,
+        default=10.0,
+        help="Capacity search seconds at the beginning of each step that are not measured. Defaults to 10",
+    )
+    parser.add_argument(
+        "--capacity-resolution",
+        type=float,
+        default=0.05,
+        help="Capacity search stops when the breaking and sustainable user counts are closer than this fraction. Defaults to 0.05",
+    )
+    parser.add_argument(
+        "--capacity-output",
+        type=str,
+        default=None,
+        help="Capacity search JSON result file (max rps, percentiles, breaking step). The result is also logged",
+    )
+    parser.add_argument(
+        "--session-mode",
+        action="store_true",
+        default=False,
+        help="Browser-like map viewer sessions: each task fetches a whole viewport of tiles in parallel, then pans or zooms to an adjacent TileMatrix",
+    )
+    parser.add_argument(
+        "--viewport-size",
+        type=str,
+        default="4x3",
+        help="Session mode viewport size in tiles, COLSxROWS. Defaults to 4x3",
+    )
+    parser.add_argument(
+        "--viewport-connections",
+        type=int,
+        default=6,
+        help="Session mode parallel connections per user, as a browser per host. Defaults to 6",
+    )
+    parser.add_argument(
+        "--session-length",
+        type=int,
+        default=10,
+        help="Session mode viewports of a session before jumping to a new random position of --tile-matrix. Defaults to 10",
+    )
+    parser.add_argument(
+        "--zoom-probability",
+        type=float,
+        default=0.3,
+        help="Session mode probability that the next viewport is a zoom instead of a pan. Defaults to 0.3",
+    )
+    parser.add_argument(
+        "--cache-status",
+        action="store_true",
+        default=False,
+        help="Tag responses as HIT, MISS or UNKNOWN from their cache headers, each with its own statistics, and report the cache hit ratio over time",
+    )
+    parser.add_argument(
+        "--cache-headers",
+        type=str,
+        default=None,
+        help="Comma separated response headers giving the cache status, the first one found decides. Defaults to X-Cache,geowebcache-cache-result,X-Cache-Status,CF-Cache-Status,Age",
+    )
+    parser.add_argument(
+        "--cache-hit-values",
+        type=str,
+        default=None,
+        help="Comma separated header value words meaning a cache hit. Defaults to HIT,STALE,UPDATING,REVALIDATED",
+    )
+    parser.add_argument(
+        "--cache-miss-values",
+        type=str,
+        default=None,
+        help="Comma separated header value words meaning a cache miss. Defaults to MISS,EXPIRED,BYPASS,DYNAMIC,WMS",
+    )
+    parser.add_argument(
+        "--cache-report-interval",
+        type=float,
+        default=10.0,
+        help="Seconds between two cache hit ratio reports. Defaults to 10",
+    )
+    parser.add_argument(
+        "--cache-report-output",
+        type=str,
+        default=None,
+        help="CSV file of the cache hit ratio reports (hits, misses, unknown and hit ratio per interval)",
+    )
+    validation.add_arguments(parser)
+    parser.add_argument(
+        "--timing-breakdown",
+        action="store_true",
+        default=False,
+        help="Report the DNS, connect, TLS, time to first byte and download time of each request as DNS/CONNECT/TLS/TTFB/DOWNLOAD entries, and the MB/s per layer and format at the end",
+    )
+    parser.add_argument(
+        "--timing-output",
+        type=str,
+        default=None,
+        help="CSV file of the timing breakdown and MB/s per layer and format",
+    )
+    connections.add_arguments(parser)
+    parser.add_argument(
+        "--connection-report-interval",
+        type=float,
+        default=0.0,
+        help="Seconds between two reports of the new connections per second and the latency, enables --timing-breakdown. Defaults to 0, no report",
+    )
+    parser.add_argument(
+        "--connection-report-output",
+        type=str,
+        default=None,
+        help="CSV file of the connection churn reports (new connections per second, requests per connection, p50 and p95 per interval)",
+    )
+    distributed.add_arguments(parser)
+    saturation.add_arguments(parser)
+    parser.add_argument(
+        "--history-db",
+        type=str,
+        default=None,
+        help="SQLite database the summary of the run is appended to (configuration, RPS, percentiles, error rate, bytes), compared with python -m utils.history compare",
+    )
+    parser.add_argument(
+        "--history-compare",
+        type=int,
+        default=0,
+        help="Number of previous runs of the same configuration in --history-db the run is compared with at the end of the test, regressions are logged as warnings. Defaults to 0, no comparison",
+    )
+    parser.add_argument(
+        "--heatmap-output",
+        type=str,
+        default=None,
+        help="Comma separated .csv, .geojson and .png files of the response times per tile (or block of tiles) of each TileMatrix, e.g. heatmap.csv,heatmap.png",
+    )
+    parser.add_argument(
+        "--heatmap-cells",
+        type=int,
+        default=128,
+        help="Maximum number of heatmap cells along the longest side of the tile range of a TileMatrix, larger ranges have blocks of tiles per cell. Defaults to 128",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="Port of a live Prometheus/OpenMetrics /metrics endpoint on the master (or local runner): requests, failures by error class, bytes and response time histogram per layer and TileMatrix, merged from the workers. Defaults to 0, no endpoint",
     )
 
 
+@events.init.add_listener
+def on_init(environment, **kwargs):
+    """
+    Replace the fixed -u/-t run by the capacity search load shape, receive
+    the work partitioning of the master on workers and their heatmaps,
+    open loop late requests, timing phases and live metrics on the master, which
+    serves --metrics-port.
+    """
+    if environment.parsed_options and environment.parsed_options.capacity_search:
+        capacity.enable(environment)
+    distributed.register(environment)
+    heatmap.register(environment)
+    arrival.register(environment)
+    timing.register(environment)
+    metrics.register(environment)
+
+
+@events.test_start.add_listener
+def on_test_start(environment, **kwargs):
+    """
+    Fetch and parse the GetCapabilities once per process, before users are spawned.
+    """
+    host = environment.host or WMTSBenchmark.host
+    if host:
+        load_layer_capabilities(
+            "WMTS",
+            host,
+            layer=environment.parsed_options.layer_name or None,
+            tile_matrix_set=environment.parsed_options.tile_matrix_set or None,
+            capabilities_file=environment.parsed_options.capabilities_file,
+            cache_dir=environment.parsed_options.capabilities_cache_dir,
+        )
+    if environment.parsed_options.target_rps > 0:
+        # the connection pool of each user must allow the open loop concurrency
+        WMTSBenchmark.concurrency = max(
+            FastHttpUser.concurrency, environment.parsed_options.max_concurrency
+        )
+    if environment.parsed_options.session_mode:
+        # and the parallel connections of the viewports
+        WMTSBenchmark.concurrency = max(
+            WMTSBenchmark.concurrency, environment.parsed_options.viewport_connections
+        )
+    # timeouts and an explicit pool size (--connections-per-user) of the users
+    connections.apply_options(WMTSBenchmark, environment.parsed_options)
+    connections.start_reporter(environment)
+    cache_status.start_reporter(environment)
+    distributed.start_reporter(environment)
+    saturation.start_monitor(environment)
+    heatmap.start(environment)
+    # capabilities parsed above and slots of the workers, before the users are spawned
+    distributed.send_setup(environment)
+
+
+@events.test_stop.add_listener
+def on_test_stop(environment, **kwargs):
+    """
+    Log (and write to --cache-report-output, --connection-report-output,
+    --worker-report-output, --client-report-output and --timing-output) the
+    last cache hit ratio, connection churn, client CPU and client saturation
+    reports and the timing breakdown, append
+    the summary of the run to --history-db and write the --heatmap-output
+    files (workers send their heatmap to the master).
+    """
+    cache_status.stop_reporter()
+    connections.stop_reporter()
+    distributed.stop_reporter()
+    saturation.stop_monitor()
+    arrival.log_report(environment)
+    timing.log_report(environment)
+    history.record(environment, "WMTS")
+    heatmap.finish(environment)
+
+
 class WMTSBenchmark(FastHttpUser):
     """
     A class to model the benchmarking of a WMS layer using Locust.
@@ -84,6 +419,9 @@ class WMTSBenchmark(FastHttpUser):
 
     # Defines a wait time of 1 to 2 seconds between consecutive tasks executed by a simulated user
     wait_time = between(1, 2)
+
+    # Index of the users spawned in this process, used to give each user its own random stream
+    user_indexes = itertools.count()
     # host = "https://service.pdok.nl/hwh/luchtfotorgb/wmts/v1_0"  # Uncomment and set this as the default
     host = ""
 
@@ -92,10 +430,18 @@ class WMTSBenchmark(FastHttpUser):
         On start, fetch the WMtS capabilities to determine layers and tilematrixsets.
         /hwh/luchtfotorgb/wmts/v1_0/{layer_identifier}/{tile_matrix_set}/{tile_matrix}/{tile_col}/{tile_row}.jpeg"
         """
-        # Timout extended for very slow servers
-        self.client.timeout = 120  # timeout is in seconds
-
-        self.wmts = WebMapTileService(self.host)
+        # Timeouts (extended for very slow servers) and the connection pool size are set
+        # on test start, headers of the connection mode are sent with every request
+        self.request_headers = connections.request_headers(self.environment.parsed_options)
+
+        self.wmts = load_layer_capabilities(
+            "WMTS",
+            self.host,
+            layer=self.environment.parsed_options.layer_name or None,
+            tile_matrix_set=self.environment.parsed_options.tile_matrix_set or None,
+            capabilities_file=self.environment.parsed_options.capabilities_file,
+            cache_dir=self.environment.parsed_options.capabilities_cache_dir,
+        )
 
         self.layers = list(self.wmts.contents.keys())
         ##### TO BE REFACTORED ####
@@ -139,57 +485,209 @@ class WMTSBenchmark(FastHttpUser):
             logger.info(
                 f"No --tile-matrix-set argument, using tilematrixset {self.tile_matrix_set}, first available in layer"
             )
-        self.tile_matrix_value = self.environment.parsed_options.tile_matrix
-
-        if self.tile_matrix_value:
-            # Let op!  self.tile_matrix_set --> name of tilematrixset
-            tile_matrix_set_obj = self.wmts.tilematrixsets.get(self.tile_matrix_set)
-
-            if (
-                self.tile_matrix_value not in tile_matrix_set_obj.tilematrix.keys()
-            ):  # tile_matrix_obj=self.layer.tilematrixsets[self.tile_matrix_set]
+        tile_matrix_set_obj = self.wmts.tilematrixsets.get(self.tile_matrix_set)
+        tile_matrix_list = list(tile_matrix_set_obj.tilematrix.keys())
+
+        if self.environment.parsed_options.tile_matrix:
+            # a single tilematrix, or a weighted mix of tilematrix drawn per request
+            try:
+                self.tile_matrix_weights = parse_tile_matrix(
+                    self.environment.parsed_options.tile_matrix, tile_matrix_list
+                )
+            except ValueError as e:
                 error_message = (
-                    f"The specificed tilematrix argument value is not on tilematrixset {self.tile_matrix_set}   "
-                    f"Available values are {tile_matrix_set_obj.tilematrix.keys()}"
+                    f"{e} {self.tile_matrix_set}. "
+                    f"Available values are {tile_matrix_list}"
                 )
                 raise TileMatrixArgError(error_message)
         else:
-
-            tile_matrix_set_obj = self.wmts.tilematrixsets.get(self.tile_matrix_set)
-            tile_matrix_list = list(tile_matrix_set_obj.tilematrix.keys())
             middle_index = len(tile_matrix_list) // 2
-            self.tile_matrix_value = tile_matrix_list[middle_index]
+            self.tile_matrix_weights = [(tile_matrix_list[middle_index], 1.0)]
 
             logger.info(
-                f"No --tile-matrix argument, using mid tilematrix value of {self.tile_matrix_value}"
+                f"No --tile-matrix argument, using mid tilematrix value of {tile_matrix_list[middle_index]}"
             )
+        self.tile_matrices = [tile_matrix for tile_matrix, _ in self.tile_matrix_weights]
+        self.tile_matrix_value = self.tile_matrices[0]
 
-        self.layer_tiles = self.wmts.tilematrixsets.get(
-            self.tile_matrix_set
-        ).tilematrix[self.tile_matrix_value]
+        self.layer_tiles = tile_matrix_set_obj.tilematrix[self.tile_matrix_value]
 
         self.layer_width = self.layer_tiles.matrixwidth  # max number cols
         self.layer_height = self.layer_tiles.matrixheight  # max number rows
-        # wmts has row-1 and col-1 as standard #
-        self.gen_col = random_number_generator(
-            0, self.layer_width - 1, seed=self.environment.parsed_options.random_seed
-        )
-        # self.gen_col=random_number_generator(14, 490-1, seed=self.environment.parsed_options.random_seed)
-        # seed for row is seed+1 otherwise cols and row sequence would be identical, one init seed value used for 2 purposes
-        self.gen_row = random_number_generator(
-            0,
-            self.layer_height - 1,
-            seed=self.environment.parsed_options.random_seed + 1,
-        )
-        # self.gen_row=random_number_generator(4, 985-1, seed=self.environment.parsed_options.random_seed+1)
+
+        # tiles within the layer's TileMatrixSetLimits and extent, outside of them
+        # tiles are empty and answered much faster than real ones
+        self.tile_ranges = coverage.layer_tile_ranges(self.layer, tile_matrix_set_obj)
+        for tile_matrix in self.tile_matrices:
+            if tile_matrix not in self.tile_ranges:
+                error_message = (
+                    f"The tilematrix {tile_matrix} has no tiles in layer '{self.layer_name}'. "
+                    f"TileMatrix with tiles are {list(self.tile_ranges)}"
+                )
+                raise TileMatrixArgError(error_message)
+
+        # with several tilematrix, requests are reported per tilematrix instead of per url
+        self.stat_names = {}
+        if len(self.tile_matrices) > 1:
+            self.stat_names = {
+                tile_matrix: f"{self.tile_matrix_set}/{tile_matrix}"
+                for tile_matrix in self.tile_ranges
+            }
+
+        # each user has its own col and row random streams, derived from the seed,
+        # worker and user index, so the col and row sequences are independent
+        self.worker_index = worker_index(self.environment)
+        self.user_index = next(self.user_indexes)
+        seed = self.environment.parsed_options.random_seed
         logger.info(
-            f"Using tile random seed:{self.environment.parsed_options.random_seed}"
+            f"Using tile random seed:{seed} (worker {self.worker_index}, user {self.user_index})"
         )
         logger.info(f"Using layer named: {self.layer_name}")
         logger.info(f"Using TileMatrixSet: {self.tile_matrix_set}")
-        logger.info(f"Using TileMatrix: {self.tile_matrix_value}")
+        logger.info(
+            f"Using TileMatrix: {', '.join(f'{tile_matrix} (weight {weight:g})' for tile_matrix, weight in self.tile_matrix_weights)}"
+            if len(self.tile_matrices) > 1
+            else f"Using TileMatrix: {self.tile_matrix_value}"
+        )
         logger.info(f"Using TileMatrixWidth:{self.layer_width}")
         logger.info(f"Using TileMatrixHeight:{self.layer_height}")
+        for tile_matrix in self.tile_matrices:
+            min_col, max_col, min_row, max_row = self.tile_ranges[tile_matrix]
+            logger.info(
+                f"Using TileMatrix {tile_matrix} TileCol range:{min_col}-{max_col}, TileRow range:{min_row}-{max_row}"
+            )
+
+        # DNS, connect, TLS, time to first byte and download times (--timing-breakdown)
+        self.timing_breakdown = self.environment.parsed_options.timing_breakdown or connections.churn_enabled(
+            self.environment.parsed_options
+        )
+        if self.timing_breakdown:
+            timing.install(self.client)
+            self.timing_name = f"{self.layer_name} {self.layer.formats[0]}"
+
+        # host and static query parameters are only parsed and encoded once
+        self.url_template = QueryTemplate(
+            self.host, self.get_url_params(), ("tilematrix", "tilerow", "tilecol")
+        )
+
+        # response times per tile, or block of tiles, of each TileMatrix (--heatmap-output)
+        self.heatmaps = {} if heatmap.enabled(self.environment.parsed_options) else None
+        # live request, failure, bytes and latency series of each TileMatrix (--metrics-port)
+        self.live_metrics = metrics.enabled(self.environment.parsed_options)
+
+        # cache HIT/MISS tagging of the responses (--cache-status)
+        self.cache_classifier = cache_status.classifier_from_options(self.environment.parsed_options)
+        # ServiceException, image format and tile size checks of the responses (--validate-responses)
+        self.validator = validation.validator_from_options(
+            self.environment.parsed_options,
+            self.layer.formats[0],
+            rng=user_random(seed, self.worker_index, self.user_index, "validation"),
+        )
+        self.tile_sizes = {
+            identifier: (tile_matrix.tilewidth, tile_matrix.tileheight)
+            for identifier, tile_matrix in self.wmts.tilematrixsets[self.tile_matrix_set].tilematrix.items()
+        }
+
+        self.open_loop = None
+        if self.environment.parsed_options.target_rps > 0:
+            self.open_loop = OpenLoop(
+                self.environment,
+                user_rate(self.environment, self.environment.parsed_options.target_rps),
+                self.environment.parsed_options.arrival_process,
+                self.environment.parsed_options.max_concurrency,
+                self.environment.parsed_options.max_lag,
+                rng=user_random(seed, self.worker_index, self.user_index, "arrival"),
+            )
+
+        # (col, row) tiles of each tilematrix
+        col_rng = user_random(seed, self.worker_index, self.user_index, "col")
+        row_rng = user_random(seed, self.worker_index, self.user_index, "row")
+        coverage_mask = None
+        hotspots = None
+        hotspot_rng = user_random(seed, self.worker_index, self.user_index, "hotspot")
+        if self.environment.parsed_options.coverage_file:
+            # only tiles with data, drawn from the coverage mask of the layer footprint
+            coverage_mask = coverage.load_mask(self.environment.parsed_options.coverage_file)
+            coverage_rng = user_random(seed, self.worker_index, self.user_index, "coverage")
+            logger.info(f"Using coverage mask: {self.environment.parsed_options.coverage_file}")
+        if self.environment.parsed_options.hotspot_file:
+            # tiles drawn from the hotspot weights instead of uniformly
+            hotspots = load_hotspots(
+                self.environment.parsed_options.hotspot_file,
+                self.environment.parsed_options.hotspot_zipf,
+            )
+            logger.info(f"Using hotspots: {self.environment.parsed_options.hotspot_file}")
+            if not hotspots.has_tiles:
+                hotspot_points = hotspots.points(
+                    hotspot_rng, self.environment.parsed_options.hotspot_radius
+                )
+
+        self.coverage_samplers = {}
+        level_tiles = {}
+        for tile_matrix in self.tile_matrices:
+            min_col, max_col, min_row, max_row = self.tile_ranges[tile_matrix]
+            if coverage_mask is not None:
+                self.coverage_samplers[tile_matrix] = coverage_mask.sampler(tile_matrix, rng=coverage_rng)
+            if hotspots is not None and not hotspots.has_tiles:
+                level_tiles[tile_matrix] = point_tiles(
+                    hotspot_points,
+                    tile_matrix_set_obj.tilematrix[tile_matrix],
+                    self.tile_ranges[tile_matrix],
+                    tile_matrix_set_obj.crs,
+                )
+            elif coverage_mask is not None:
+                level_tiles[tile_matrix] = self.coverage_samplers[tile_matrix]
+            else:
+                level_tiles[tile_matrix] = zip(
+                    random_number_generator(min_col, max_col, rng=col_rng),
+                    random_number_generator(min_row, max_row, rng=row_rng),
+                )
+
+        if self.environment.parsed_options.workload_file:
+            # precomputed (matrix, col, row) tiles, the plan is split between workers
+            self.tile_generator = plan_cursor(
+                self.environment.parsed_options.workload_file,
+                WMTS,
+                self.worker_index,
+                worker_count(self.environment),
+            )
+            logger.info(f"Using workload plan: {self.environment.parsed_options.workload_file}")
+        elif hotspots is not None and hotspots.has_tiles:
+            # ranked tiles, with their own tilematrix
+            self.tile_generator = hotspots.ranked_tiles(hotspot_rng)
+        else:
+            self.tile_generator = TileMatrixMix(
+                self.tile_matrix_weights,
+                level_tiles,
+                rng=user_random(seed, self.worker_index, self.user_index, "tilematrix"),
+            )
+
+        self.session = None
+        if self.environment.parsed_options.session_mode:
+            # viewports of a map viewer, starting on --tile-matrix
+            cols, rows = viewport.parse_viewport_size(self.environment.parsed_options.viewport_size)
+            self.session = viewport.ViewerSession(
+                viewport.pyramid_levels(
+                    self.wmts.tilematrixsets[self.tile_matrix_set], self.tile_ranges
+                ),
+                self.tile_matrix_value,
+                cols,
+                rows,
+                rng=user_random(seed, self.worker_index, self.user_index, "viewport"),
+                session_length=self.environment.parsed_options.session_length,
+                zoom_probability=self.environment.parsed_options.zoom_probability,
+                origins=self.coverage_samplers,
+                start_levels=(
+                    iter(self.tile_generator.next_level, None)
+                    if isinstance(self.tile_generator, TileMatrixMix)
+                    else None
+                ),
+            )
+            self.viewport_pool = Pool(self.environment.parsed_options.viewport_connections)
+            logger.info(
+                f"Using viewer sessions: {cols}x{rows} tiles viewports over "
+                f"{self.environment.parsed_options.viewport_connections} connections"
+            )
 
     def get_layer_tiles(self):
         """Having a matrix set get the middle zoom set"""
@@ -214,30 +712,148 @@ class WMTSBenchmark(FastHttpUser):
         &FORMAT=image%2Fpng
         &TILEMATRIXSET={tile_matrix_set}&TILEMATRIX={tile_matrix}&TILEROW={tile_row}&TILECOL={tile_col}"
 
+        """
+        # session mode (--session-mode) fetches a whole viewport instead of a single tile
+        request = self.request_viewport if self.session else self.request_tile
+        if self.open_loop:
+            # open loop mode (--target-rps), requests are sent on the arrival schedule until the user stops
+            self.open_loop.run(request)
+        else:
+            request()
+
+    def request_tile(self, intended=None):
+        """
+        GetTile request of the next tile.
+
+        Parameters:
+        intended (float): Open loop intended send time (time.perf_counter), the
+                          response time is measured from it instead of the actual send time.
         """
         # Constructing the URL path for the specific tile request
 
-        tile_col = next(self.gen_col)
-        tile_row = next(self.gen_row)
+        start = time.perf_counter()
+        tile_matrix, tile_col, tile_row = next(self.tile_generator)
+        saturation.add(saturation.DRAW, start)
+        return self.get_tile(tile_matrix, tile_col, tile_row, intended)
 
+    def get_tile(self, tile_matrix, tile_col, tile_row, intended=None):
+        """
+        GetTile request of one tile, returns the response.
+        """
         #url_path = f"{self.host}?SERVICE=WMTS&REQUEST=GetTile&VERSION=1.0.0&
         #LAYER={self.layer_name}&STYLE=default&
         #FORMAT={self.layer_mimetype}&TILEMATRIXSET={self.tile_matrix_set}
         #&TILEMATRIX={self.tile_matrix_value}&
         #TILEROW={tile_row}&TILECOL={tile_col}"
         
-        url_path = self.get_url(tile_col,tile_row)
-        logger.debug(f"URL for request: {url_path}")
+        start = time.perf_counter()
+        url_path = self.url_template.render_encoded(
+            tilematrix=encode_value(tile_matrix), tilecol=tile_col, tilerow=tile_row
+        )
+        saturation.add(saturation.URL, start)
+        logger.debug("URL for request: %s", url_path)
         
-        response = self.client.get(url_path)
+        name = self.stat_names.get(tile_matrix)
+        if self.timing_breakdown:
+            timing.start()
+        with self.client.get(url_path, name=name, headers=self.request_headers, catch_response=True) as response:
+            if self.timing_breakdown:
+                timing.report(self.environment, self.timing_name, response.request_meta["response_length"])
+            if self.cache_classifier:
+                cache_status.tag_response(response, self.cache_classifier, name or "GetTile")
+            if self.validator and tile_matrix in self.tile_sizes:
+                validation.check_response(response, self.validator, *self.tile_sizes[tile_matrix])
+            if intended is not None:
+                response.request_meta["response_time"] = (time.perf_counter() - intended) * 1000
+        if self.heatmaps is not None:
+            self.heatmap_grid(tile_matrix).add_tile(
+                tile_col, tile_row, response.request_meta["response_time"], response.request_meta["exception"] is not None
+            )
+        if self.live_metrics:
+            metrics.series("WMTS", self.layer_name, tile_matrix).add(
+                response.request_meta["response_time"], response.request_meta["response_length"], metrics.error_class(response)
+            )
+        return response
+
+    def heatmap_grid(self, tile_matrix):
+        """
+        Heatmap grid of a TileMatrix, over its tile range (the whole matrix
+        when the layer has no tiles in it, e.g. in a workload plan).
+        """
+        grid = self.heatmaps.get(tile_matrix)
+        if grid is None:
+            tile_matrix_set = self.wmts.tilematrixsets[self.tile_matrix_set]
+            matrix = tile_matrix_set.tilematrix[tile_matrix]
+            grid = self.heatmaps[tile_matrix] = heatmap.tile_matrix_heatmap(
+                f"{self.tile_matrix_set}/{tile_matrix}",
+                matrix,
+                tile_matrix_set.crs,
+                self.tile_ranges.get(tile_matrix, (0, matrix.matrixwidth - 1, 0, matrix.matrixheight - 1)),
+                self.environment.parsed_options.heatmap_cells,
+            )
+        return grid
+
+    def request_viewport(self, intended=None):
+        """
+        Fetch every tile of the next viewport of the session through the
+        parallel connections, and report the viewport complete time under the
+        VIEWPORT request type (per tile times are reported as usual).
+
+        Parameters:
+        intended (float): Open loop intended send time (time.perf_counter), the
+                          viewport time is measured from it instead of the actual send time.
+        """
+        tile_matrix, tiles = next(self.session)
+        start = intended if intended is not None else time.perf_counter()
+        responses = self.viewport_pool.map(
+            lambda tile: self.get_tile(tile_matrix, *tile), tiles
+        )
+        failed = [response for response in responses if response.request_meta.get("exception")]
+        self.environment.events.request.fire(
+            request_type=viewport.REQUEST_TYPE,
+            name=f"{self.environment.parsed_options.viewport_size} viewport",
+            response_time=(time.perf_counter() - start) * 1000,
+            response_length=sum(response.request_meta["response_length"] for response in responses),
+            exception=viewport.ViewportError(f"{len(failed)} of {len(tiles)} tiles failed") if failed else None,
+            context={},
+        )
+
+    def on_stop(self):
+        """
+        On stop, kill the open loop requests still in flight.
+        """
+        if self.open_loop:
+            self.open_loop.stop()
+        if self.session:
+            self.viewport_pool.kill()
+
+    def get_url_params(self):
+        """
+        Query parameters of the WMTS GetTile request, tilematrix, tilerow and tilecol are set per request.
+        """
+        # TODO: Obtain WMTS and version from generic class arguments
+        # TODO: Width/Height is not implemented
+        return {
+            "service": "WMTS",
+            "version": "1.0.0",
+            "request": "GetTile",
+            "layer": self.layer_name,
+            "style": "default",
+            "tilematrix": None,
+            "tilematrixset": self.tile_matrix_set,
+            "tilerow": None,
+            "tilecol": None,
+            "format": self.layer_mimetype
+            }
 
     def get_url(self,tile_col,tile_row):
         """
         Construct a URL for a GetTile request to the WMTS service.
 
-        This method constructs a URL using the base host URL and additional query parameters 
-        required for the WMTS GetTile request. The `urllib.parse` module is used to handle cases 
-        where the base host URL already contains query parameters.
+        The host url (that may contain query parameters) and the static query
+        parameters are parsed and encoded once in `on_start` into
+        `self.url_template`, only the tile matrix, row and col are set on each request.
+        The url is the same as the one built by `utils.url_template.build_url`.
         
         Parameters:
         tile_col (int): The column index of the tile.
@@ -253,42 +869,12 @@ class WMTSBenchmark(FastHttpUser):
         # Example return URL:
         # https://cartografia.dgterritorio.gov.pt/ortos2021/service?service=WMTS&version=1.0.0&request=GetTile&layer=Ortos2021-RGB&style=default&tilematrix=07&tilematrixset=PTTM_06&tilerow=108&tilecol=56&format=image%2Fpng
         """
-        # TODO: Obtain WMTS and version from generic class arguments
-        # TODO: Width/Height is not implemented
-        # TODO: obtain WMTS and version from generic class arguments
-        # TODO: Width/Height is not implementend
-
-        params = {
-            "service": "WMTS",
-            "version": "1.0.0",
-            "request": "GetTile",
-            "layer": self.layer_name,
-            "style": "default",
-            "tilematrix": self.tile_matrix_value,
-            "tilematrixset": self.tile_matrix_set,
-            "tilerow": tile_row,
-            "tilecol": tile_col,
-            "format": self.layer_mimetype
-            }
-        # Parse the base URL
-        url_parts = urlparse(self.host)
-
-        # Extract existing query parameters
-        query_params = parse_qs(url_parts.query)
-
-        # Update the query parameters with the new ones
-        query_params.update(params)
-
-        # Rebuild the query string
-        new_query = urlencode(query_params, doseq=True)
-
-        # Construct the new URL
-        new_url_parts = url_parts._replace(query=new_query)
-        full_url = urlunparse(new_url_parts)
-        return full_url
+        return self.url_template.render(
+            tilematrix=self.tile_matrix_value, tilecol=tile_col, tilerow=tile_row
+        )
 
 
-def random_number_generator(min_value, max_value, seed=None):
+def random_number_generator(min_value, max_value, seed=None, rng=None):
     """
     A generator function that yields random numbers between min_value and max_value,
     always producing the same sequence for a given seed.
@@ -297,13 +883,15 @@ def random_number_generator(min_value, max_value, seed=None):
     - min_value: the minimum value in the range.
     - max_value: the maximum value in the range (included in distribution).
     - seed: an optional seed to initialize the random number generator.
+    - rng: an optional random.Random to use instead of one seeded with seed.
     """
-    # Initialize the random number generator with the specified seed
-    random.seed(seed)
+    # Own random number generator, the global random module is shared by all users
+    if rng is None:
+        rng = random.Random(seed)
 
     # Infinite loop to continuously yield random numbers
     while True:
-        yield random.randint(min_value, max_value)
+        yield rng.randint(min_value, max_value)
 
 
 # Example running code snippet would be similar to your WMTS benchmark
@@ -347,6 +935,19 @@ if __name__ == "__main__":
     # env.parsed_options.tile_matrix_set= "test" ['EPSG:28992', 'EPSG:3857', 'EPSG:4258', 'EPSG:4326', 'EPSG:25831', 'EPSG:25832', 'OGC:1.0:GoogleMapsCompatible']
     env.parsed_options.tile_matrix_set = "PTTM_06"  # Most extreme case
     env.parsed_options.tile_matrix = "07"
+    env.parsed_options.capabilities_file = None
+    env.parsed_options.capabilities_cache_dir = None
+    env.parsed_options.workload_file = None
+    env.parsed_options.hotspot_file = None
+    env.parsed_options.coverage_file = None
+    env.parsed_options.target_rps = 0.0
+    env.parsed_options.capacity_search = False
+    env.parsed_options.session_mode = False
+    env.parsed_options.cache_status = False
+    env.parsed_options.validate_responses = False
+    env.parsed_options.timing_breakdown = False
+    env.parsed_options.accept_encoding = None
+    env.parsed_options.connection_close = False
 
     wmts_benchmark.environment = env
 